@@ -15,6 +15,8 @@ class FeynmanApp {
         this.saveSettingsBtn = document.getElementById('saveSettings');
         this.clearApiKeyBtn = document.getElementById('clearApiKey');
         this.toggleVisibilityBtn = document.getElementById('toggleApiKeyVisibility');
+        this.sessionId = this.loadSessionId();  // Per-tab id for fair server scheduling 每个标签页的ID，用于服务端公平调度
+        this.learnerId = this.loadLearnerId();  // Long-lived id for saved history 用于保存历史的长期ID
         this.customApiKey = this.loadApiKey();  // Load saved API key 加载保存的API密钥
         
         // Smart send related states 智能发送相关状态
@@ -39,6 +41,17 @@ class FeynmanApp {
         // Key: commentId, Value: array of {question, answer} exchanges commentId为键，值为{question, answer}交换数组
         this.conversationHistories = {};
         
+        // Answers waiting to be judged together 等待一起评估的回答
+        this.pendingResponses = [];
+        this.responseInFlight = false;
+        this.maxResponseBatch = 6;      // Matches server MAX_RESPOND_BATCH 与服务端 MAX_RESPOND_BATCH 一致
+        
+        // Persistent tutoring channel (null = use HTTP) 持久辅导通道（null表示使用HTTP）
+        // A new turn cancels the running one, so only one request uses it at a time
+        // 新轮次会取消正在运行的轮次，因此同一时间只有一个请求使用它
+        this.tutorSocket = null;
+        this.tutorTurnActive = false;
+        
         this.init();
     }
 
@@ -51,6 +64,57 @@ class FeynmanApp {
         this.showWelcomeMessage();
         this.updateApiKeyDisplay();
         this.initializeMarkdown();
+        this.connectTutorSocket();
+    }
+
+    // Open the WebSocket channel; HTTP stays the fallback 打开WebSocket通道；HTTP作为兜底
+    connectTutorSocket() {
+        if (typeof TutorSocket === 'undefined' || typeof WebSocket === 'undefined') {
+            return;
+        }
+        new TutorSocket({
+            sessionId: this.sessionId,
+            learnerId: this.learnerId,
+            apiKey: this.customApiKey,
+            mode: 'student',
+            onPush: (event) => this.showNotification(event.message || 'New update received', 'info'),
+            // Reconnect after a server restart or dropped connection 服务重启或连接断开后重连
+            onClose: () => this.scheduleTutorReconnect()
+        }).connect()
+            .then((socket) => {
+                this.tutorSocket = socket;
+                this.tutorReconnectDelay = 1000;
+            })
+            .catch(() => {
+                this.tutorSocket = null;
+                if (this.tutorReconnectDelay) this.scheduleTutorReconnect();
+            });
+    }
+
+    // Retry with exponential backoff, 1s up to 30s; HTTP is used meanwhile 指数退避重试（1秒至30秒），期间使用HTTP
+    scheduleTutorReconnect() {
+        this.tutorSocket = null;
+        const delay = this.tutorReconnectDelay || 1000;
+        this.tutorReconnectDelay = Math.min(delay * 2, 30000);
+        setTimeout(() => this.connectTutorSocket(), delay);
+    }
+
+    useTutorSocket() {
+        return this.tutorSocket !== null && this.tutorSocket.isOpen() && !this.tutorTurnActive;
+    }
+
+    // Run one turn on the channel; a superseded turn counts as a failure 在通道上运行一轮；被取代的轮次视为失败
+    async tutorRequest(type, payload) {
+        this.tutorTurnActive = true;
+        try {
+            const result = await this.tutorSocket.request(type, payload);
+            if (!result) {
+                throw new Error('Request was cancelled');
+            }
+            return result;
+        } finally {
+            this.tutorTurnActive = false;
+        }
     }
 
     // Initialize Markdown renderer 初始化Markdown渲染器
@@ -142,6 +206,7 @@ class FeynmanApp {
         const apiKey = this.apiKeyInput.value.trim();
         this.customApiKey = apiKey;
         this.saveApiKey(apiKey);
+        if (this.tutorSocket) this.tutorSocket.updateApiKey(apiKey);
         this.showNotification('Settings saved! 设置已保存！', 'success');
         this.closeSettings();
         this.updateApiKeyDisplay();
@@ -151,6 +216,7 @@ class FeynmanApp {
         this.customApiKey = '';
         this.apiKeyInput.value = '';
         localStorage.removeItem('gemini_api_key');
+        if (this.tutorSocket) this.tutorSocket.updateApiKey('');
         this.showNotification('Custom API key cleared! 已清除自定义API密钥！', 'success');
         this.updateApiKeyDisplay();
     }
@@ -173,6 +239,28 @@ class FeynmanApp {
         return localStorage.getItem('gemini_api_key') || '';
     }
 
+    loadSessionId() {
+        let sessionId = sessionStorage.getItem('learning_session_id');
+        if (!sessionId) {
+            sessionId = (window.crypto && crypto.randomUUID)
+                ? crypto.randomUUID()
+                : `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+            sessionStorage.setItem('learning_session_id', sessionId);
+        }
+        return sessionId;
+    }
+
+    loadLearnerId() {
+        let learnerId = localStorage.getItem('learner_id');
+        if (!learnerId) {
+            learnerId = (window.crypto && crypto.randomUUID)
+                ? crypto.randomUUID()
+                : `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+            localStorage.setItem('learner_id', learnerId);
+        }
+        return learnerId;
+    }
+
     updateApiKeyDisplay() {
         // Update settings button to show if custom key is active 更新设置按钮以显示是否使用自定义密钥
         if (this.customApiKey) {
@@ -686,10 +774,15 @@ class FeynmanApp {
     }
 
     async sendToAI(content) {
+        if (this.useTutorSocket()) {
+            return await this.tutorRequest('analyze', { content });
+        }
         const response = await fetch('/api/analyze', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
+                'X-Session-Id': this.sessionId,
+                'X-Learner-Id': this.learnerId,
             },
             body: JSON.stringify({ 
                 content,  // Only content is required 只需要content参数
@@ -970,11 +1063,98 @@ class FeynmanApp {
         }
     }
 
-    async sendResponse(commentId, response, originalQuestion = '', conversationHistory = []) {
+    // Queue an answer. It is sent at once when nothing is in flight; answers
+    // submitted while another request is in flight are judged together in
+    // one /api/respond-batch call when it returns
+    // 将回答加入队列。无请求进行中时立即发送；在另一请求进行中提交的回答会在其返回后
+    // 通过一次 /api/respond-batch 调用一起评估
+    sendResponse(commentId, response, originalQuestion = '', conversationHistory = []) {
+        return new Promise((resolve, reject) => {
+            this.pendingResponses.push({
+                item: { commentId, response, originalQuestion, conversationHistory },
+                resolve,
+                reject
+            });
+            this.scheduleResponseFlush();
+        });
+    }
+
+    scheduleResponseFlush() {
+        if (this.responseInFlight) {
+            return;
+        }
+        this.flushResponses();
+    }
+
+    async flushResponses() {
+        const batch = this.pendingResponses.splice(0, this.maxResponseBatch);
+        if (batch.length === 0) {
+            return;
+        }
+        
+        this.responseInFlight = true;
+        try {
+            if (batch.length === 1) {
+                const { commentId, response, originalQuestion, conversationHistory } = batch[0].item;
+                batch[0].resolve(await this.postResponse(commentId, response, originalQuestion, conversationHistory));
+            } else {
+                const results = await this.postResponseBatch(batch.map(entry => entry.item));
+                batch.forEach((entry, i) => {
+                    if (results[i]) {
+                        entry.resolve(results[i]);
+                    } else {
+                        entry.reject(new Error('Missing result in batch response'));
+                    }
+                });
+            }
+        } catch (error) {
+            batch.forEach(entry => entry.reject(error));
+        } finally {
+            this.responseInFlight = false;
+            if (this.pendingResponses.length > 0) {
+                this.scheduleResponseFlush();
+            }
+        }
+    }
+
+    async postResponseBatch(items) {
+        const apiResponse = await fetch('/api/respond-batch', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'X-Session-Id': this.sessionId,
+                'X-Learner-Id': this.learnerId,
+            },
+            body: JSON.stringify({
+                items,
+                apiKey: this.customApiKey
+            })
+        });
+
+        if (!apiResponse.ok) {
+            throw new Error('Network response was not ok');
+        }
+
+        const data = await apiResponse.json();
+        return data.results || [];
+    }
+
+    async postResponse(commentId, response, originalQuestion = '', conversationHistory = []) {
+        if (this.useTutorSocket()) {
+            // The server keeps the thread; the history only seeds it after a reconnect 服务端保存线程；历史仅在重连后用于初始化
+            return await this.tutorRequest('respond', {
+                threadId: commentId.split('_followup_')[0],
+                response,
+                originalQuestion,
+                conversationHistory
+            });
+        }
         const apiResponse = await fetch('/api/respond', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
+                'X-Session-Id': this.sessionId,
+                'X-Learner-Id': this.learnerId,
             },
             body: JSON.stringify({ 
                 commentId,
@@ -1,10 +1,49 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, send_from_directory, send_file, Response, stream_with_context, has_request_context, g
 from flask_cors import CORS
 import json
 import os
 from dotenv import load_dotenv
 import google.generativeai as genai
-from prompts import PROMPT_FINAL, PROMPT_RESPOND, PROMPT_TEACH, PROMPT_ANSWER_QUESTION
+from google.ai import generativelanguage as glm
+try:
+    from flask_sock import Sock  # Optional: WebSocket tutoring channel 可选：WebSocket辅导通道
+except ImportError:
+    Sock = None
+from prompts import (
+    PROMPT_FINAL, PROMPT_RESPOND, PROMPT_RESPOND_BATCH, PROMPT_TEACH, PROMPT_ANSWER_QUESTION,
+    PROMPT_TEACH_OUTLINE, PROMPT_TEACH_SECTION, PROMPT_TEACH_IMAGE, PROMPT_DOCUMENT_PAGE,
+    PROMPT_DOCUMENT_LESSON
+)
+from services import lesson_indexes, KeyedLimiter, key_fingerprint, run_ordered, section_executor
+from services import ResponseCache, RequestLog, prompt_version
+from services.scheduler import UpstreamScheduler, LANE_INTERACTIVE, LANE_LESSON, LANE_BATCH
+from services.hedging import Hedger, HedgeCancelled
+from services.tutoring import TutorSession, TurnCancelled, tutor_sessions
+from services.jobs import JobStore, JobWorkerPool, STATUS_DONE, STATUS_FAILED, detach_main_module
+from job_worker import JOB_HANDLERS
+from services.codec import FastJSONProvider, dumps_text, install_body_limits, install_compression
+from services.credentials import CredentialStore, CredentialError
+from services.usage import UsageLedger, DailyBudget, BUDGET_NORMAL, BUDGET_DEFERRED, usage_counts
+from services.history import HistoryStore
+from services.documents import DocumentError, DocumentWorkspace, document_executor, plan_pages, save_upload
+from services.experiments import (
+    CanaryRouter, BASELINE, KIND_ANALYZE, KIND_RESPOND, KIND_TEACH, check_output, load_variants,
+    validate_analysis, validate_answer, validate_feedback, validate_feedback_batch
+)
+from services.gemini import model_for
+from services.structured import JsonEarlyStop, cancel_call, cancel_stream, clean_json_response, open_stream
+from services.profiling import FORMATS, MemoryTracer, ProfileStore, RequestProfile, SamplingProfiler
+from services.lifecycle import Lifecycle, install_lifecycle, install_signal_handlers
+import prompts
+import hashlib
+import hmac
+import importlib
+import sys
+import uuid
+import threading
+import time
+from contextlib import contextmanager
+from werkzeug.formparser import parse_form_data
 
 # Load environment variables 加载环境变量
 load_dotenv()
@@ -14,8 +53,285 @@ generation_config = {
   "temperature": 0.4
 }
 
+def routing_settings():
+    """
+    Routing settings from the environment, read at startup and again on every reload
+    从环境变量读取的路由设置，启动时读取，每次重新加载时再次读取
+    """
+    return {
+        # Number of lesson passages sent with each follow-up question 每次追问携带的课程段落数
+        'retrieval_top_k': int(os.getenv('RETRIEVAL_TOP_K', 3)),
+        # Shared admission control for all upstream calls 所有上游调用共享的准入控制
+        'upstream_concurrency': int(os.getenv('UPSTREAM_CONCURRENCY', 8)),
+        # Slots lessons and background work can never take 课程与后台任务永远不能占用的槽位数
+        'interactive_reserve': int(os.getenv('UPSTREAM_INTERACTIVE_RESERVE', 2)),
+        # Hedged requests for short interactive endpoints 短交互接口的对冲请求
+        'hedged_endpoints': [e.strip() for e in os.getenv('HEDGED_ENDPOINTS', 'respond').split(',') if e.strip()],
+        'hedge_percentile': float(os.getenv('HEDGE_PERCENTILE', 0.9)),
+        'hedge_budget_ratio': float(os.getenv('HEDGE_BUDGET_RATIO', 0.1)),
+        # Daily budgets for the shared server key, in USD (0 = unlimited) 共享服务器密钥的每日美元预算（0为不限）
+        'daily_budget_usd': float(os.getenv('DAILY_BUDGET_USD', 0)),
+        'daily_session_budget_usd': float(os.getenv('DAILY_SESSION_BUDGET_USD', 0)),
+        'budget_soft_ratio': float(os.getenv('BUDGET_SOFT_RATIO', 0.8)),
+        # Cheaper settings used when a budget runs low 预算不足时使用的低成本设置
+        'economy_model': os.getenv('ECONOMY_MODEL', 'gemini-2.0-flash-lite'),
+        'economy_max_output_tokens': int(os.getenv('ECONOMY_MAX_OUTPUT_TOKENS', 2048)),
+        # max_output_tokens per structured endpoint (0 = model default) 各结构化接口的 max_output_tokens（0为模型默认）
+        'output_budgets': {
+            'analyze': int(os.getenv('MAX_OUTPUT_TOKENS_ANALYZE', 1536)),
+            'respond': int(os.getenv('MAX_OUTPUT_TOKENS_RESPOND', 512)),
+            'answer': int(os.getenv('MAX_OUTPUT_TOKENS_ANSWER', 1024)),
+        },
+        # Live prompt canary: CANARY_PERCENT of sessions use CANARY_VARIANT from EXPERIMENT_VARIANTS_FILE
+        # 线上提示词金丝雀：CANARY_PERCENT 比例的会话使用 EXPERIMENT_VARIANTS_FILE 中的 CANARY_VARIANT
+        'experiment_variants_file': os.getenv('EXPERIMENT_VARIANTS_FILE', ''),
+        'canary_variant': os.getenv('CANARY_VARIANT', ''),
+        'canary_percent': float(os.getenv('CANARY_PERCENT', 5)),
+    }
+
+ROUTING = routing_settings()
+RETRIEVAL_TOP_K = ROUTING['retrieval_top_k']
+# Max answers judged in one /api/respond-batch call 单次 /api/respond-batch 调用评估的最大回答数
+MAX_RESPOND_BATCH = int(os.getenv('MAX_RESPOND_BATCH', 6))
+# Sections per lesson in sectioned teaching mode 分节教学模式下每课的节数
+SECTION_COUNTS = {'standard': 4, 'detailed': 6}
+# Max concurrent section generations per API key 每个API密钥的最大并发分节生成数
+section_limiter = KeyedLimiter(int(os.getenv('SECTION_FANOUT_PER_KEY', 4)))
+# Shared admission control for all upstream calls 所有上游调用共享的准入控制
+upstream_scheduler = UpstreamScheduler(capacity=ROUTING['upstream_concurrency'],
+                                       interactive_reserve=ROUTING['interactive_reserve'])
+# Hedged requests for short interactive endpoints 短交互接口的对冲请求
+hedger = Hedger(
+    endpoints=ROUTING['hedged_endpoints'],
+    percentile=ROUTING['hedge_percentile'],
+    budget_ratio=ROUTING['hedge_budget_ratio']
+)
+
+# Durable background jobs 持久后台任务
+DATA_DIR = os.getenv('DATA_DIR', 'data')
+os.makedirs(DATA_DIR, exist_ok=True)
+job_store = JobStore(
+    os.getenv('JOB_DB_PATH', os.path.join(DATA_DIR, 'jobs.db')),
+    result_ttl=int(os.getenv('JOB_RESULT_TTL', 86400))
+)
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))
+# Set by start_runtime() in the serving process; None means jobs are not run here 由 start_runtime() 在服务进程中设置；None表示本进程不运行任务
+job_pool = None
+# Custom API keys of queued jobs, by job id (kept out of the jobs table) 排队任务的自定义API密钥，按任务ID（不写入任务表）
+job_api_keys = {}
+# Job id -> push token of the tutoring socket to notify 任务ID -> 需通知的辅导连接的推送令牌
+job_push_tokens = {}
+
+# Generated lesson cache, keyed by prompt version 生成课程缓存，以提示词版本为键
+response_cache = ResponseCache(
+    capacity=int(os.getenv('RESPONSE_CACHE_SIZE', 2048)),
+    ttl=int(os.getenv('RESPONSE_CACHE_TTL', 7 * 86400))
+)
+CACHE_VERSIONS = {'teach': prompt_version(PROMPT_TEACH)}
+RESPONSE_CACHE_FILE = os.getenv('RESPONSE_CACHE_FILE', os.path.join(DATA_DIR, 'lesson_cache.jsonl.gz'))
+if os.path.exists(RESPONSE_CACHE_FILE):
+    print(f'Loaded {response_cache.load(RESPONSE_CACHE_FILE, CACHE_VERSIONS)} cached lessons 已加载缓存课程')
+# Optional log of requested topics, mined by warm_cache.py 可选的主题请求日志，供 warm_cache.py 挖掘
+request_log = RequestLog(os.getenv('REQUEST_LOG_PATH'))
+
+# API key health: custom keys are validated once, bad keys are rejected early
+# API密钥健康状态：自定义密钥只验证一次，无效密钥被提前拒绝
+credential_store = CredentialStore(
+    validator=lambda api_key: validate_api_key(api_key),
+    valid_ttl=int(os.getenv('KEY_VALID_TTL', 3600)),
+    invalid_ttl=int(os.getenv('KEY_INVALID_TTL', 86400)),
+    exhausted_ttl=int(os.getenv('KEY_EXHAUSTED_TTL', 60)),
+    unknown_ttl=int(os.getenv('KEY_UNKNOWN_TTL', 30))
+)
+if GOOGLE_API_KEY:
+    # Upstream rejections of the shared key must not lock every user out 上游对共享密钥的拒绝不能把所有用户挡在门外
+    credential_store.trust(GOOGLE_API_KEY)
+# Persistent learner history: lessons, analyses and Q&A turns 持久学习历史：课程、分析与问答轮次
+history_store = HistoryStore(os.getenv('HISTORY_DB_PATH', os.path.join(DATA_DIR, 'history.db')))
+# Max items per page for /api/history reads /api/history 读取每页的最大条目数
+HISTORY_PAGE_LIMIT = int(os.getenv('HISTORY_PAGE_LIMIT', 100))
+
+# Multi-page document ingestion 多页文档导入
+DOCUMENT_DIR = os.path.join(DATA_DIR, 'documents')
+MAX_DOCUMENT_BODY = int(os.getenv('MAX_DOCUMENT_BODY', 64 * 1024 * 1024))
+MAX_DOCUMENT_PAGES = int(os.getenv('MAX_DOCUMENT_PAGES', 200))
+# Max bytes of one page image sent upstream (uploaded or rendered) 发送到上游的单页图片最大字节数（上传或渲染）
+MAX_DOCUMENT_IMAGE = int(os.getenv('MAX_DOCUMENT_IMAGE', 8 * 1024 * 1024))
+# Processes extracting/rasterizing pages, and pages in flight at once 提取/栅格化页面的进程数，以及同时在途的页数
+DOCUMENT_WORKERS = int(os.getenv('DOCUMENT_WORKERS', 2))
+DOCUMENT_PAGE_WINDOW = int(os.getenv('DOCUMENT_PAGE_WINDOW', 4))
+# Max text kept per PDF page, 0 for no limit; longer pages are marked truncated 每个PDF页面保留的最大文本长度，0为不限制；更长的页面会被标记为已截断
+MAX_PAGE_TEXT_CHARS = int(os.getenv('MAX_PAGE_TEXT_CHARS', 4000))
+
+# Token, image and cost accounting (written behind the request path) token、图片与费用记账（在请求路径之外写入）
+usage_ledger = UsageLedger(os.getenv('USAGE_DB_PATH', os.path.join(DATA_DIR, 'usage.db')))
+# Daily budgets for the shared server key, in USD (0 = unlimited) 共享服务器密钥的每日美元预算（0为不限）
+daily_budget = DailyBudget(
+    usage_ledger,
+    key_budget=ROUTING['daily_budget_usd'],
+    session_budget=ROUTING['daily_session_budget_usd'],
+    soft_ratio=ROUTING['budget_soft_ratio']
+)
+# Cheaper settings used when a budget runs low 预算不足时使用的低成本设置
+ECONOMY_MODEL = ROUTING['economy_model']
+ECONOMY_MAX_OUTPUT_TOKENS = ROUTING['economy_max_output_tokens']
+OUTPUT_BUDGETS = ROUTING['output_budgets']
+
+# Schema of each JSON endpoint; streams stop once a valid value has arrived 各JSON接口的结构；收到有效值后即停止流
+OUTPUT_SCHEMAS = {
+    'analyze': validate_analysis,
+    'respond': validate_feedback,
+    'respond-batch': validate_feedback_batch,
+    'answer': validate_answer,
+}
+
+def build_canary_router(settings):
+    """
+    CanaryRouter for the configured variant, or a disabled one
+    为配置的变体创建 CanaryRouter，未配置时返回禁用的路由器
+    """
+    variants_file, variant_name = settings['experiment_variants_file'], settings['canary_variant']
+    if not variants_file or not variant_name:
+        return CanaryRouter()
+    variants = {v.name: v for v in load_variants(variants_file)}
+    if variant_name not in variants:
+        raise ValueError(f'CANARY_VARIANT {variant_name!r} is not defined in {variants_file}')
+    router = CanaryRouter(variants[variant_name], settings['canary_percent'])
+    print(f'Canary 金丝雀: {router.percent}% of sessions use variant {variant_name}')
+    return router
+
+canary_router = build_canary_router(ROUTING)
+
+# Token for /api/admin/* endpoints (disabled when unset) /api/admin/* 接口的令牌（未设置时禁用）
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN', '')
+
+# On-demand profiling, admin only 按需性能剖析，仅限管理员
+profile_store = ProfileStore(os.getenv('PROFILE_DIR', os.path.join(DATA_DIR, 'profiles')),
+                             keep=int(os.getenv('PROFILE_KEEP', 50)))
+# A forgotten sampler stops itself after this long 被遗忘的采样器在此时长后自动停止
+PROFILE_MAX_SECONDS = int(os.getenv('PROFILE_MAX_SECONDS', 300))
+memory_tracer = MemoryTracer()
+active_sampler = None
+sampler_lock = threading.Lock()
+
+# Graceful shutdown: seconds in-flight generations and streams get to finish 优雅关闭：进行中的生成和流式响应的完成时限（秒）
+lifecycle = Lifecycle(drain_timeout=float(os.getenv('DRAIN_TIMEOUT', 30)))
+
+# Request body limits in bytes, checked before the body is read 请求体大小限制（字节），在读取请求体前检查
+MAX_JSON_BODY = int(os.getenv('MAX_JSON_BODY', 256 * 1024))
+MAX_IMAGE_BODY = int(os.getenv('MAX_IMAGE_BODY', 12 * 1024 * 1024))
+BODY_LIMITS = {
+    '/api/respond': int(os.getenv('MAX_RESPOND_BODY', 64 * 1024)),
+    '/api/respond-batch': MAX_JSON_BODY,
+    '/api/teach-with-image': MAX_IMAGE_BODY,
+    '/api/jobs': MAX_IMAGE_BODY,
+    '/api/documents': MAX_DOCUMENT_BODY,
+}
+# Smallest JSON response worth compressing 值得压缩的最小JSON响应
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', 1024))
+
 app = Flask(__name__)
+app.json = FastJSONProvider(app)  # orjson when installed 安装了orjson时使用
 CORS(app)  # Allow cross-origin requests 允许跨域请求
+# Registered first: refuse new work while draining 最先注册：排空期间拒绝新工作
+install_lifecycle(app, lifecycle, exempt_prefixes=('/api/health/', '/api/admin/', '/api/metrics/'))
+install_body_limits(app, BODY_LIMITS, MAX_JSON_BODY)
+install_compression(app, min_size=COMPRESS_MIN_SIZE)
+
+@app.before_request
+def start_request_profile():
+    """
+    Profile this request when an admin sends X-Profile: cpu or memory
+    管理员发送 X-Profile: cpu 或 memory 时剖析本请求
+    
+    cpu records cProfile and the request thread's stacks; memory records
+    allocation growth with tracemalloc (for the image and document paths).
+    The capture id is returned in X-Profile-Id.
+    cpu 记录cProfile和请求线程的调用栈；memory 使用tracemalloc记录分配增长（用于图片和文档路径）。
+    采集ID在 X-Profile-Id 中返回。
+    """
+    mode = request.headers.get('X-Profile', '').strip().lower()
+    if not mode or not request.path.startswith('/api/') or require_admin() is not None:
+        return None
+    label = f'{request.method} {request.path}'
+    if mode == 'memory':
+        capture_id = profile_store.new_id('memory')
+        if not memory_tracer.start(capture_id):
+            # One memory capture at a time; this request runs untraced 同一时间只有一个内存采集；本请求不做追踪
+            g.profile_skipped = f'memory capture {memory_tracer.owner} is running'
+            return None
+        g.profile = (capture_id, 'memory', label, None)
+    else:
+        g.profile = (profile_store.new_id('request'), 'cpu', label, RequestProfile(label).start())
+    return None
+
+@app.after_request
+def add_profile_header(response):
+    if 'profile' in g:
+        response.headers['X-Profile-Id'] = g.profile[0]
+    elif 'profile_skipped' in g:
+        response.headers['X-Profile-Skipped'] = g.profile_skipped
+    return response
+
+@app.teardown_request
+def finish_request_profile(exc):
+    # Runs after streamed bodies finish, so streams are profiled whole 在流式响应体结束后运行，因此整个流都被剖析
+    if 'profile' not in g:
+        return
+    capture_id, mode, label, profile = g.pop('profile')
+    try:
+        if mode == 'memory':
+            profile_store.save('memory', label, text=f'{label}\n{memory_tracer.snapshot()}', capture_id=capture_id)
+        else:
+            profile.stop()
+            profile_store.save('request', label, collapsed=profile.sampler.collapsed(), profile=profile.profile,
+                               text=profile.report(), capture_id=capture_id)
+    except Exception as e:
+        print(f'Profile capture failed 剖析采集失败: {e}')
+    finally:
+        if mode == 'memory':
+            memory_tracer.stop(capture_id)
+
+@app.before_request
+def reject_bad_api_key():
+    """
+    Answer 401/429 for a known-bad custom key before any route work
+    在任何路由处理之前，对已知无效的自定义密钥返回401/429
+    """
+    if request.method != 'POST' or not request.path.startswith('/api/'):
+        return None
+    data = request.get_json(silent=True)
+    custom_api_key = data.get('apiKey') if isinstance(data, dict) else None
+    if not isinstance(custom_api_key, str) or not custom_api_key.strip():
+        return None
+    try:
+        credential_store.check(custom_api_key.strip())
+    except CredentialError as e:
+        return credential_error_response(e)
+    return None
+
+def credential_error_response(e):
+    response = jsonify({
+        'error': 'API密钥无效' if e.status == 401 else 'API密钥配额已用尽',
+        'message': str(e),
+        'keyState': e.state
+    })
+    response.status_code = e.status
+    if e.retry_after:
+        response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+def require_admin():
+    """
+    None if the request carries ADMIN_TOKEN, else an error response
+    请求携带 ADMIN_TOKEN 时返回None，否则返回错误响应
+    """
+    if not ADMIN_TOKEN:
+        return jsonify({'error': '管理接口未启用', 'message': 'Set ADMIN_TOKEN to enable admin endpoints'}), 404
+    token = request.headers.get('X-Admin-Token', '')
+    if not hmac.compare_digest(token.encode('utf-8'), ADMIN_TOKEN.encode('utf-8')):
+        return jsonify({'error': '无权访问'}), 403
+    return None
 
 # ==================== Routes 路由 ====================
 
@@ -40,8 +356,13 @@ def analyze_content():
         if not content:
             return jsonify({'error': '内容不能为空'}), 400
         
+        # Async variant: queue as a background job 异步版本：作为后台任务排队
+        if wants_async(data):
+            return submit_job('analyze', {'content': content}, custom_api_key, data)
+        
         # Call unified analysis function with custom API key 使用自定义API密钥调用统一的分析函数
         analysis = analyze_with_ai(content, custom_api_key)
+        history_store.record_analysis(current_user_id(), current_session_id(), content, analysis)
         
         return jsonify({
             'success': True,
@@ -84,13 +405,15 @@ def respond_to_question():
         
         # Call AI response function with custom API key 使用自定义API密钥调用AI回应函数
         feedback_data = respond_with_ai(response, original_question, conversation_history, custom_api_key)
-        
-        return jsonify({
-            'success': True,
+        reply = {
             'understood': feedback_data.get('understood', True),
             'feedback': feedback_data.get('feedback', ''),
             'followUpQuestion': feedback_data.get('followUpQuestion', None)
-        })
+        }
+        history_store.record_turn(current_user_id(), current_session_id(), 'respond', response,
+                                  dict(reply, originalQuestion=original_question), thread_id=str(comment_id or ''))
+        
+        return jsonify(dict(reply, success=True))
         
     except Exception as e:
         import traceback
@@ -111,6 +434,74 @@ def respond_to_question():
             'message': str(e)
         }), 500
 
+# Batched AI response endpoint 批量AI回应接口
+@app.route('/api/respond-batch', methods=['POST'])
+def respond_to_questions_batch():
+    try:
+        # Get request data 获取请求数据
+        data = request.get_json()
+        items = data.get('items', [])
+        custom_api_key = data.get('apiKey', '').strip()  # Get custom API key 获取自定义API密钥
+        
+        if not isinstance(items, list) or not items:
+            return jsonify({'error': '回答列表不能为空'}), 400
+        
+        if len(items) > MAX_RESPOND_BATCH:
+            return jsonify({'error': f'单次最多提交{MAX_RESPOND_BATCH}个回答'}), 400
+        
+        threads = []
+        for item in items:
+            if not isinstance(item, dict):
+                return jsonify({'error': '回答格式无效'}), 400
+            response = str(item.get('response', '')).strip()
+            if not response:
+                return jsonify({'error': '回答内容不能为空'}), 400
+            history = item.get('conversationHistory')
+            threads.append({
+                'threadId': str(item.get('commentId', '')),
+                'response': response,
+                'originalQuestion': str(item.get('originalQuestion', '')),
+                'conversationHistory': [h for h in history if isinstance(h, dict)] if isinstance(history, list) else []
+            })
+        
+        # Judge all answers in one call; results follow the order of items 一次调用评估所有回答；结果与items顺序一致
+        results = [
+            {
+                'commentId': thread['threadId'],
+                'understood': result.get('understood', True),
+                'feedback': result.get('feedback', ''),
+                'followUpQuestion': result.get('followUpQuestion', None)
+            }
+            for thread, result in zip(threads, respond_batch_with_ai(threads, custom_api_key))
+        ]
+        for thread, result in zip(threads, results):
+            history_store.record_turn(current_user_id(), current_session_id(), 'respond', thread['response'],
+                                      dict(result, originalQuestion=thread['originalQuestion']),
+                                      thread_id=thread['threadId'])
+        
+        return jsonify({
+            'success': True,
+            'results': results
+        })
+        
+    except Exception as e:
+        import traceback
+        print(f'===== AI Batch Response Error AI批量回应错误 =====')
+        print(f'Error Type 错误类型: {type(e).__name__}')
+        print(f'Error Message 错误信息: {str(e)}')
+        print(f'Full Stack 完整堆栈:')
+        traceback.print_exc()
+        
+        if hasattr(e, 'ai_response'):
+            print(f'===== AI Raw Output AI原始输出 =====')
+            print(e.ai_response)
+        
+        print(f'=====================')
+        return jsonify({
+            'error': 'AI回应失败',
+            'message': str(e)
+        }), 500
+
 # Teacher mode: Start teaching 教师模式：开始教学
 @app.route('/api/teach', methods=['POST'])
 def start_teaching():
@@ -119,17 +510,43 @@ def start_teaching():
         data = request.get_json()
         topic = data.get('topic', '').strip()
         custom_api_key = data.get('apiKey', '').strip()  # Get custom API key 获取自定义API密钥
+        # Ask for a new lesson instead of the saved or cached one 请求新课程，而不是已保存或已缓存的课程
+        regenerate = data.get('regenerate') is True
         
         if not topic:
             return jsonify({'error': '教学主题不能为空'}), 400
         
+        # Async variant: queue as a background job 异步版本：作为后台任务排队
+        if wants_async(data):
+            return submit_job('teach', {'topic': topic, 'regenerate': regenerate}, custom_api_key, data)
+        
+        request_log.record('teach', topic=topic)
+        
+        # Returning learner: serve their earlier lesson from disk 回访的学习者：从磁盘返回之前的课程
+        user_id = current_user_id()
+        # Same version teach_with_ai caches under, so a prompt reload retires saved lessons too 与 teach_with_ai 的缓存版本一致，提示词重新加载后已保存的课程也随之失效
+        version = current_variant().version(KIND_TEACH, PROMPT_TEACH)
+        previous = None if regenerate else history_store.find_lesson(user_id, topic, 'teach', version)
+        if previous is not None:
+            return jsonify({
+                'success': True,
+                'content': previous['content'],
+                'topic': topic,
+                'lessonId': lesson_indexes.add(previous['content']),
+                'fromHistory': True
+            })
+        
         # Call AI teaching function 调用AI教学函数
-        teaching_content = teach_with_ai(topic, custom_api_key)
+        teaching_content = teach_with_ai(topic, custom_api_key, use_cache=not regenerate)
+        lesson_id = lesson_indexes.add(teaching_content)  # Index lesson for follow-up questions 为后续提问索引课程
+        history_store.record_lesson(user_id, current_session_id(), lesson_id, topic, teaching_content,
+                                    prompt_version=version)
         
         return jsonify({
             'success': True,
             'content': teaching_content,
-            'topic': topic
+            'topic': topic,
+            'lessonId': lesson_id
         })
         
     except Exception as e:
@@ -150,6 +567,50 @@ def start_teaching():
             'message': str(e)
         }), 500
 
+# Teacher mode: Sectioned teaching (streamed) 教师模式：分节教学（流式）
+@app.route('/api/teach-sectioned', methods=['POST'])
+def start_sectioned_teaching():
+    # Get request data 获取请求数据
+    data = request.get_json()
+    topic = data.get('topic', '').strip()
+    detail = data.get('detail', 'detailed')
+    custom_api_key = data.get('apiKey', '').strip()
+    
+    if not topic:
+        return jsonify({'error': '教学主题不能为空'}), 400
+    
+    if detail not in SECTION_COUNTS:
+        return jsonify({'error': '不支持的详细程度'}), 400
+    
+    def generate():
+        # Stream one JSON object per line 每行输出一个JSON对象
+        try:
+            for event in teach_sectioned_with_ai(topic, custom_api_key, SECTION_COUNTS[detail]):
+                if event['type'] == 'done':
+                    history_store.record_lesson(current_user_id(), current_session_id(), event['lessonId'],
+                                                topic, event['content'], source='sectioned')
+                yield dumps_text(event) + '\n'
+        except Exception as e:
+            import traceback
+            print(f'===== AI Sectioned Teaching Error AI分节教学错误 =====')
+            print(f'Error Type 错误类型: {type(e).__name__}')
+            print(f'Error Message 错误信息: {str(e)}')
+            print(f'Full Stack 完整堆栈:')
+            traceback.print_exc()
+            
+            if hasattr(e, 'ai_response'):
+                print(f'===== AI Raw Output AI原始输出 =====')
+                print(e.ai_response)
+            
+            print(f'=====================')
+            yield dumps_text({
+                'type': 'error',
+                'error': 'AI教学失败',
+                'message': str(e)
+            }) + '\n'
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
 # Teacher mode: Start teaching with image 教师模式：带图片的教学
 @app.route('/api/teach-with-image', methods=['POST'])
 def start_teaching_with_image():
@@ -179,13 +640,21 @@ def start_teaching_with_image():
         if not image.get('data'):
             return jsonify({'error': '图片数据为空'}), 400
         
+        # Async variant: queue as a background job 异步版本：作为后台任务排队
+        if wants_async(data):
+            return submit_job('teach-with-image', {'topic': topic, 'image': image}, custom_api_key, data)
+        
         # Call AI teaching function with image 调用带图片的AI教学函数
         teaching_content = teach_with_ai_image(topic, image, custom_api_key)
+        lesson_id = lesson_indexes.add(teaching_content)  # Index lesson for follow-up questions 为后续提问索引课程
+        history_store.record_lesson(current_user_id(), current_session_id(), lesson_id,
+                                    topic or 'Image Analysis', teaching_content, source='image')
         
         return jsonify({
             'success': True,
             'content': teaching_content,
-            'topic': topic or 'Image Analysis'
+            'topic': topic or 'Image Analysis',
+            'lessonId': lesson_id
         })
         
     except Exception as e:
@@ -206,6 +675,80 @@ def start_teaching_with_image():
             'message': str(e)
         }), 500
 
+# Teacher mode: Teach from a multi-page document 教师模式：基于多页文档教学
+@app.route('/api/documents', methods=['POST'])
+def start_teaching_with_document():
+    workspace = DocumentWorkspace(DOCUMENT_DIR, uuid.uuid4().hex)
+    try:
+        # Stream the upload to disk: multipart files, or a raw PDF/image body 将上传内容流式写入磁盘：multipart文件或原始PDF/图片请求体
+        if request.mimetype == 'multipart/form-data':
+            # File parts are written straight into the workspace, not buffered by request.files first
+            # 文件部分直接写入工作区，而不是先由 request.files 缓冲
+            _, fields, files = parse_form_data(request.environ, stream_factory=workspace.open_file,
+                                               max_content_length=request.max_content_length)
+            uploads = files.getlist('files') + files.getlist('file')
+            for _, upload in files.items(multi=True):
+                upload.close()
+            workspace.files = [upload.stream.name for upload in uploads]
+        else:
+            fields = request.args
+            save_upload(request.stream, workspace.new_file(), MAX_DOCUMENT_BODY)
+        
+        topic = fields.get('topic', '').strip()
+        custom_api_key = fields.get('apiKey', '').strip()
+        if custom_api_key:
+            credential_store.check(custom_api_key)
+        
+        if not workspace.files:
+            workspace.remove()
+            return jsonify({'error': '文档不能为空'}), 400
+        
+        pages = plan_pages(workspace.files, MAX_DOCUMENT_PAGES, document_executor(DOCUMENT_WORKERS), MAX_DOCUMENT_IMAGE,
+                           MAX_PAGE_TEXT_CHARS)
+    except DocumentError as e:
+        workspace.remove()
+        return jsonify({'error': '文档无法处理', 'message': str(e)}), 400
+    except CredentialError as e:
+        workspace.remove()
+        return credential_error_response(e)
+    except Exception:
+        workspace.remove()
+        raise
+    
+    user_id = current_user_id()
+    
+    def generate():
+        # Stream one JSON object per line 每行输出一个JSON对象
+        try:
+            for event in teach_document_with_ai(topic, pages, custom_api_key):
+                if event['type'] == 'done':
+                    history_store.record_lesson(user_id, current_session_id(), event['lessonId'],
+                                                event['topic'], event['content'], source='document')
+                yield dumps_text(event) + '\n'
+        except Exception as e:
+            import traceback
+            print(f'===== AI Document Teaching Error AI文档教学错误 =====')
+            print(f'Error Type 错误类型: {type(e).__name__}')
+            print(f'Error Message 错误信息: {str(e)}')
+            print(f'Full Stack 完整堆栈:')
+            traceback.print_exc()
+            
+            if hasattr(e, 'ai_response'):
+                print(f'===== AI Raw Output AI原始输出 =====')
+                print(e.ai_response)
+            
+            print(f'=====================')
+            yield dumps_text({
+                'type': 'error',
+                'error': 'AI文档教学失败',
+                'message': str(e)
+            }) + '\n'
+    
+    response = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    # Runs even if the client leaves before the body starts 即使客户端在响应体开始前离开也会执行
+    response.call_on_close(workspace.remove)
+    return response
+
 # Teacher mode: Answer student question 教师模式：回答学生问题
 @app.route('/api/answer', methods=['POST'])
 def answer_student_question():
@@ -215,6 +758,7 @@ def answer_student_question():
         topic = data.get('topic', '').strip()
         question = data.get('question', '').strip()
         teaching_context = data.get('teachingContext', '')
+        lesson_id = data.get('lessonId', '')  # Id returned by /api/teach 由/api/teach返回的课程ID
         conversation_history = data.get('conversationHistory', [])
         custom_api_key = data.get('apiKey', '').strip()
         
@@ -225,14 +769,15 @@ def answer_student_question():
             return jsonify({'error': '教学主题不能为空'}), 400
         
         # Call AI answer function 调用AI回答函数
-        answer_data = answer_question_with_ai(topic, question, teaching_context, conversation_history, custom_api_key)
-        
-        return jsonify({
-            'success': True,
+        answer_data = answer_question_with_ai(topic, question, teaching_context, conversation_history, custom_api_key, lesson_id)
+        reply = {
             'answer': answer_data.get('answer', ''),
             'additionalContext': answer_data.get('additionalContext', ''),
             'encouragement': answer_data.get('encouragement', '')
-        })
+        }
+        history_store.record_turn(current_user_id(), current_session_id(), 'answer', question, reply, lesson_id=lesson_id)
+        
+        return jsonify(dict(reply, success=True))
         
     except Exception as e:
         import traceback
@@ -252,54 +797,311 @@ def answer_student_question():
             'message': str(e)
         }), 500
 
-# ==================== AI Functions AI 函数 ====================
-
-def clean_json_response(text):
-    """
-    Clean AI response, remove markdown code block markers
-    清理AI响应，移除markdown代码块标记
-    
-    Args:
-        text: Raw text returned by AI AI返回的原始文本
-    
-    Returns:
-        str: Cleaned JSON string 清理后的JSON字符串
-    """
-    text = text.strip()
-    
-    # Remove markdown code block markers 移除markdown代码块标记
-    if text.startswith('```json'):
-        text = text[7:]  # Remove opening ```json 移除开头的 ```json
-    elif text.startswith('```'):
-        text = text[3:]  # Remove opening ``` 移除开头的 ```
+# Persistent tutoring channel 持久辅导通道
+if Sock is not None:
+    sock = Sock(app)
     
-    if text.endswith('```'):
-        text = text[:-3]  # Remove closing ``` 移除结尾的 ```
-    
-    # Clean all leading and trailing whitespace again (including newlines) 再次清理所有前后空白字符（包括换行符）
-    text = text.strip()
+    @sock.route('/ws/tutor')
+    def tutor_socket(ws):
+        session = TutorSession(ws, TUTOR_HANDLERS, on_error=print_tutor_error, registry=tutor_sessions,
+                               modes=TUTOR_MODES)
+        session.session_id = current_session_id()
+        session.user_id = current_user_id()
+        session.serve()
+else:
+    print('flask-sock not installed, /ws/tutor disabled 未安装flask-sock，/ws/tutor 已禁用')
+
+# Background jobs: submit 后台任务：提交
+@app.route('/api/jobs', methods=['POST'])
+def create_job():
+    data = request.get_json()
+    kind = data.get('kind', '')
+    payload = data.get('payload', {})
+    custom_api_key = data.get('apiKey', '').strip()
     
-    # Find position of first '[' or '{' (JSON start) 找到第一个 '[' 或 '{' 的位置（JSON的开始）
-    json_start = -1
-    for i, char in enumerate(text):
-        if char in '[{':
-            json_start = i
-            break
+    if kind not in JOB_HANDLERS:
+        return jsonify({'error': '不支持的任务类型'}), 400
     
-    if json_start > 0:
-        text = text[json_start:]
+    if not isinstance(payload, dict):
+        return jsonify({'error': '任务参数格式不正确'}), 400
     
-    # Find position of last ']' or '}' (JSON end) 找到最后一个 ']' 或 '}' 的位置（JSON的结束）
-    json_end = -1
-    for i in range(len(text) - 1, -1, -1):
-        if text[i] in ']}':
-            json_end = i + 1
-            break
+    return submit_job(kind, payload, custom_api_key, data)
+
+# Background jobs: poll 后台任务：轮询
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = collect_job(job_store.get(job_id))
+    if job is None:
+        return jsonify({'error': '任务不存在或已过期'}), 404
+    return jsonify(dict(job, success=True))
+
+# Background jobs: stream status until finished (Server-Sent Events) 后台任务：流式推送状态直到完成（SSE）
+@app.route('/api/jobs/<job_id>/stream', methods=['GET'])
+def stream_job(job_id):
+    if job_store.get(job_id) is None:
+        return jsonify({'error': '任务不存在或已过期'}), 404
     
-    if json_end > 0:
-        text = text[:json_end]
+    def generate():
+        last_status = None
+        while True:
+            job = collect_job(job_store.get(job_id))
+            if job is None:
+                yield 'event: error\ndata: {"error": "任务不存在或已过期"}\n\n'
+                return
+            if job['status'] != last_status:
+                last_status = job['status']
+                event = 'result' if last_status in ('done', 'failed') else 'status'
+                yield f'event: {event}\ndata: {dumps_text(job)}\n\n'
+                if event == 'result':
+                    return
+            else:
+                yield ': keep-alive\n\n'
+            if lifecycle.draining:
+                # EventSource reconnects, to another instance 浏览器的EventSource会重连（到其他实例）
+                yield 'retry: 3000\n\n'
+                return
+            time.sleep(1)
     
-    return text.strip()
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# ---------- Learner history 学习历史 ----------
+
+def history_page_args(default_limit):
+    """
+    (limit, cursor) query arguments of a paginated history read
+    分页历史读取的 (limit, cursor) 查询参数
+    """
+    try:
+        limit = int(request.args.get('limit', default_limit))
+    except ValueError:
+        limit = default_limit
+    return min(max(limit, 1), HISTORY_PAGE_LIMIT), request.args.get('cursor') or None
+
+# Learner's lessons, newest first 学习者的课程，最新的在前
+@app.route('/api/history/lessons', methods=['GET'])
+def history_lessons():
+    user_id = current_user_id()
+    if not user_id:
+        return jsonify({'error': '缺少学习者ID', 'message': 'Send the X-Learner-Id header'}), 400
+    limit, cursor = history_page_args(20)
+    try:
+        lessons, next_cursor = history_store.recent_lessons(user_id, limit, cursor)
+    except ValueError as e:
+        return jsonify({'error': '分页参数无效', 'message': str(e)}), 400
+    return jsonify({'success': True, 'lessons': lessons, 'nextCursor': next_cursor})
+
+# One lesson with the first page of its Q&A turns 单个课程及其第一页问答轮次
+@app.route('/api/history/lessons/<lesson_id>', methods=['GET'])
+def history_lesson(lesson_id):
+    user_id = current_user_id()
+    if not user_id:
+        return jsonify({'error': '缺少学习者ID', 'message': 'Send the X-Learner-Id header'}), 400
+    lesson = history_store.get_lesson(user_id, lesson_id)
+    if lesson is None:
+        return jsonify({'error': '课程不存在'}), 404
+    # Re-index so follow-up questions use retrieval again 重新索引，使后续提问再次使用检索
+    lesson_indexes.add(lesson['content'])
+    limit, _ = history_page_args(50)
+    turns, next_cursor = history_store.turns(user_id, lesson_id, limit)
+    return jsonify(dict(lesson, success=True, turns=turns, nextCursor=next_cursor))
+
+# Q&A turns of a lesson, paginated or streamed as NDJSON 课程的问答轮次，分页或以NDJSON流式返回
+@app.route('/api/history/turns', methods=['GET'])
+def history_turns():
+    user_id = current_user_id()
+    if not user_id:
+        return jsonify({'error': '缺少学习者ID', 'message': 'Send the X-Learner-Id header'}), 400
+    lesson_id = request.args.get('lessonId', '')
+    if request.args.get('stream') == '1':
+        def generate():
+            for turn in history_store.iter_turns(user_id, lesson_id):
+                yield dumps_text(turn) + '\n'
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    limit, cursor = history_page_args(50)
+    if cursor is not None and not cursor.isdigit():
+        return jsonify({'error': '分页参数无效'}), 400
+    turns, next_cursor = history_store.turns(user_id, lesson_id, limit, cursor or 0)
+    return jsonify({'success': True, 'turns': turns, 'nextCursor': next_cursor})
+
+# Learner's analyses with their comments 学习者的分析及其评论
+@app.route('/api/history/analyses', methods=['GET'])
+def history_analyses():
+    user_id = current_user_id()
+    if not user_id:
+        return jsonify({'error': '缺少学习者ID', 'message': 'Send the X-Learner-Id header'}), 400
+    limit, cursor = history_page_args(10)
+    try:
+        analyses, next_cursor = history_store.recent_analyses(user_id, limit, cursor)
+    except ValueError as e:
+        return jsonify({'error': '分页参数无效', 'message': str(e)}), 400
+    return jsonify({'success': True, 'analyses': analyses, 'nextCursor': next_cursor})
+
+# Upstream scheduler metrics 上游调度器指标
+@app.route('/api/metrics/scheduler', methods=['GET'])
+def scheduler_metrics():
+    return jsonify(upstream_scheduler.snapshot())
+
+# Hedged request metrics 对冲请求指标
+@app.route('/api/metrics/hedging', methods=['GET'])
+def hedging_metrics():
+    return jsonify(hedger.snapshot())
+
+# API key health (admin) API密钥健康状态（管理）
+@app.route('/api/admin/keys', methods=['GET'])
+def key_health():
+    denied = require_admin()
+    if denied:
+        return denied
+    return jsonify(credential_store.snapshot())
+
+# Usage totals for a day (admin) 某日用量汇总（管理）
+@app.route('/api/admin/usage', methods=['GET'])
+def usage_summary():
+    denied = require_admin()
+    if denied:
+        return denied
+    group_by = request.args.get('by', 'key')
+    if group_by not in ('key', 'session', 'endpoint', 'model'):
+        return jsonify({'error': '不支持的分组方式'}), 400
+    return jsonify({
+        'day': request.args.get('day') or None,
+        'groupBy': group_by,
+        'rows': usage_ledger.summary(request.args.get('day'), group_by, int(request.args.get('limit', 100))),
+        'budget': daily_budget.snapshot(GOOGLE_API_KEY or '')
+    })
+
+# Prompt canary arms: live metrics plus today's usage per arm 提示词金丝雀各组：线上指标及今日各组用量
+@app.route('/api/admin/experiments', methods=['GET'])
+def experiment_summary():
+    denied = require_admin()
+    if denied:
+        return denied
+    paths = ('/api/analyze', '/api/respond', '/api/teach')
+    rows = usage_ledger.summary(request.args.get('day'), 'endpoint', 1000)
+    return jsonify({
+        'canary': canary_router.snapshot(),
+        'usage': [row for row in rows if row['endpoint'].split('@')[0] in paths]
+    })
+
+# Start the process-wide sampling profiler 启动进程级采样剖析器
+@app.route('/api/admin/profiling/sampler/start', methods=['POST'])
+def start_sampler():
+    global active_sampler
+    denied = require_admin()
+    if denied:
+        return denied
+    data = request.get_json(silent=True) or {}
+    interval = min(max(float(data.get('intervalMs', 5)), 1.0), 100.0) / 1000
+    with sampler_lock:
+        if active_sampler is not None and active_sampler.running:
+            return jsonify({'error': '采样器已在运行'}), 409
+        active_sampler = SamplingProfiler(interval, max_seconds=PROFILE_MAX_SECONDS).start()
+    return jsonify({'running': True, 'intervalMs': interval * 1000, 'maxSeconds': PROFILE_MAX_SECONDS})
+
+# Stop the sampler and save its flamegraph 停止采样器并保存火焰图
+@app.route('/api/admin/profiling/sampler/stop', methods=['POST'])
+def stop_sampler():
+    global active_sampler
+    denied = require_admin()
+    if denied:
+        return denied
+    with sampler_lock:
+        sampler, active_sampler = active_sampler, None
+    if sampler is None:
+        return jsonify({'error': '采样器未运行'}), 409
+    sampler.stop()
+    summary = sampler.summary()
+    capture_id = profile_store.save('sampler', f'Sampler {summary["durationSeconds"]}s',
+                                    collapsed=sampler.collapsed(), text=json.dumps(summary, indent=2))
+    return jsonify({'id': capture_id, 'summary': summary})
+
+# Memory tracing: start, snapshot (diff since start), stop 内存追踪：启动、快照（与启动时对比）、停止
+@app.route('/api/admin/profiling/memory/<action>', methods=['POST'])
+def memory_profiling(action):
+    denied = require_admin()
+    if denied:
+        return denied
+    if action == 'start':
+        if not memory_tracer.start('admin', int((request.get_json(silent=True) or {}).get('frames', 10))):
+            return jsonify({'error': '内存追踪已在运行', 'message': f'Held by {memory_tracer.owner}'}), 409
+        return jsonify({'tracing': True})
+    if action == 'snapshot':
+        if memory_tracer.owner != 'admin':
+            return jsonify({'error': '内存追踪未运行'}), 409
+        return jsonify({'id': profile_store.save('memory', 'Memory snapshot', text=memory_tracer.snapshot())})
+    if action == 'stop':
+        if not memory_tracer.stop('admin'):
+            return jsonify({'error': '内存追踪未运行'}), 409
+        return jsonify({'tracing': False})
+    return jsonify({'error': '不支持的操作'}), 404
+
+# Saved captures 已保存的采集结果
+@app.route('/api/admin/profiles', methods=['GET'])
+def list_profiles():
+    denied = require_admin()
+    if denied:
+        return denied
+    return jsonify({
+        'sampler': active_sampler.summary() if active_sampler is not None and active_sampler.running else None,
+        'memoryTracing': memory_tracer.tracing,
+        'profiles': profile_store.list()
+    })
+
+# Download a capture: collapsed, svg, pstats or txt 下载采集结果：collapsed、svg、pstats 或 txt
+@app.route('/api/admin/profiles/<capture_id>/<fmt>', methods=['GET'])
+def download_profile(capture_id, fmt):
+    denied = require_admin()
+    if denied:
+        return denied
+    path = profile_store.path(capture_id, fmt)
+    if path is None:
+        return jsonify({'error': '采集结果不存在'}), 404
+    return send_file(path, mimetype=FORMATS[fmt], as_attachment=fmt != 'svg',
+                     download_name=f'{capture_id}.{fmt}')
+
+# Liveness: the process is serving requests 存活检查：进程正在处理请求
+@app.route('/api/health/live', methods=['GET'])
+def health_live():
+    return jsonify(dict(lifecycle.snapshot(), alive=True))
+
+# Readiness: 503 while starting or draining, so load balancers stop routing here 就绪检查：启动或排空时返回503，使负载均衡器停止路由到此处
+@app.route('/api/health/ready', methods=['GET'])
+def health_ready():
+    return jsonify(dict(lifecycle.snapshot(), ready=lifecycle.ready)), 200 if lifecycle.ready else 503
+
+# Start draining without exiting (e.g. from a pre-stop hook) 开始排空但不退出（如在停止前钩子中调用）
+@app.route('/api/admin/drain', methods=['POST'])
+def admin_drain():
+    denied = require_admin()
+    if denied:
+        return denied
+    begin_drain()
+    return jsonify(lifecycle.snapshot())
+
+# Reload prompt templates and routing settings 重新加载提示词模板和路由设置
+@app.route('/api/admin/reload', methods=['POST'])
+def admin_reload():
+    denied = require_admin()
+    if denied:
+        return denied
+    try:
+        return jsonify(dict(reload_runtime_config(), success=True))
+    except Exception as e:
+        print(f'===== Reload Error 重新加载错误 =====')
+        print(f'Error Message 错误信息: {str(e)}')
+        print(f'=====================')
+        return jsonify({'error': '重新加载失败', 'message': str(e)}), 500
+
+# Forget a key's cached state so it is validated again 遗忘密钥缓存状态以便重新验证
+@app.route('/api/admin/keys/<fingerprint>', methods=['DELETE'])
+def forget_key(fingerprint):
+    denied = require_admin()
+    if denied:
+        return denied
+    return jsonify({'success': credential_store.forget(fingerprint)})
+
+# ==================== AI Functions AI 函数 ====================
 
 def print_ai_response(response_text, response_type='analysis'):
     """
@@ -326,15 +1128,268 @@ def get_api_key(custom_api_key=''):
     
     Returns:
         str: API key to use 要使用的API密钥
+    
+    Raises:
+        CredentialError: The key is known to be invalid or out of quota 密钥已知无效或配额耗尽
     """
     if custom_api_key:
-        print(f'Using custom API key (ending with: ...{custom_api_key[-4:]})')
+        credential_store.check(custom_api_key)
+        print(f'Using custom API key (fingerprint: {key_fingerprint(custom_api_key)})')
         return custom_api_key
     else:
+        # The server key is not validated, only tracked 服务器密钥不做验证，只记录状态
+        credential_store.check(GOOGLE_API_KEY, validate=False)
         print('Using default API key from environment')
         return GOOGLE_API_KEY
 
-def analyze_with_ai(content, custom_api_key=''):
+def validate_api_key(api_key):
+    """
+    Cheap upstream call used to validate a custom key (model metadata lookup)
+    用于验证自定义密钥的低成本上游调用（查询模型元数据）
+    
+    Uses its own client so the global genai configuration is not touched.
+    使用独立客户端，不影响全局genai配置。
+    """
+    client = glm.ModelServiceClient(client_options={'api_key': api_key})
+    client.get_model(name='models/gemini-2.0-flash', timeout=10)
+
+def current_session_id():
+    """
+    Session id of the current request, used for fair scheduling
+    当前请求的会话ID，用于公平调度
+    
+    Returns:
+        str: X-Session-Id header, else remote address (empty outside a request)
+             X-Session-Id 请求头，否则为远程地址（请求上下文之外为空）
+    """
+    if not has_request_context():
+        return ''
+    return request.headers.get('X-Session-Id', '').strip()[:64] or (request.remote_addr or '')
+
+def current_user_id():
+    """
+    Long-lived learner id of the current request, used to persist history
+    当前请求的长期学习者ID，用于持久化历史
+    
+    Returns:
+        str: X-Learner-Id header ('' when absent or outside a request; nothing is persisted then)
+             X-Learner-Id 请求头（缺失或在请求上下文之外时为空，此时不做持久化）
+    """
+    if not has_request_context():
+        return ''
+    return request.headers.get('X-Learner-Id', '').strip()[:64]
+
+# Endpoint name for calls made outside a request (jobs, tutoring turns) 请求之外调用所属的接口名（任务、辅导轮次）
+_usage_scope = threading.local()
+
+@contextmanager
+def usage_scope(endpoint):
+    """
+    Attribute upstream calls made in this thread to an endpoint name
+    将本线程中的上游调用归属到某个接口名
+    """
+    previous = getattr(_usage_scope, 'endpoint', None)
+    _usage_scope.endpoint = endpoint
+    try:
+        yield
+    finally:
+        _usage_scope.endpoint = previous
+
+def current_endpoint():
+    """
+    Endpoint the current upstream call is made for, for the usage ledger
+    当前上游调用所属的接口，用于用量账本
+    """
+    if has_request_context():
+        # Canary calls are accounted separately, e.g. /api/analyze@short-final 金丝雀调用单独统计
+        variant = g.get('experiment_variant', BASELINE)
+        return request.path if variant is BASELINE else f'{request.path}@{variant.name}'
+    return getattr(_usage_scope, 'endpoint', None) or 'internal'
+
+def current_variant():
+    """
+    Prompt variant of the current request: the canary variant for sessions
+    in the canary share, else BASELINE
+    当前请求的提示词变体：处于金丝雀比例内的会话使用金丝雀变体，否则为 BASELINE
+    """
+    if not canary_router.enabled or not has_request_context():
+        return BASELINE
+    if 'experiment_variant' not in g:
+        g.experiment_variant = canary_router.assign(current_session_id())
+    return g.experiment_variant
+
+def observe_variant(variant, kind, started, text):
+    """
+    Report a canaried call's latency and JSON/schema validity 上报金丝雀调用的延迟及JSON/结构有效性
+    """
+    if canary_router.enabled:
+        json_ok, schema_ok = check_output(kind, text, clean_json_response)
+        canary_router.observe(variant.name, kind, time.monotonic() - started, json_ok, schema_ok)
+
+def output_config(endpoint, config=None, scale=1):
+    """
+    Cap output at the endpoint's budget unless the config already sets a cap
+    将输出限制在接口预算内，除非配置已设置上限
+    
+    Args:
+        endpoint: Key of OUTPUT_BUDGETS 输出预算的键
+        config: Base generation config 基础生成配置
+        scale: Multiplier, e.g. the number of answers judged in one call 倍数，如一次调用评估的回答数
+    
+    Returns:
+        dict: Generation config 生成配置
+    """
+    config = config or generation_config
+    budget = OUTPUT_BUDGETS.get(endpoint, 0)
+    if budget <= 0 or 'max_output_tokens' in config:
+        return config
+    return dict(config, max_output_tokens=budget * scale)
+
+def plan_call(model, lane, api_key, session_id, config=None):
+    """
+    Apply the daily budget to a call on the server key
+    对使用服务器密钥的调用应用每日预算
+    
+    Over the soft limit the call switches to ECONOMY_MODEL with capped
+    output; over the budget it also moves to the batch lane, so it waits
+    behind other traffic instead of failing.
+    超过软限制时切换到 ECONOMY_MODEL 并限制输出；超过预算时还会移到批处理通道，排在其他流量之后而不是失败。
+    
+    Returns:
+        tuple: (model, lane, generation config) (模型, 调度通道, 生成配置)
+    """
+    config = config or generation_config
+    if api_key != GOOGLE_API_KEY:
+        return model, lane, config
+    level = daily_budget.decide(api_key, session_id)
+    if level == BUDGET_NORMAL:
+        return model, lane, config
+    config = dict(config, max_output_tokens=min(config.get('max_output_tokens') or ECONOMY_MAX_OUTPUT_TOKENS,
+                                                ECONOMY_MAX_OUTPUT_TOKENS))
+    return model_for(ECONOMY_MODEL, api_key), LANE_BATCH if level == BUDGET_DEFERRED else lane, config
+
+def record_usage(response, model, contents, text, api_key, session_id, endpoint):
+    """
+    Add one upstream call to the usage ledger
+    将一次上游调用写入用量账本
+    
+    Token counts come from usage_metadata; when it is missing they are
+    estimated from text length (and a fixed count per image).
+    token数来自 usage_metadata；缺失时根据文本长度（及每张图片的固定数量）估算。
+    """
+    usage_ledger.record(api_key, session_id, endpoint, model.model_name, *usage_counts(response, contents, text))
+
+def response_text(response):
+    """
+    Text of a response, or '' if it has none (e.g. blocked) 响应文本；没有文本时（如被拦截）返回空字符串
+    """
+    try:
+        return response.text
+    except ValueError:
+        return ''
+
+def call_gemini(model, contents, lane, api_key, session_id=None, endpoint=None, config=None):
+    """
+    Call Gemini through the upstream scheduler
+    通过上游调度器调用Gemini
+    
+    Args:
+        model: GenerativeModel instance 模型实例
+        contents: Prompt or multimodal content parts 提示词或多模态内容
+        lane: Scheduler lane (LANE_INTERACTIVE / LANE_LESSON / LANE_BATCH) 调度通道
+        api_key: API key in use 使用的API密钥
+        session_id: Client session id, defaults to the current request's 客户端会话ID，默认取当前请求
+        endpoint: Endpoint for usage accounting, defaults to the current one 用于用量统计的接口，默认取当前接口
+        config: generation_config override (prompt variants) generation_config 覆盖（提示词变体）
+    
+    Returns:
+        Gemini response object Gemini响应对象
+    """
+    if session_id is None:
+        session_id = current_session_id()
+    if endpoint is None:
+        endpoint = current_endpoint()
+    model, lane, config = plan_call(model, lane, api_key, session_id, config)
+    with upstream_scheduler.slot(lane, api_key, session_id), credential_store.track(api_key):
+        response = model.generate_content(
+            contents,
+            generation_config=config
+        )
+    record_usage(response, model, contents, response_text(response), api_key, session_id, endpoint)
+    return response
+
+def call_gemini_hedged(endpoint, model, contents, lane, api_key, config=None):
+    """
+    Stream a Gemini call through the hedger and return its text
+    通过对冲器流式调用Gemini并返回文本
+    
+    Each attempt takes its own scheduler slot and reports its first streamed
+    chunk; a losing attempt stops reading its stream at the next chunk. For
+    endpoints in OUTPUT_SCHEMAS, reading also stops as soon as a schema-valid
+    JSON value has arrived, and only that value's text is returned.
+    每次尝试占用独立的调度槽位并报告首个流式块；落败的尝试在下一个块处停止读取。
+    对于 OUTPUT_SCHEMAS 中的接口，一旦收到通过结构校验的JSON值也会停止读取，并只返回该值的文本。
+    
+    Args:
+        endpoint: Endpoint name, see HEDGED_ENDPOINTS 接口名，见 HEDGED_ENDPOINTS
+        model: GenerativeModel instance 模型实例
+        contents: Prompt or multimodal content parts 提示词或多模态内容
+        lane: Scheduler lane 调度通道
+        api_key: API key in use 使用的API密钥
+        config: generation_config override (prompt variants) generation_config 覆盖（提示词变体）
+    
+    Returns:
+        str: Full response text 完整响应文本
+    """
+    # Captured here: attempts run outside the request context 在此捕获：尝试在请求上下文之外运行
+    session_id = current_session_id()
+    endpoint_path = current_endpoint()
+    config = output_config(endpoint, config)
+    validator = OUTPUT_SCHEMAS.get(endpoint)
+    
+    def attempt_call(attempt):
+        attempt_model, attempt_lane, attempt_config = plan_call(model, lane, api_key, session_id, config)
+        with upstream_scheduler.slot(attempt_lane, api_key, session_id), credential_store.track(api_key, ignore=HedgeCancelled):
+            attempt.check_cancelled()
+            # The first-token clock starts once the slot is granted 获得槽位后才开始计算首个token时间
+            attempt.mark_started()
+            # The winner cancels this call directly, even before its first chunk 胜出者直接取消此调用，即使首个块尚未到达
+            try:
+                response = open_stream(
+                    attempt_model,
+                    contents,
+                    generation_config=attempt_config,
+                    on_open=lambda call: attempt.on_cancel(lambda: cancel_call(call))
+                )
+            except Exception:
+                attempt.check_cancelled()
+                raise
+            parts = []
+            last_chunk = None
+            early = JsonEarlyStop(validator) if validator else None
+            try:
+                for chunk in response:
+                    last_chunk = chunk
+                    attempt.mark_first_token()
+                    attempt.check_cancelled()
+                    parts.append(chunk.text)
+                    # Don't pay for commentary after the JSON 不为JSON之后的评论付费
+                    if early is not None and early.feed(chunk.text):
+                        break
+            except Exception:
+                # A cancelled stream raises; report it as a lost race 被取消的流会抛出异常；按竞争落败处理
+                attempt.check_cancelled()
+                raise
+            finally:
+                # Early stop or lost race: end the upstream call, not just the loop 提前停止或竞争落败：结束上游调用，而不仅是循环
+                cancel_stream(response)
+                # The losing attempt is billed too 落败的尝试同样计费
+                record_usage(last_chunk, attempt_model, contents, ''.join(parts), api_key, session_id, endpoint_path)
+            return early.result() if early is not None else ''.join(parts)
+    
+    return hedger.call(endpoint, attempt_call)
+
+def analyze_with_ai(content, custom_api_key='', lane=LANE_LESSON):
     """
     Unified AI analysis function
     统一的 AI 分析函数
@@ -342,6 +1397,7 @@ def analyze_with_ai(content, custom_api_key=''):
     Args:
         content: User's explanation content 用户讲解的内容
         custom_api_key: Custom API key 自定义API密钥
+        lane: Scheduler lane 调度通道
     
     Returns:
         list: List of AI-generated comments AI 生成的评论列表
@@ -352,21 +1408,17 @@ def analyze_with_ai(content, custom_api_key=''):
         # Get API key to use 获取要使用的API密钥
         api_key = get_api_key(custom_api_key)
         
-        # Configure Gemini with the selected API key 使用选定的API密钥配置Gemini
-        genai.configure(api_key=api_key)
-        
-        # Use PROMPT_FINAL template 使用 PROMPT_FINAL 模板
-        prompt = PROMPT_FINAL.format(content=content)
+        # Use PROMPT_FINAL template (or the canary's) 使用 PROMPT_FINAL 模板（或金丝雀变体的模板）
+        variant = current_variant()
+        prompt = variant.prompt(KIND_ANALYZE, PROMPT_FINAL).format(content=content)
         
-        # Initialize Gemini model 初始化 Gemini 模型
-        model = genai.GenerativeModel('gemini-2.0-flash')
+        # Initialize Gemini model with a client for this key 使用该密钥的客户端初始化 Gemini 模型
+        model = model_for(variant.model_name(), api_key)
         
-        # Generate response 生成回复
-        response = model.generate_content(
-            prompt,
-            generation_config=generation_config
-        )
-        ai_response = response.text
+        # Generate response, streamed so it stops after the comment list 生成回复，流式读取以便在评论列表结束后停止
+        started = time.monotonic()
+        ai_response = call_gemini_hedged('analyze', model, prompt, lane, api_key, variant.config(generation_config))
+        observe_variant(variant, KIND_ANALYZE, started, ai_response)
         
         # Print AI raw response 打印AI原始响应
         print_ai_response(ai_response, 'analysis')
@@ -396,27 +1448,17 @@ def analyze_with_ai(content, custom_api_key=''):
             e.ai_response = ai_response  # Attach AI response to exception 附加AI响应到异常
         raise
 
-def respond_with_ai(user_response, original_question='', conversation_history=None, custom_api_key=''):
+def format_respond_history(conversation_history):
     """
-    Use Google Gemini to provide feedback on user's answer
-    使用 Google Gemini 对用户的回答进行反馈
+    Format a student-mode thread history for PROMPT_RESPOND
+    为 PROMPT_RESPOND 格式化学生模式的话题线程历史
     
     Args:
-        user_response: User's answer content 用户的回答内容
-        original_question: Original question previously asked by AI AI之前提出的原始问题
         conversation_history: List of previous Q&A exchanges 之前的问答交流列表
-        custom_api_key: Custom API key 自定义API密钥
     
     Returns:
-        dict: AI feedback object, containing understood, feedback, followUpQuestion
-              AI 的反馈对象，包含 understood, feedback, followUpQuestion
+        str: History section, empty if there is no history 历史段落；无历史时为空
     """
-    ai_response = None  # For error handling access 用于错误处理时访问
-    
-    if conversation_history is None:
-        conversation_history = []
-    
-    # Build conversation context if there's history 如果有历史记录，构建对话上下文
     context = ""
     if conversation_history:
         context = "\n\n## Previous Conversation History 之前的对话历史:\n"
@@ -424,10 +1466,31 @@ def respond_with_ai(user_response, original_question='', conversation_history=No
             context += f"\n**Round {i} 第{i}轮:**\n"
             context += f"AI Question AI问题: {exchange.get('question', '')}\n"
             context += f"Teacher Answer 老师回答: {exchange.get('answer', '')}\n"
+    return context
+
+def build_respond_prompt(user_response, original_question='', conversation_history=None, template=None):
+    """
+    Build the PROMPT_RESPOND prompt for a teacher's answer
+    为老师的回答构建 PROMPT_RESPOND 提示词
+    
+    Args:
+        user_response: User's answer content 用户的回答内容
+        original_question: Original question previously asked by AI AI之前提出的原始问题
+        conversation_history: List of previous Q&A exchanges 之前的问答交流列表
+        template: Prompt template, PROMPT_RESPOND unless a variant overrides it 提示词模板，变体未覆盖时为 PROMPT_RESPOND
+    
+    Returns:
+        str: Prompt text 提示词文本
+    """
+    # Looked up at call time so reloaded templates apply 调用时再取模板，使重新加载的模板生效
+    template = template or PROMPT_RESPOND
+    
+    # Build conversation context if there's history 如果有历史记录，构建对话上下文
+    context = format_respond_history(conversation_history)
     
     # Build prompt with original question, user answer, and conversation history 使用原始问题、用户回答和对话历史构建提示词
     # If no original question, provide a more reasonable default value 如果没有原始问题，提供一个更合理的默认值
-    prompt = PROMPT_RESPOND.format(
+    prompt = template.format(
         previous_question=original_question if original_question else "之前讨论的概念或问题",
         teacher_answer=user_response
     )
@@ -436,60 +1499,172 @@ def respond_with_ai(user_response, original_question='', conversation_history=No
     if context:
         prompt = prompt + context
     
+    return prompt
+
+def parse_feedback_response(ai_response):
+    """
+    Parse a PROMPT_RESPOND reply, falling back to plain text
+    解析 PROMPT_RESPOND 的回复，失败时回退为纯文本
+    
+    Args:
+        ai_response: Raw text of AI response AI响应的原始文本
+    
+    Returns:
+        dict: Feedback with understood, feedback, followUpQuestion 包含 understood, feedback, followUpQuestion 的反馈
+    """
+    # Clean and parse JSON response 清理和解析JSON响应
+    cleaned_response = clean_json_response(ai_response)
+    
     try:
-        # Get API key to use 获取要使用的API密钥
-        api_key = get_api_key(custom_api_key)
-        
-        # Configure Gemini with the selected API key 使用选定的API密钥配置Gemini
-        genai.configure(api_key=api_key)
-        
-        # Initialize Gemini model 初始化 Gemini 模型
-        model = genai.GenerativeModel('gemini-2.0-flash')
-        
-        # Generate response 生成回复
-        response = model.generate_content(
-            prompt,
-            generation_config=generation_config
-        )
-        ai_response = response.text.strip()
+        feedback_data = json.loads(cleaned_response)
+        
+        # Validate required fields 验证必需字段
+        if 'understood' not in feedback_data or 'feedback' not in feedback_data:
+            raise ValueError('AI返回的反馈缺少必需字段')
+        
+        return feedback_data
+        
+    except json.JSONDecodeError as e:
+        # If JSON parsing fails, return text format fallback 如果JSON解析失败，返回文本格式的兜底方案
+        print(f'===== AI Feedback JSON Parse Failed AI反馈JSON解析失败 =====')
+        print(f'Raw Response 原始响应: {ai_response}')
+        print(f'Cleaned 清理后: {cleaned_response}')
+        print(f'Error 错误: {str(e)}')
+        print(f'===== Using Fallback 使用兜底方案 =====')
+        
+        # Fallback: assume fully understood, return text content 兜底方案：假设完全理解，返回文本内容
+        return {
+            'understood': True,
+            'feedback': ai_response,
+            'followUpQuestion': None
+        }
+
+def respond_with_ai(user_response, original_question='', conversation_history=None, custom_api_key=''):
+    """
+    Use Google Gemini to provide feedback on user's answer
+    使用 Google Gemini 对用户的回答进行反馈
+    
+    Args:
+        user_response: User's answer content 用户的回答内容
+        original_question: Original question previously asked by AI AI之前提出的原始问题
+        conversation_history: List of previous Q&A exchanges 之前的问答交流列表
+        custom_api_key: Custom API key 自定义API密钥
+    
+    Returns:
+        dict: AI feedback object, containing understood, feedback, followUpQuestion
+              AI 的反馈对象，包含 understood, feedback, followUpQuestion
+    """
+    ai_response = None  # For error handling access 用于错误处理时访问
+    
+    variant = current_variant()
+    prompt = build_respond_prompt(user_response, original_question, conversation_history,
+                                  variant.prompt(KIND_RESPOND, PROMPT_RESPOND))
+    
+    try:
+        # Get API key to use 获取要使用的API密钥
+        api_key = get_api_key(custom_api_key)
+        
+        # Initialize Gemini model with a client for this key 使用该密钥的客户端初始化 Gemini 模型
+        model = model_for(variant.model_name(), api_key)
+        
+        # Generate response 生成回复
+        started = time.monotonic()
+        ai_response = call_gemini_hedged('respond', model, prompt, LANE_INTERACTIVE, api_key,
+                                         variant.config(generation_config)).strip()
+        observe_variant(variant, KIND_RESPOND, started, ai_response)
         
         # Print AI feedback response 打印AI反馈响应
         print_ai_response(ai_response, 'feedback')
         
-        # Clean and parse JSON response 清理和解析JSON响应
-        cleaned_response = clean_json_response(ai_response)
+        return parse_feedback_response(ai_response)
+            
+    except Exception as e:
+        print(f'Google Gemini API调用失败: {e}')
+        if ai_response and not hasattr(e, 'ai_response'):
+            e.ai_response = ai_response  # Attach AI response to exception 附加AI响应到异常
+        raise
+
+def respond_batch_with_ai(threads, custom_api_key=''):
+    """
+    Use Google Gemini to judge several pending answers in one call
+    使用 Google Gemini 在一次调用中评估多个待处理回答
+    
+    The shared PROMPT_RESPOND instructions are sent once for all threads.
+    Threads are labelled by their position in the batch, not by client ids,
+    so missing or repeated ids cannot merge two answers into one judgement.
+    Threads missing from the reply (or an unparseable reply) fall back to
+    individual respond_with_ai calls, so every thread always gets feedback.
+    共享的 PROMPT_RESPOND 指令只为所有线程发送一次。线程按其在批次中的位置标记，而非客户端ID，
+    因此缺失或重复的ID不会把两个回答合并为一次评估。回复中缺失的线程（或无法解析的回复）
+    会回退为单独的 respond_with_ai 调用，因此每个线程都能得到反馈。
+    
+    Args:
+        threads: List of {response, originalQuestion, conversationHistory}
+                 线程列表 {response, originalQuestion, conversationHistory}
+        custom_api_key: Custom API key 自定义API密钥
+    
+    Returns:
+        list: Feedback dicts in thread order 按线程顺序的反馈字典列表
+    """
+    ai_response = None
+    
+    # Build one section per thread 为每个线程构建一个段落
+    sections = []
+    for i, thread in enumerate(threads, 1):
+        section = f"### Thread {i} (threadId: {i})\n\n"
+        section += f"The previous question was: {thread['originalQuestion'] or '之前讨论的概念或问题'}\n\n"
+        section += f"The teacher's current answer is: {thread['response']}"
+        section += format_respond_history(thread['conversationHistory'])
+        sections.append(section)
+    prompt = PROMPT_RESPOND_BATCH.format(threads='\n\n'.join(sections))
+    
+    results = {}
+    try:
+        # Get API key to use 获取要使用的API密钥
+        api_key = get_api_key(custom_api_key)
+        
+        # Initialize Gemini model with a client for this key 使用该密钥的客户端初始化 Gemini 模型
+        model = model_for('gemini-2.0-flash', api_key)
+        
+        # Generate response 生成回复
+        ai_response = call_gemini_hedged('respond-batch', model, prompt, LANE_INTERACTIVE, api_key,
+                                         output_config('respond', scale=len(threads))).strip()
+        
+        # Print AI feedback response 打印AI反馈响应
+        print_ai_response(ai_response, 'batch_feedback')
         
         try:
-            feedback_data = json.loads(cleaned_response)
-            
-            # Validate required fields 验证必需字段
-            if 'understood' not in feedback_data or 'feedback' not in feedback_data:
-                raise ValueError('AI返回的反馈缺少必需字段')
-            
-            return feedback_data
-            
+            parsed = json.loads(clean_json_response(ai_response))
+            if isinstance(parsed, list):
+                for item in parsed:
+                    if isinstance(item, dict) and 'understood' in item and 'feedback' in item:
+                        results[str(item.get('threadId', ''))] = item
         except json.JSONDecodeError as e:
-            # If JSON parsing fails, return text format fallback 如果JSON解析失败，返回文本格式的兜底方案
-            print(f'===== AI Feedback JSON Parse Failed AI反馈JSON解析失败 =====')
-            print(f'Raw Response 原始响应: {ai_response}')
-            print(f'Cleaned 清理后: {cleaned_response}')
+            print(f'===== AI Batch Feedback JSON Parse Failed AI批量反馈JSON解析失败 =====')
             print(f'Error 错误: {str(e)}')
-            print(f'===== Using Fallback 使用兜底方案 =====')
-            
-            # Fallback: assume fully understood, return text content 兜底方案：假设完全理解，返回文本内容
-            return {
-                'understood': True,
-                'feedback': ai_response,
-                'followUpQuestion': None
-            }
+            print(f'===== Falling Back To Single Calls 回退为单独调用 =====')
             
     except Exception as e:
         print(f'Google Gemini API调用失败: {e}')
         if ai_response and not hasattr(e, 'ai_response'):
             e.ai_response = ai_response  # Attach AI response to exception 附加AI响应到异常
         raise
+    
+    # Fill gaps with single calls 用单独调用填补缺失
+    feedback = []
+    for i, thread in enumerate(threads, 1):
+        result = results.get(str(i))
+        if result is None:
+            result = respond_with_ai(
+                thread['response'],
+                thread['originalQuestion'],
+                thread['conversationHistory'],
+                custom_api_key
+            )
+        feedback.append(result)
+    return feedback
 
-def teach_with_ai(topic, custom_api_key=''):
+def teach_with_ai(topic, custom_api_key='', lane=LANE_LESSON, use_cache=True):
     """
     Use Google Gemini to teach a topic
     使用 Google Gemini 教授一个主题
@@ -497,35 +1672,44 @@ def teach_with_ai(topic, custom_api_key=''):
     Args:
         topic: Topic to teach 要教授的主题
         custom_api_key: Custom API key 自定义API密钥
+        lane: Scheduler lane 调度通道
+        use_cache: False to generate a new lesson even if one is cached 为False时即使有缓存也生成新课程
     
     Returns:
         str: Teaching content 教学内容
     """
     ai_response = None
     
+    # Canary lessons are cached under their own version 金丝雀课程以其自身版本缓存
+    variant = current_variant()
+    version = variant.version(KIND_TEACH, PROMPT_TEACH)
+    
+    # Serve pre-generated lesson if available 如有预生成的课程则直接返回
+    cached = response_cache.get('teach', version, topic) if use_cache else None
+    if cached is not None:
+        print(f'Serving cached lesson for topic 使用缓存课程: {topic}')
+        return cached
+    
     try:
         # Get API key to use 获取要使用的API密钥
         api_key = get_api_key(custom_api_key)
         
-        # Configure Gemini with the selected API key 使用选定的API密钥配置Gemini
-        genai.configure(api_key=api_key)
+        # Use PROMPT_TEACH template (or the canary's) 使用 PROMPT_TEACH 模板（或金丝雀变体的模板）
+        prompt = variant.prompt(KIND_TEACH, PROMPT_TEACH).format(topic=topic)
         
-        # Use PROMPT_TEACH template 使用 PROMPT_TEACH 模板
-        prompt = PROMPT_TEACH.format(topic=topic)
-        
-        # Initialize Gemini model 初始化 Gemini 模型
-        model = genai.GenerativeModel('gemini-2.0-flash')
+        # Initialize Gemini model with a client for this key 使用该密钥的客户端初始化 Gemini 模型
+        model = model_for(variant.model_name(), api_key)
         
         # Generate response 生成回复
-        response = model.generate_content(
-            prompt,
-            generation_config=generation_config
-        )
+        started = time.monotonic()
+        response = call_gemini(model, prompt, lane, api_key, config=variant.config(generation_config))
         ai_response = response.text.strip()
+        observe_variant(variant, KIND_TEACH, started, ai_response)
         
         # Print AI teaching response 打印AI教学响应
         print_ai_response(ai_response, 'teaching')
         
+        response_cache.put('teach', version, topic, ai_response)
         return ai_response
             
     except Exception as e:
@@ -534,7 +1718,93 @@ def teach_with_ai(topic, custom_api_key=''):
             e.ai_response = ai_response
         raise
 
-def teach_with_ai_image(topic, image, custom_api_key=''):
+def teach_sectioned_with_ai(topic, custom_api_key='', section_count=6):
+    """
+    Teach a topic as an outline plus sections generated concurrently
+    以大纲加并发生成的分节方式教授一个主题
+    
+    The outline is generated first; every section is then generated in
+    parallel (capped per API key) and yielded in order as soon as it and
+    all earlier sections are done.
+    先生成大纲；然后并行生成各节（按API密钥限制并发），每节在其自身及之前各节完成后立即按顺序产出。
+    
+    Args:
+        topic: Topic to teach 要教授的主题
+        custom_api_key: Custom API key 自定义API密钥
+        section_count: Number of sections to plan 计划的节数
+    
+    Yields:
+        dict: 'outline', then one 'section' per section, then 'done'
+              先产出 'outline'，然后每节一个 'section'，最后 'done'
+    """
+    ai_response = None
+    
+    try:
+        # Get API key to use 获取要使用的API密钥
+        api_key = get_api_key(custom_api_key)
+        
+        # Initialize Gemini model with a client for this key 使用该密钥的客户端初始化 Gemini 模型
+        model = model_for('gemini-2.0-flash', api_key)
+        
+        # Generate outline 生成大纲
+        prompt = PROMPT_TEACH_OUTLINE.format(topic=topic, section_count=section_count)
+        response = call_gemini(model, prompt, LANE_LESSON, api_key)
+        ai_response = response.text.strip()
+        print_ai_response(ai_response, 'teaching_outline')
+        
+        outline = json.loads(clean_json_response(ai_response))
+        if not isinstance(outline, list):
+            raise ValueError('AI返回的大纲格式不正确')
+        # Keep usable items only, and never more sections than planned 只保留可用的条目，且节数不超过计划
+        outline = [
+            {'title': str(item.get('title', '')).strip(), 'focus': str(item.get('focus', '')).strip()}
+            for item in outline if isinstance(item, dict) and str(item.get('title', '')).strip()
+        ][:section_count]
+        if not outline:
+            raise ValueError('AI返回的大纲格式不正确')
+        yield {'type': 'outline', 'topic': topic, 'sections': outline}
+        
+        outline_text = '\n'.join(
+            f"{i}. {item['title']} - {item['focus']}" for i, item in enumerate(outline, 1)
+        )
+        
+        # Captured here: section threads run outside the request context 在此捕获：分节线程在请求上下文之外运行
+        session_id = current_session_id()
+        endpoint = current_endpoint()
+        
+        def make_task(number, item):
+            def task():
+                prompt = PROMPT_TEACH_SECTION.format(
+                    topic=topic,
+                    outline=outline_text,
+                    section_number=number,
+                    section_count=len(outline),
+                    section_title=item['title'],
+                    section_focus=item['focus']
+                )
+                section_response = call_gemini(model, prompt, LANE_LESSON, api_key, session_id, endpoint)
+                return section_response.text.strip()
+            return task
+        
+        # Generate sections concurrently, stream in order 并发生成各节，按顺序流式输出
+        sections = []
+        tasks = [make_task(i, item) for i, item in enumerate(outline, 1)]
+        for i, content in enumerate(run_ordered(section_executor, tasks, limiter=section_limiter, api_key=api_key)):
+            sections.append(content)
+            yield {'type': 'section', 'index': i, 'title': outline[i]['title'], 'content': content}
+        
+        # Stitch lesson and index it for follow-up questions 拼接课程并为后续提问建立索引
+        lesson = '\n\n'.join(sections)
+        print_ai_response(lesson, 'sectioned_teaching')
+        yield {'type': 'done', 'content': lesson, 'lessonId': lesson_indexes.add(lesson)}
+            
+    except Exception as e:
+        print(f'Google Gemini API调用失败: {e}')
+        if ai_response and not hasattr(e, 'ai_response'):
+            e.ai_response = ai_response
+        raise
+
+def teach_with_ai_image(topic, image, custom_api_key='', lane=LANE_LESSON):
     """
     Use Google Gemini to teach based on an image
     使用 Google Gemini 基于图片进行教学
@@ -543,6 +1813,7 @@ def teach_with_ai_image(topic, image, custom_api_key=''):
         topic: Topic or question about the image 关于图片的主题或问题
         image: Image data dict {'data': base64, 'mimeType': '...'} 图片数据
         custom_api_key: Custom API key 自定义API密钥
+        lane: Scheduler lane 调度通道
     
     Returns:
         str: Teaching content 教学内容
@@ -553,25 +1824,11 @@ def teach_with_ai_image(topic, image, custom_api_key=''):
         # Get API key to use 获取要使用的API密钥
         api_key = get_api_key(custom_api_key)
         
-        # Configure Gemini with the selected API key 使用选定的API密钥配置Gemini
-        genai.configure(api_key=api_key)
-        
         # Build prompt 构建提示词
-        prompt_text = f"""You are an experienced and patient teacher. The student has uploaded an image and wants to learn about it.
-
-Student's request: {topic}
-
-Please analyze the image and provide a comprehensive explanation. Your explanation should:
-1. Describe what you see in the image
-2. Explain the key concepts or principles shown
-3. Provide relevant context and background information
-4. Use clear and simple language
-5. Make connections to real-world applications if applicable
-
-Provide your teaching content as plain text (NOT JSON). Write naturally and engagingly."""
+        prompt_text = PROMPT_TEACH_IMAGE.format(topic=topic)
         
-        # Initialize Gemini model 初始化 Gemini 模型
-        model = genai.GenerativeModel('gemini-2.0-flash')
+        # Initialize Gemini model with a client for this key 使用该密钥的客户端初始化 Gemini 模型
+        model = model_for('gemini-2.0-flash', api_key)
         
         # Build multimodal input 构建多模态输入
         content_parts = [
@@ -583,10 +1840,7 @@ Provide your teaching content as plain text (NOT JSON). Write naturally and enga
         ]
         
         # Generate response 生成回复
-        response = model.generate_content(
-            content_parts,
-            generation_config=generation_config
-        )
+        response = call_gemini(model, content_parts, lane, api_key)
         ai_response = response.text.strip()
         
         # Print AI teaching response 打印AI教学响应
@@ -600,24 +1854,118 @@ Provide your teaching content as plain text (NOT JSON). Write naturally and enga
             e.ai_response = ai_response
         raise
 
-def answer_question_with_ai(topic, question, teaching_context='', conversation_history=None, custom_api_key=''):
+def teach_document_with_ai(topic, pages, custom_api_key=''):
     """
-    Use Google Gemini to answer student's question
-    使用 Google Gemini 回答学生的问题
+    Teach a multi-page document: summarize every page, then compose one lesson
+    教授多页文档：先总结每一页，再组合成一篇课程
+    
+    Pages are extracted (or rasterized) in the document process pool and
+    summarized concurrently, with at most DOCUMENT_PAGE_WINDOW pages in
+    flight, so memory stays bounded for any document size. Page text is
+    indexed with the lesson for follow-up questions.
+    页面在文档进程池中提取（或栅格化）并并发总结，同时在途的页面最多为 DOCUMENT_PAGE_WINDOW 页，
+    因此无论文档多大内存都有上限。页面文本与课程一同建立索引，供后续提问使用。
+    
+    Args:
+        topic: Student's request about the document (optional) 学生对文档的要求（可选）
+        pages: (fn, args) page jobs from plan_pages() 由 plan_pages() 生成的页面任务
+        custom_api_key: Custom API key 自定义API密钥
+    
+    Yields:
+        dict: 'document', then one 'page' per page, then 'done'
+              先产出 'document'，然后每页一个 'page'，最后 'done'
+    """
+    ai_response = None
+    
+    try:
+        # Get API key to use 获取要使用的API密钥
+        api_key = get_api_key(custom_api_key)
+        
+        # Initialize Gemini model with a client for this key 使用该密钥的客户端初始化 Gemini 模型
+        model = model_for('gemini-2.0-flash', api_key)
+        
+        request_text = topic or 'Teach me the material in this document'
+        page_count = len(pages)
+        executor = document_executor(DOCUMENT_WORKERS)
+        yield {'type': 'document', 'pageCount': page_count}
+        
+        # Captured here: page threads run outside the request context 在此捕获：页面线程在请求上下文之外运行
+        session_id = current_session_id()
+        endpoint = current_endpoint()
+        
+        def make_task(fn, args):
+            def task():
+                page = executor.submit(fn, *args).result()
+                if page['image'] is not None:
+                    page_content = 'The page is attached as an image.'
+                    if page['text']:
+                        page_content += f"\n\n## Text Found on the Page:\n{page['text']}"
+                    contents = [PROMPT_DOCUMENT_PAGE.format(
+                        page_number=page['page'], page_count=page_count, topic=request_text, page_content=page_content
+                    ), page['image']]
+                else:
+                    contents = PROMPT_DOCUMENT_PAGE.format(
+                        page_number=page['page'], page_count=page_count, topic=request_text,
+                        page_content=f"## Page Text:\n{page['text']}"
+                    )
+                response = call_gemini(model, contents, LANE_LESSON, api_key, session_id, endpoint)
+                # Drop the page image; only text and summary are kept 丢弃页面图片；只保留文本和摘要
+                return {'page': page['page'], 'text': page['text'], 'truncated': page['truncated'],
+                        'summary': response.text.strip()}
+            return task
+        
+        # Summarize pages concurrently with a bounded window, in order 以有界窗口并发总结各页，按顺序输出
+        summaries = []
+        page_texts = []
+        tasks = (make_task(fn, args) for fn, args in pages)
+        for result in run_ordered(section_executor, tasks, window=DOCUMENT_PAGE_WINDOW,
+                                  limiter=section_limiter, api_key=api_key):
+            if result['summary'] and '(no teaching content)' not in result['summary']:
+                summaries.append(f"### Page {result['page']}\n{result['summary']}")
+            page_texts.append(f"[Page {result['page']}] {result['text'] or result['summary']}")
+            yield {'type': 'page', 'page': result['page'], 'pageCount': page_count, 'summary': result['summary'],
+                   'truncated': result['truncated']}
+        
+        # Compose one lesson from the page summaries 基于各页摘要组合成一篇课程
+        prompt = PROMPT_DOCUMENT_LESSON.format(
+            topic=request_text,
+            page_count=page_count,
+            page_summaries='\n\n'.join(summaries) or '(The document has no teaching content.)'
+        )
+        response = call_gemini(model, prompt, LANE_LESSON, api_key, session_id, endpoint)
+        ai_response = response.text.strip()
+        print_ai_response(ai_response, 'document_teaching')
+        
+        # Index lesson and pages for follow-up questions 为后续提问索引课程和页面
+        lesson_id = lesson_indexes.add(ai_response, extra_texts=page_texts)
+        yield {'type': 'done', 'content': ai_response, 'topic': topic or 'Document', 'lessonId': lesson_id,
+               'pageCount': page_count}
+            
+    except Exception as e:
+        print(f'Google Gemini API调用失败: {e}')
+        if ai_response and not hasattr(e, 'ai_response'):
+            e.ai_response = ai_response
+        raise
+
+def build_answer_prompt(topic, question, teaching_context='', conversation_history=None, lesson_id=''):
+    """
+    Build the PROMPT_ANSWER_QUESTION prompt for a student's question
+    为学生的问题构建 PROMPT_ANSWER_QUESTION 提示词
+    
+    Only the lesson passages most relevant to the question are included in
+    the prompt, so prompt size stays roughly constant for long lessons.
+    提示词中只包含与问题最相关的课程段落，因此长课程的提示词大小基本恒定。
     
     Args:
         topic: Current teaching topic 当前教学主题
         question: Student's question 学生的问题
         teaching_context: Previous teaching content 之前的教学内容
         conversation_history: Previous Q&A history 之前的问答历史
-        custom_api_key: Custom API key 自定义API密钥
+        lesson_id: Lesson index id returned by /api/teach 由/api/teach返回的课程索引ID
     
     Returns:
-        dict: Answer data containing answer, additionalContext, encouragement
-              答案数据，包含 answer, additionalContext, encouragement
+        str: Prompt text 提示词文本
     """
-    ai_response = None
-    
     if conversation_history is None:
         conversation_history = []
     
@@ -630,66 +1978,99 @@ def answer_question_with_ai(topic, question, teaching_context='', conversation_h
             context += f"Question 问题: {exchange.get('question', '')}\n"
             context += f"Answer 回答: {exchange.get('answer', '')}\n"
     
+    # Retrieve relevant lesson passages 检索相关课程段落
+    passages = lesson_indexes.retrieve(question, lesson_id, teaching_context, k=RETRIEVAL_TOP_K)
+    if passages:
+        teaching_context = '\n\n[...]\n\n'.join(passages)
+    
     # Build prompt 构建提示词
-    prompt = PROMPT_ANSWER_QUESTION.format(
+    return PROMPT_ANSWER_QUESTION.format(
         topic=topic,
         question=question,
         teaching_context=teaching_context if teaching_context else "Initial teaching session 初始教学",
         conversation_history=context if context else "No previous Q&A 没有之前的问答"
     )
+
+def parse_answer_response(ai_response):
+    """
+    Parse a PROMPT_ANSWER_QUESTION reply, falling back to plain text
+    解析 PROMPT_ANSWER_QUESTION 的回复，失败时回退为纯文本
+    
+    Args:
+        ai_response: Raw text of AI response AI响应的原始文本
+    
+    Returns:
+        dict: Answer data containing answer, additionalContext, encouragement
+              答案数据，包含 answer, additionalContext, encouragement
+    """
+    # Clean and parse JSON response 清理和解析JSON响应
+    cleaned_response = clean_json_response(ai_response)
+    
+    try:
+        answer_data = json.loads(cleaned_response)
+        
+        # Validate required fields 验证必需字段
+        if 'answer' not in answer_data:
+            raise ValueError('AI返回的答案缺少必需字段')
+        
+        # Set defaults for optional fields 为可选字段设置默认值
+        if 'additionalContext' not in answer_data:
+            answer_data['additionalContext'] = ''
+        if 'encouragement' not in answer_data:
+            answer_data['encouragement'] = 'Feel free to ask more questions! 随时提出更多问题！'
+        
+        return answer_data
+        
+    except json.JSONDecodeError as e:
+        # If JSON parsing fails, return text format fallback 如果JSON解析失败，返回文本格式的兜底方案
+        print(f'===== AI Answer JSON Parse Failed AI答案JSON解析失败 =====')
+        print(f'Raw Response 原始响应: {ai_response}')
+        print(f'Cleaned 清理后: {cleaned_response}')
+        print(f'Error 错误: {str(e)}')
+        print(f'===== Using Fallback 使用兜底方案 =====')
+        
+        # Fallback: return text content 兜底方案：返回文本内容
+        return {
+            'answer': ai_response,
+            'additionalContext': '',
+            'encouragement': 'Feel free to ask more questions! 随时提出更多问题！'
+        }
+
+def answer_question_with_ai(topic, question, teaching_context='', conversation_history=None, custom_api_key='', lesson_id=''):
+    """
+    Use Google Gemini to answer student's question
+    使用 Google Gemini 回答学生的问题
+    
+    Args:
+        topic: Current teaching topic 当前教学主题
+        question: Student's question 学生的问题
+        teaching_context: Previous teaching content 之前的教学内容
+        conversation_history: Previous Q&A history 之前的问答历史
+        custom_api_key: Custom API key 自定义API密钥
+        lesson_id: Lesson index id returned by /api/teach 由/api/teach返回的课程索引ID
+    
+    Returns:
+        dict: Answer data containing answer, additionalContext, encouragement
+              答案数据，包含 answer, additionalContext, encouragement
+    """
+    ai_response = None
+    
+    prompt = build_answer_prompt(topic, question, teaching_context, conversation_history, lesson_id)
     
     try:
         # Get API key to use 获取要使用的API密钥
         api_key = get_api_key(custom_api_key)
         
-        # Configure Gemini with the selected API key 使用选定的API密钥配置Gemini
-        genai.configure(api_key=api_key)
-        
-        # Initialize Gemini model 初始化 Gemini 模型
-        model = genai.GenerativeModel('gemini-2.0-flash')
+        # Initialize Gemini model with a client for this key 使用该密钥的客户端初始化 Gemini 模型
+        model = model_for('gemini-2.0-flash', api_key)
         
         # Generate response 生成回复
-        response = model.generate_content(
-            prompt,
-            generation_config=generation_config
-        )
-        ai_response = response.text.strip()
+        ai_response = call_gemini_hedged('answer', model, prompt, LANE_INTERACTIVE, api_key).strip()
         
         # Print AI answer response 打印AI回答响应
         print_ai_response(ai_response, 'answer')
         
-        # Clean and parse JSON response 清理和解析JSON响应
-        cleaned_response = clean_json_response(ai_response)
-        
-        try:
-            answer_data = json.loads(cleaned_response)
-            
-            # Validate required fields 验证必需字段
-            if 'answer' not in answer_data:
-                raise ValueError('AI返回的答案缺少必需字段')
-            
-            # Set defaults for optional fields 为可选字段设置默认值
-            if 'additionalContext' not in answer_data:
-                answer_data['additionalContext'] = ''
-            if 'encouragement' not in answer_data:
-                answer_data['encouragement'] = 'Feel free to ask more questions! 随时提出更多问题！'
-            
-            return answer_data
-            
-        except json.JSONDecodeError as e:
-            # If JSON parsing fails, return text format fallback 如果JSON解析失败，返回文本格式的兜底方案
-            print(f'===== AI Answer JSON Parse Failed AI答案JSON解析失败 =====')
-            print(f'Raw Response 原始响应: {ai_response}')
-            print(f'Cleaned 清理后: {cleaned_response}')
-            print(f'Error 错误: {str(e)}')
-            print(f'===== Using Fallback 使用兜底方案 =====')
-            
-            # Fallback: return text content 兜底方案：返回文本内容
-            return {
-                'answer': ai_response,
-                'additionalContext': '',
-                'encouragement': 'Feel free to ask more questions! 随时提出更多问题！'
-            }
+        return parse_answer_response(ai_response)
             
     except Exception as e:
         print(f'Google Gemini API调用失败: {e}')
@@ -697,11 +2078,500 @@ def answer_question_with_ai(topic, question, teaching_context='', conversation_h
             e.ai_response = ai_response
         raise
 
+# ==================== Tutoring Channel 辅导通道 ====================
+
+def print_tutor_error(e):
+    """
+    Log an error raised inside a WebSocket tutoring turn
+    记录WebSocket辅导轮次中抛出的错误
+    """
+    import traceback
+    print(f'===== Tutoring Channel Error 辅导通道错误 =====')
+    print(f'Error Type 错误类型: {type(e).__name__}')
+    print(f'Error Message 错误信息: {str(e)}')
+    traceback.print_exception(type(e), e, e.__traceback__)
+    
+    if hasattr(e, 'ai_response'):
+        print(f'===== AI Raw Output AI原始输出 =====')
+        print(e.ai_response)
+    
+    print(f'=====================')
+
+def stream_gemini(model, contents, lane, api_key, session_id, turn, config=None):
+    """
+    Stream Gemini output chunk by chunk, stopping when the turn is cancelled
+    逐块流式输出Gemini结果，轮次被取消时停止
+    
+    When the turn is cancelled or the caller closes the generator, the
+    upstream call is cancelled too, so the model stops generating tokens.
+    轮次被取消或调用方关闭生成器时，上游调用也会被取消，因此模型不再生成token。
+    
+    Args:
+        model: GenerativeModel instance 模型实例
+        contents: Prompt or multimodal content parts 提示词或多模态内容
+        lane: Scheduler lane 调度通道
+        api_key: API key in use 使用的API密钥
+        session_id: Client session id 客户端会话ID
+        turn: Tutoring turn, for cancellation 辅导轮次，用于取消
+        config: Generation config override 生成配置覆盖
+    
+    Yields:
+        str: Text chunks 文本块
+    """
+    model, lane, config = plan_call(model, lane, api_key, session_id, config)
+    with upstream_scheduler.slot(lane, api_key, session_id), credential_store.track(api_key, ignore=TurnCancelled):
+        turn.check_cancelled()
+        response = model.generate_content(
+            contents,
+            generation_config=config,
+            stream=True
+        )
+        parts = []
+        last_chunk = None
+        try:
+            for chunk in response:
+                last_chunk = chunk
+                turn.check_cancelled()
+                parts.append(chunk.text)
+                yield chunk.text
+        finally:
+            cancel_stream(response)
+            record_usage(last_chunk, model, contents, ''.join(parts), api_key, session_id, f'ws:{turn.kind}')
+
+def stream_gemini_json(model, contents, lane, api_key, session_id, turn, endpoint):
+    """
+    Stream a structured reply and stop once its JSON value is complete
+    流式读取结构化回复，JSON值完整后即停止
+    
+    Args:
+        endpoint: Key of OUTPUT_SCHEMAS and OUTPUT_BUDGETS 输出结构和输出预算的键
+    
+    Returns:
+        str: The JSON value's text, or the whole reply if none was valid JSON值的文本；没有有效值时为整个回复
+    """
+    early = JsonEarlyStop(OUTPUT_SCHEMAS.get(endpoint))
+    stream = stream_gemini(model, contents, lane, api_key, session_id, turn, output_config(endpoint))
+    try:
+        for text in stream:
+            if early.feed(text):
+                break
+    finally:
+        # Closing the generator cancels the upstream call and records usage 关闭生成器会取消上游调用并记录用量
+        stream.close()
+    return early.result()
+
+def tutor_model(session):
+    """
+    Configure Gemini for a tutoring session and return (model, api_key)
+    为辅导会话配置Gemini并返回 (model, api_key)
+    """
+    api_key = get_api_key(session.api_key)
+    return model_for('gemini-2.0-flash', api_key), api_key
+
+def tutor_teach(session, message, turn):
+    """
+    Teacher mode: stream a lesson token by token
+    教师模式：逐token流式输出课程
+    """
+    topic = str(message.get('topic', '')).strip()
+    if not topic:
+        raise ValueError('教学主题不能为空')
+    
+    model, api_key = tutor_model(session)
+    parts = []
+    for text in stream_gemini(model, PROMPT_TEACH.format(topic=topic), LANE_LESSON, api_key, session.session_id, turn):
+        parts.append(text)
+        session.send_token(turn, text)
+    lesson = ''.join(parts).strip()
+    print_ai_response(lesson, 'teaching')
+    
+    # Keep the lesson server-side for follow-up questions 在服务端保存课程以供后续提问
+    session.topic = topic
+    session.lesson = lesson
+    session.lesson_id = lesson_indexes.add(lesson)
+    session.history = []
+    history_store.record_lesson(session.user_id, session.session_id, session.lesson_id, topic, lesson,
+                                prompt_version=prompt_version(PROMPT_TEACH))
+    return {'topic': topic, 'content': lesson, 'lessonId': session.lesson_id}
+
+def tutor_ask(session, message, turn):
+    """
+    Teacher mode: answer a question about the session's lesson
+    教师模式：回答关于会话课程的问题
+    """
+    question = str(message.get('question', '')).strip()
+    if not question:
+        raise ValueError('问题不能为空')
+    if not session.topic:
+        raise ValueError('教学主题不能为空')
+    
+    prompt = build_answer_prompt(session.topic, question, session.lesson, session.history, session.lesson_id)
+    model, api_key = tutor_model(session)
+    ai_response = stream_gemini_json(model, prompt, LANE_INTERACTIVE, api_key, session.session_id, turn, 'answer').strip()
+    print_ai_response(ai_response, 'answer')
+    
+    answer_data = parse_answer_response(ai_response)
+    session.history.append({'question': question, 'answer': answer_data.get('answer', '')})
+    history_store.record_turn(session.user_id, session.session_id, 'answer', question, answer_data,
+                              lesson_id=session.lesson_id)
+    return answer_data
+
+def tutor_analyze(session, message, turn):
+    """
+    Student mode: analyze an explanation
+    学生模式：分析讲解内容
+    """
+    content = str(message.get('content', '')).strip()
+    if not content:
+        raise ValueError('内容不能为空')
+    
+    model, api_key = tutor_model(session)
+    prompt = PROMPT_FINAL.format(content=content)
+    ai_response = stream_gemini_json(model, prompt, LANE_LESSON, api_key, session.session_id, turn, 'analyze')
+    print_ai_response(ai_response, 'analysis')
+    
+    try:
+        comments = json.loads(clean_json_response(ai_response))
+    except json.JSONDecodeError as e:
+        error = ValueError(f'AI返回的响应不是有效的JSON格式: {str(e)}')
+        error.ai_response = ai_response  # Attach AI response 附加AI响应
+        raise error
+    history_store.record_analysis(session.user_id, session.session_id, content, comments)
+    return {'comments': comments}
+
+def tutor_respond(session, message, turn):
+    """
+    Student mode: feedback on an answer, keeping per-thread history server-side
+    学生模式：对回答给出反馈，在服务端按话题线程保存历史
+    """
+    thread_id = str(message.get('threadId', ''))
+    answer = str(message.get('response', '')).strip()
+    question = str(message.get('originalQuestion', ''))
+    if not answer:
+        raise ValueError('回答内容不能为空')
+    
+    if thread_id not in session.threads:
+        # A reconnected client re-sends the thread so far 重连的客户端会重新发送已有的线程
+        session.threads[thread_id] = [
+            {'question': str(h.get('question', '')), 'answer': str(h.get('answer', ''))}
+            for h in (message.get('conversationHistory') or []) if isinstance(h, dict)
+        ]
+    history = session.threads[thread_id]
+    prompt = build_respond_prompt(answer, question, history)
+    model, api_key = tutor_model(session)
+    ai_response = stream_gemini_json(model, prompt, LANE_INTERACTIVE, api_key, session.session_id, turn, 'respond').strip()
+    print_ai_response(ai_response, 'feedback')
+    
+    feedback_data = parse_feedback_response(ai_response)
+    history.append({'question': question, 'answer': answer})
+    reply = {
+        'threadId': thread_id,
+        'understood': feedback_data.get('understood', True),
+        'feedback': feedback_data.get('feedback', ''),
+        'followUpQuestion': feedback_data.get('followUpQuestion', None)
+    }
+    history_store.record_turn(session.user_id, session.session_id, 'respond', answer,
+                              dict(reply, originalQuestion=question), thread_id=thread_id)
+    return reply
+
+# Message type -> turn handler 消息类型 -> 轮次处理函数
+TUTOR_HANDLERS = {
+    'teach': tutor_teach,
+    'ask': tutor_ask,
+    'analyze': tutor_analyze,
+    'respond': tutor_respond,
+}
+
+# Session mode -> message types it may send; the first mode is the default
+# 会话模式 -> 可发送的消息类型；第一个模式为默认模式
+TUTOR_MODES = {
+    'teacher': ('teach', 'ask'),
+    'student': ('analyze', 'respond'),
+}
+
+# ==================== Background Jobs 后台任务 ====================
+
+def wants_async(data):
+    """
+    Whether the client asked for the "submit job" variant of a route
+    客户端是否请求了路由的"提交任务"版本
+    """
+    return request.args.get('async') == '1' or data.get('async') is True
+
+def submit_job(kind, payload, custom_api_key, data):
+    """
+    Queue a background job and answer 202 with its URLs
+    将后台任务加入队列，并以202返回其URL
+    
+    A custom API key is kept in this process's memory until the job is
+    collected and handed to the worker over its broker pipe; it is never
+    written to the jobs table. Idempotency keys are scoped to the learner
+    (or session) and API key, so one client cannot reach another's job.
+    自定义API密钥保存在本进程内存中直到任务被收集，并通过代理管道交给工作进程；它从不写入任务表。
+    幂等键按学习者（或会话）和API密钥划分作用域，因此一个客户端无法获取另一个客户端的任务。
+    
+    Args:
+        kind: Job kind, a key of JOB_HANDLERS 任务类型
+        payload: Job arguments 任务参数
+        custom_api_key: Custom API key 自定义API密钥
+        data: Request JSON, for the idempotency key 请求JSON，用于获取幂等键
+    """
+    if job_pool is None:
+        # Nothing would ever run it 没有任何进程会运行它
+        return jsonify({
+            'error': '后台任务不可用',
+            'message': 'No job workers run in this server process; call without async or start it with start_runtime()'
+        }), 503
+    idempotency_key = request.headers.get('Idempotency-Key', '').strip() or str(data.get('idempotencyKey', '')).strip()
+    if idempotency_key:
+        scope = '\0'.join([current_user_id() or current_session_id(),
+                           key_fingerprint(custom_api_key or GOOGLE_API_KEY or ''), idempotency_key])
+        idempotency_key = f"{kind}:{hashlib.sha256(scope.encode('utf-8')).hexdigest()}"
+    job, created = job_store.submit(
+        kind,
+        dict(payload, customKey=bool(custom_api_key)),
+        idempotency_key or None,
+        current_session_id()
+    )
+    if created and custom_api_key:
+        job_api_keys[job['jobId']] = custom_api_key
+    # Only the socket that issued this token is notified 只通知签发该令牌的连接
+    push_token = request.headers.get('X-Push-Token', '').strip()
+    if created and tutor_sessions.has(push_token):
+        job_push_tokens[job['jobId']] = push_token
+    return jsonify({
+        'success': True,
+        'jobId': job['jobId'],
+        'status': job['status'],
+        'pollUrl': f"/api/jobs/{job['jobId']}",
+        'streamUrl': f"/api/jobs/{job['jobId']}/stream"
+    }), 202 if created else 200
+
+def job_api_key(job_id, custom):
+    """
+    Broker: API key for a job; custom keys are kept in memory, never in the jobs table
+    代理：任务使用的API密钥；自定义密钥只保存在内存中，从不写入任务表
+    """
+    custom_api_key = job_api_keys.get(job_id, '')
+    if custom and not custom_api_key:
+        raise ValueError('The API key of this job was lost in a server restart; submit the job again '
+                         '任务的API密钥因服务重启而丢失，请重新提交')
+    return get_api_key(custom_api_key)
+
+def plan_job_call(kind, model_name, lane, api_key, session_id):
+    """
+    Broker: (model name, lane, generation config) for a job's upstream call
+    代理：任务上游调用的 (模型名, 调度通道, 生成配置)
+    """
+    model, lane, config = plan_call(genai.GenerativeModel(model_name), lane, api_key, session_id, output_config(kind))
+    return model.model_name, lane, config
+
+def record_job_usage(api_key, session_id, endpoint, model_name, counts):
+    """
+    Broker: add a worker's upstream call to the usage ledger 代理：将工作进程的上游调用写入用量账本
+    """
+    usage_ledger.record(api_key, session_id, endpoint, model_name, *counts)
+
+# Functions job workers call in this process, see job_worker.py 任务工作进程在本进程中调用的函数，见 job_worker.py
+JOB_BROKER = {
+    'api_key': job_api_key,
+    'plan': plan_job_call,
+    'usage': record_job_usage,
+    'cached_lesson': lambda version, topic: response_cache.get('teach', version, topic),
+}
+
+def collect_job(job):
+    """
+    Web-side completion of a finished job: forget its API key, and index
+    and cache a generated lesson so its lessonId works for /api/answer
+    已完成任务的Web端收尾：遗忘其API密钥，并为生成的课程建立索引和缓存，使其 lessonId 可用于 /api/answer
+    
+    Returns:
+        dict: The job, with lessonId added to lesson results 任务；课程结果会补充 lessonId
+    """
+    if job is None or job['status'] not in (STATUS_DONE, STATUS_FAILED):
+        return job
+    job_api_keys.pop(job['jobId'], None)
+    result = job.get('result')
+    if job['status'] != STATUS_DONE or not isinstance(result, dict) or not result.get('content') or 'lessonId' in result:
+        return job
+    result = dict(result, lessonId=lesson_indexes.add(result['content']))
+    version = result.pop('promptVersion', None)
+    if version:
+        response_cache.put('teach', version, result['topic'], result['content'])
+    job_store.set_result(job['jobId'], result)
+    return dict(job, result=result)
+
+def start_background_jobs():
+    """
+    Start job worker processes and a watcher that keeps them alive and
+    pushes finished jobs to connected tutoring sessions
+    启动任务工作进程，以及一个保持其存活并将完成的任务推送给已连接辅导会话的监视线程
+    """
+    # Workers import job_worker, not this module; their upstream calls go through upstream_scheduler
+    # 工作进程导入 job_worker 而不是本模块；其上游调用经由 upstream_scheduler
+    pool = JobWorkerPool(job_store, JOB_WORKERS, 'job_worker', 'JOB_HANDLERS',
+                         scheduler=upstream_scheduler, functions=JOB_BROKER).start()
+    print(f'Started {JOB_WORKERS} job workers 已启动{JOB_WORKERS}个任务工作进程')
+    
+    def watch():
+        since = time.time()
+        while True:
+            time.sleep(1)
+            pool.ensure_alive()
+            for job_id, kind, status, session_id, updated_at in job_store.finished_since(since):
+                since = max(since, updated_at)
+                collect_job(job_store.get(job_id))
+                push_token = job_push_tokens.pop(job_id, None)
+                if push_token:
+                    tutor_sessions.push(push_token, {
+                        'event': 'job',
+                        'jobId': job_id,
+                        'kind': kind,
+                        'status': status,
+                        'message': f'Background {kind} {status}'
+                    })
+    
+    threading.Thread(target=watch, name='job-watcher', daemon=True).start()
+    return pool
+
+# ==================== Lifecycle 生命周期 ====================
+
+def reload_prompt_templates():
+    """
+    Re-import the prompts package and return its templates by name
+    重新导入 prompts 包并按名称返回其模板
+    """
+    for name in sorted(name for name in sys.modules if name.startswith('prompts.')):
+        importlib.reload(sys.modules[name])
+    importlib.reload(prompts)
+    return {name: getattr(prompts, name) for name in prompts.__all__}
+
+def reload_runtime_config():
+    """
+    Re-read prompt templates and routing settings without a restart
+    无需重启即可重新读取提示词模板和路由设置
+    
+    Everything is loaded before anything is applied, so a broken template
+    or variants file leaves the running configuration untouched. Job
+    worker processes pick up changes when they restart.
+    先加载全部内容再统一应用，因此损坏的模板或变体文件不会影响正在运行的配置。
+    任务工作进程在重启时获取变更。
+    
+    Returns:
+        dict: Changed template names and the routing settings now in use 发生变化的模板名和当前路由设置
+    """
+    global ROUTING, RETRIEVAL_TOP_K, ECONOMY_MODEL, ECONOMY_MAX_OUTPUT_TOKENS, OUTPUT_BUDGETS, canary_router
+    load_dotenv(override=True)
+    settings = routing_settings()
+    canary = build_canary_router(settings)
+    templates = reload_prompt_templates()
+    
+    # Functions look templates up as module globals at call time 函数在调用时以模块全局变量查找模板
+    changed = sorted(name for name, template in templates.items() if globals().get(name) != template)
+    globals().update(templates)
+    CACHE_VERSIONS['teach'] = prompt_version(PROMPT_TEACH)
+    
+    RETRIEVAL_TOP_K = settings['retrieval_top_k']
+    upstream_scheduler.set_capacity(settings['upstream_concurrency'], settings['interactive_reserve'])
+    hedger.configure(settings['hedged_endpoints'], settings['hedge_percentile'], settings['hedge_budget_ratio'])
+    daily_budget.key_budget = settings['daily_budget_usd']
+    daily_budget.session_budget = settings['daily_session_budget_usd']
+    daily_budget.soft_ratio = settings['budget_soft_ratio']
+    ECONOMY_MODEL = settings['economy_model']
+    ECONOMY_MAX_OUTPUT_TOKENS = settings['economy_max_output_tokens']
+    OUTPUT_BUDGETS = settings['output_budgets']
+    canary_router = canary
+    ROUTING = settings
+    
+    print(f'Reloaded configuration 已重新加载配置: prompts changed {changed or "none"}')
+    return {'promptsChanged': changed, 'routing': settings}
+
+def begin_drain():
+    """
+    Turn not-ready, refuse new work and let tutoring sessions finish their turn
+    变为未就绪，拒绝新工作，并让辅导会话完成当前轮次
+    """
+    if lifecycle.begin_drain():
+        print(f'Draining 正在排空: {lifecycle.inflight} requests in flight, {tutor_sessions.busy()} tutoring turns')
+        tutor_sessions.drain()
+
+def shutdown(job_pool=None, stop=None):
+    """
+    SIGTERM: drain within DRAIN_TIMEOUT, flush stores, then stop the server
+    SIGTERM：在 DRAIN_TIMEOUT 内排空，写入存储，然后停止服务
+    
+    Args:
+        job_pool: Job workers to drain 需排空的任务工作进程池
+        stop: Stops the server; default interrupts the main thread (app.run) 停止服务；默认中断主线程（app.run）
+    """
+    begin_drain()
+    deadline = time.monotonic() + lifecycle.drain_timeout
+    jobs = None
+    if job_pool is not None:
+        # Workers finish their current job in parallel with the web tier 工作进程与Web层并行完成当前任务
+        jobs = threading.Thread(target=job_pool.drain, args=(lifecycle.drain_timeout,), daemon=True)
+        jobs.start()
+    idle = lifecycle.wait_idle(lifecycle.drain_timeout, busy=tutor_sessions.busy)
+    if jobs is not None:
+        jobs.join(max(deadline - time.monotonic(), 0) + 1)
+    print(f'Drained 排空完成: {"idle" if idle else f"deadline passed with {lifecycle.inflight} requests in flight"}')
+    usage_ledger.flush()
+    history_store.flush()
+    if stop is not None:
+        stop()
+        return
+    # Stop the server loop in the main thread 停止主线程中的服务循环
+    import _thread
+    _thread.interrupt_main()
+
+_runtime_lock = threading.Lock()
+_runtime_started = False
+
+def start_runtime(stop=None):
+    """
+    Start job workers and the SIGTERM/SIGHUP handlers, once per serving process
+    启动任务工作进程以及 SIGTERM/SIGHUP 处理器，每个服务进程一次
+    
+    Called by `python app.py` and by gunicorn's post_worker_init hook
+    (gunicorn.conf.py). Must run on the main thread.
+    由 `python app.py` 以及 gunicorn 的 post_worker_init 钩子（gunicorn.conf.py）调用。必须在主线程运行。
+    
+    Args:
+        stop: Stops the server after draining, see shutdown() 排空后停止服务，见 shutdown()
+    
+    Returns:
+        JobWorkerPool or None 任务工作进程池或None
+    """
+    global job_pool, _runtime_started
+    with _runtime_lock:
+        if _runtime_started:
+            return job_pool
+        _runtime_started = True
+        # Spawned workers must not re-run the server script 派生的工作进程不应重新执行服务脚本
+        detach_main_module()
+        if JOB_WORKERS > 0:
+            job_pool = start_background_jobs()
+        # SIGTERM drains in-flight work; SIGHUP reloads prompts and routing settings SIGTERM排空进行中的工作；SIGHUP重新加载提示词和路由设置
+        pool = job_pool
+        install_signal_handlers(lambda: shutdown(pool, stop), on_reload=reload_runtime_config)
+        return job_pool
+
+# Routes are registered and stores loaded: ready for traffic 路由已注册、存储已加载：可以接收流量
+lifecycle.mark_ready()
+
 # ==================== Start Service 启动服务 ====================
 
 if __name__ == '__main__':
     port = int(os.getenv('PORT', 10001))
     debug_mode = os.getenv('FLASK_ENV') == 'development'
     
+    # The debug reloader runs this block twice; start workers in the serving process only 调试重载器会执行两次；仅在服务进程中启动
+    if not debug_mode or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_runtime()
+    
     print(f'运行在 http://localhost:{port}')
-    app.run(host='127.0.0.1', port=port, debug=debug_mode)
+    try:
+        app.run(host='127.0.0.1', port=port, debug=debug_mode)
+    except KeyboardInterrupt:
+        pass
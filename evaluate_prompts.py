@@ -0,0 +1,110 @@
+"""
+Prompt Evaluator - compare prompt/config variants on a fixed corpus
+提示词评测工具 - 在固定语料上比较提示词/配置变体
+
+Runs explanations, answers and topics through the baseline prompts and
+each variant, and reports prompt/output tokens, latency, JSON parse
+failures and schema validity. Replay mode answers from recorded responses
+and needs no network; record mode calls Gemini for prompts not recorded
+yet and saves them, so later runs are offline.
+让讲解、回答和主题通过基线提示词与各变体，报告提示/输出token、延迟、JSON解析失败率和结构有效率。
+回放模式使用录制的响应，无需网络；录制模式对尚未录制的提示词调用Gemini并保存，使后续运行可离线进行。
+
+Usage 用法:
+    python evaluate_prompts.py --corpus eval/corpus.jsonl --variants eval/variants.json --mode record
+    python evaluate_prompts.py --corpus eval/corpus.jsonl --variants eval/variants.json --output report.json
+"""
+
+import argparse
+import json
+import os
+import sys
+
+import app
+from services.experiments import (
+    BASELINE, KIND_ANALYZE, KIND_RESPOND, KIND_TEACH,
+    GeminiBackend, ReplayBackend, load_corpus, load_variants, run_experiment, summarize
+)
+
+
+def build_prompt(variant, case):
+    """
+    Prompt a route would send for a case under a variant
+    在某变体下，路由为某用例发送的提示词
+    """
+    kind = case['kind']
+    if kind == KIND_ANALYZE:
+        return variant.prompt(KIND_ANALYZE, app.PROMPT_FINAL).format(content=case['content'])
+    if kind == KIND_RESPOND:
+        return app.build_respond_prompt(
+            case['response'], case.get('originalQuestion', ''), case.get('conversationHistory'),
+            variant.prompt(KIND_RESPOND, app.PROMPT_RESPOND)
+        )
+    return variant.prompt(KIND_TEACH, app.PROMPT_TEACH).format(topic=case['topic'])
+
+
+def format_value(value, suffix=''):
+    return '-' if value is None else f'{value}{suffix}'
+
+
+def print_report(report):
+    columns = ['variant', 'kind', 'done', 'miss', 'err', 'in tok', 'out tok', 'p50 ms', 'p95 ms', 'json fail', 'schema ok']
+    print(' | '.join(columns))
+    for variant, kinds in report.items():
+        for kind, m in sorted(kinds.items()):
+            print(' | '.join([
+                variant, kind, f"{m['completed']}/{m['cases']}", str(m['misses']), str(m['errors']),
+                format_value(m['promptTokens']), format_value(m['outputTokens']),
+                format_value(m['latencyP50Ms']), format_value(m['latencyP95Ms']),
+                format_value(m['jsonFailureRate']), format_value(m['schemaValidRate'])
+            ]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare prompt/config variants offline 离线比较提示词/配置变体')
+    parser.add_argument('--corpus', required=True, help='JSON-lines evaluation cases 评测用例（JSON行）')
+    parser.add_argument('--variants', help='JSON list of variants 变体列表（JSON）')
+    parser.add_argument('--recordings', default=os.path.join(app.DATA_DIR, 'eval_recordings.jsonl'),
+                        help='Recorded responses file 录制响应文件')
+    parser.add_argument('--mode', choices=['replay', 'record', 'live'], default='replay',
+                        help='replay: recordings only; record: call and save misses; live: always call '
+                             'replay仅回放；record调用并保存未命中；live始终调用')
+    parser.add_argument('--no-baseline', action='store_true', help='Skip the current prompts 跳过当前提示词')
+    parser.add_argument('--concurrency', type=int, default=4, help='Parallel calls 并行调用数')
+    parser.add_argument('--api-key', default='', help='API key, defaults to GOOGLE_API_KEY 默认使用 GOOGLE_API_KEY')
+    parser.add_argument('--output', help='Write per-case results and the summary as JSON 将逐例结果和汇总写为JSON')
+    args = parser.parse_args(argv)
+
+    cases = load_corpus(args.corpus)
+    variants = [] if args.no_baseline else [BASELINE]
+    if args.variants:
+        variants.extend(load_variants(args.variants))
+    if not variants:
+        parser.error('no variants to run: pass --variants or drop --no-baseline')
+
+    if args.mode == 'replay':
+        backend = ReplayBackend(args.recordings)
+    else:
+        api_key = args.api_key or app.GOOGLE_API_KEY
+        if not api_key:
+            parser.error(f'--mode {args.mode} needs --api-key or GOOGLE_API_KEY')
+        live = GeminiBackend(api_key)
+        backend = ReplayBackend(args.recordings, live=live) if args.mode == 'record' else live
+
+    print(f'Running {len(cases)} cases x {len(variants)} variants ({args.mode})')
+    results = run_experiment(cases, variants, backend, build_prompt, app.clean_json_response,
+                             app.generation_config, args.concurrency)
+    report = summarize(results)
+    print_report(report)
+    if isinstance(backend, ReplayBackend):
+        print(f'Recordings: {backend.hits} replayed, {backend.misses} missing')
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'summary': report, 'results': results}, f, ensure_ascii=False, indent=2)
+        print(f'Wrote {args.output}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,40 @@
+"""
+Gunicorn settings - serve app.py with job workers and graceful draining
+Gunicorn 配置 - 运行 app.py，并启用任务工作进程与优雅排空
+
+    gunicorn -c gunicorn.conf.py app:app
+
+One web worker with threads: queued jobs, custom job keys and tutoring
+sockets live in the web process's memory, so they must all be in one process.
+单个带线程的Web工作进程：排队的任务、任务自定义密钥和辅导连接都保存在Web进程内存中，因此必须位于同一进程。
+"""
+
+import os
+import signal
+
+bind = f"0.0.0.0:{os.getenv('PORT', 10001)}"
+workers = 1
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', 32))
+# Streamed lessons run long 流式课程耗时较长
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 300))
+# Longer than the app's own drain 长于应用自身的排空时间
+graceful_timeout = float(os.getenv('DRAIN_TIMEOUT', 30)) + 10
+
+
+def post_worker_init(worker):
+    """
+    Start job workers and the app's signal handlers in the serving process
+    在服务进程中启动任务工作进程和应用的信号处理器
+    """
+    from app import start_runtime
+
+    # After the app has drained, hand SIGTERM back to gunicorn's own graceful exit
+    # 应用排空后，将 SIGTERM 交还给 gunicorn 自身的优雅退出
+    gunicorn_term = signal.getsignal(signal.SIGTERM)
+
+    def stop():
+        signal.signal(signal.SIGTERM, gunicorn_term)
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    start_runtime(stop=stop)
@@ -0,0 +1,107 @@
+"""
+Job Worker - handlers run inside background job processes
+任务工作进程 - 在后台任务进程中运行的处理函数
+
+Worker processes import this module instead of app.py, so they skip the
+web tier's setup (stores, writer threads, cache loading, routes). Through
+the broker pipe each worker gets from the web process, upstream calls
+wait for a slot in the web tier's scheduler, and the API key, budget
+decision and usage accounting are handled there. Lessons are returned as
+text; the web process indexes and caches them when it collects the result.
+工作进程导入本模块而不是 app.py，因此跳过Web层的初始化（存储、写入线程、缓存加载、路由）。
+通过Web进程为每个工作进程建立的代理管道，上游调用在Web层调度器中等待槽位，API密钥、预算决策和用量统计
+也都在Web进程中处理。课程以文本返回；Web进程在收集结果时为其建立索引并写入缓存。
+"""
+
+import json
+
+from prompts import PROMPT_FINAL, PROMPT_TEACH, PROMPT_TEACH_IMAGE
+from services.response_cache import prompt_version
+from services.scheduler import LANE_BATCH
+from services.structured import JsonEarlyStop, cancel_stream, clean_json_response
+from services.experiments import validate_analysis
+from services.gemini import model_for
+from services.usage import usage_counts
+
+JOB_MODEL = 'gemini-2.0-flash'
+
+
+def generate(job, upstream, contents, validator=None):
+    """
+    One upstream call for a job, through the web tier's scheduler
+    为任务发起一次上游调用，经由Web层调度器
+
+    Args:
+        job: Claimed job 已领取的任务
+        upstream: UpstreamClient 代理客户端
+        contents: Prompt or multimodal content parts 提示词或多模态内容
+        validator: Schema check; the stream stops once a valid JSON value arrived 结构校验；收到有效JSON值后停止读取
+
+    Returns:
+        str: Response text 响应文本
+    """
+    session_id = job.get('sessionId', '')
+    api_key = upstream.call('api_key', job['jobId'], bool(job['payload'].get('customKey')))
+    model_name, lane, config = upstream.call('plan', job['kind'], JOB_MODEL, LANE_BATCH, api_key, session_id)
+    model = model_for(model_name, api_key)
+
+    with upstream.slot(lane, api_key, session_id):
+        response = model.generate_content(contents, generation_config=config, stream=True)
+        parts = []
+        last_chunk = None
+        early = JsonEarlyStop(validator) if validator else None
+        try:
+            for chunk in response:
+                last_chunk = chunk
+                parts.append(chunk.text)
+                if early is not None and early.feed(chunk.text):
+                    break
+        finally:
+            cancel_stream(response)
+            upstream.notify('usage', api_key, session_id, f"job:{job['kind']}", model.model_name,
+                            usage_counts(last_chunk, contents, ''.join(parts)))
+    return early.result() if early is not None else ''.join(parts)
+
+
+def job_analyze(job, upstream):
+    content = str(job['payload'].get('content', '')).strip()
+    if not content:
+        raise ValueError('内容不能为空')
+    ai_response = generate(job, upstream, PROMPT_FINAL.format(content=content), validate_analysis)
+    try:
+        return {'comments': json.loads(clean_json_response(ai_response))}
+    except json.JSONDecodeError as e:
+        raise ValueError(f'AI返回的响应不是有效的JSON格式: {str(e)}')
+
+
+def job_teach(job, upstream):
+    topic = str(job['payload'].get('topic', '')).strip()
+    if not topic:
+        raise ValueError('教学主题不能为空')
+    # Same cache key as /api/teach; the web process fills the cache on collection 与 /api/teach 相同的缓存键；Web进程在收集时写入缓存
+    version = prompt_version(PROMPT_TEACH)
+    content = None if job['payload'].get('regenerate') else upstream.call('cached_lesson', version, topic)
+    if content is None:
+        content = generate(job, upstream, PROMPT_TEACH.format(topic=topic)).strip()
+    return {'content': content, 'topic': topic, 'promptVersion': version}
+
+
+def job_teach_with_image(job, upstream):
+    image = job['payload'].get('image') or {}
+    if not image.get('data'):
+        raise ValueError('图片数据为空')
+    topic = str(job['payload'].get('topic', '')).strip()
+    contents = [
+        PROMPT_TEACH_IMAGE.format(topic=topic),
+        {'mime_type': image.get('mimeType', 'image/png'), 'data': image['data']}
+    ]
+    content = generate(job, upstream, contents).strip()
+    return {'content': content, 'topic': topic or 'Image Analysis'}
+
+
+# Job kind -> handler, run inside worker processes 任务类型 -> 处理函数，在工作进程中运行
+JOB_HANDLERS = {
+    'analyze': job_analyze,
+    'teach': job_teach,
+    'teach-with-image': job_teach_with_image,
+}
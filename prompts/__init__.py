@@ -7,7 +7,14 @@ Centralized management of all AI prompt templates
 """
 
 from .final_analysis_prompt import PROMPT_FINAL
-from .response_feedback_prompt import PROMPT_RESPOND
-from .teacher_mode_prompt import PROMPT_TEACH, PROMPT_ANSWER_QUESTION
+from .response_feedback_prompt import PROMPT_RESPOND, PROMPT_RESPOND_BATCH
+from .teacher_mode_prompt import (
+    PROMPT_TEACH, PROMPT_ANSWER_QUESTION, PROMPT_TEACH_OUTLINE, PROMPT_TEACH_SECTION,
+    PROMPT_TEACH_IMAGE, PROMPT_DOCUMENT_PAGE, PROMPT_DOCUMENT_LESSON
+)
 
-__all__ = ['PROMPT_FINAL', 'PROMPT_RESPOND', 'PROMPT_TEACH', 'PROMPT_ANSWER_QUESTION']
+__all__ = [
+    'PROMPT_FINAL', 'PROMPT_RESPOND', 'PROMPT_RESPOND_BATCH', 'PROMPT_TEACH', 'PROMPT_ANSWER_QUESTION',
+    'PROMPT_TEACH_OUTLINE', 'PROMPT_TEACH_SECTION', 'PROMPT_TEACH_IMAGE', 'PROMPT_DOCUMENT_PAGE',
+    'PROMPT_DOCUMENT_LESSON'
+]
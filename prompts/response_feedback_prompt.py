@@ -6,7 +6,7 @@ Used for providing Feynman-style feedback on user answers.
 
 """
 
-PROMPT_RESPOND = """
+_RESPOND_GUIDE = """
 
 ## Your Role and Current Context
 
@@ -76,7 +76,9 @@ Teacher's Answer (teacher_answer):
 }}
 ```
 
-### Output Format Specification
+"""
+
+PROMPT_RESPOND = _RESPOND_GUIDE + """### Output Format Specification
 
 You must output the analysis result in a strict JSON object format, without any text or markers outside the JSON. The format is as follows:
 
@@ -101,4 +103,26 @@ The previous question was: {previous_question}
 
 The teacher's current answer is: {teacher_answer}
 
-"""
\ No newline at end of file
+"""
+# Batched variant: several pending answers judged in one call 批量版本：一次调用评估多个待处理回答
+PROMPT_RESPOND_BATCH = _RESPOND_GUIDE + """### Output Format Specification
+
+This time the teacher has answered **several separate questions** you asked. Each one is an independent thread with its own history; judge every thread on its own, exactly as you would a single answer, and never mix information between threads.
+
+You must output a strict JSON array with exactly one object per thread, in the same order as the threads below, without any text or markers outside the JSON:
+
+```
+[
+  {{
+    "threadId": "The id of the thread, copied exactly",
+    "understood": true or false,
+    "feedback": "The text content of your feedback for this thread.",
+    "followUpQuestion": "Follow-up question for this thread, or null if 'understood' is true."
+  }}
+]
+```
+
+## Begin Your Work Now
+
+{threads}
+"""
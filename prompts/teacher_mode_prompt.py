@@ -54,3 +54,81 @@ Provide your response as a JSON object with the following structure:
 
 Your response must be valid JSON format. Be warm, patient, and thorough in your answer.
 """
+
+PROMPT_TEACH_OUTLINE = """
+You are an experienced teacher planning a detailed lesson for a student.
+
+**Topic:** {topic}
+
+Plan the lesson as {section_count} sections that build logically from basic to more complex. The first section should open with a hook and a clear definition; the last section should summarize and invite questions.
+
+Provide your outline as a JSON array, one object per section, in teaching order:
+[
+    {{
+        "title": "Short section title",
+        "focus": "One sentence describing what this section must cover"
+    }}
+]
+
+Your response must be valid JSON format.
+"""
+
+PROMPT_TEACH_SECTION = """
+You are an experienced, patient, and engaging teacher writing one section of a detailed lesson.
+
+**Topic:** {topic}
+
+## Full Lesson Outline:
+{outline}
+
+## Your Section (section {section_number} of {section_count}):
+**{section_title}** - {section_focus}
+
+Write ONLY this section. Do not repeat material that belongs to other sections of the outline, and do not add a greeting or closing unless this is the first or last section. Use concrete examples or analogies, and start with a Markdown heading (`## {section_title}`).
+
+Keep the section focused (around 150-250 words).
+
+Provide your teaching content as plain text (NOT JSON). Write naturally and engagingly.
+"""
+
+PROMPT_TEACH_IMAGE = """You are an experienced and patient teacher. The student has uploaded an image and wants to learn about it.
+
+Student's request: {topic}
+
+Please analyze the image and provide a comprehensive explanation. Your explanation should:
+1. Describe what you see in the image
+2. Explain the key concepts or principles shown
+3. Provide relevant context and background information
+4. Use clear and simple language
+5. Make connections to real-world applications if applicable
+
+Provide your teaching content as plain text (NOT JSON). Write naturally and engagingly."""
+
+PROMPT_DOCUMENT_PAGE = """
+You are an experienced teacher reading page {page_number} of {page_count} of a document a student uploaded (lecture slides, notes or a textbook chapter).
+
+**Student's request:** {topic}
+
+{page_content}
+
+Summarize what this page teaches in 3-6 concise bullet points. Keep key definitions, formulas, numbers and examples exactly as written. If the page has no teaching content (title page, blank page, references), reply with a single line: "(no teaching content)".
+
+Provide your summary as plain text (NOT JSON).
+"""
+
+PROMPT_DOCUMENT_LESSON = """
+You are an experienced, patient, and engaging teacher. A student uploaded a {page_count}-page document and asked you to teach it.
+
+**Student's request:** {topic}
+
+## Page-by-Page Summaries:
+{page_summaries}
+
+Write one coherent lesson that teaches the material of the whole document:
+1. Start with a brief overview of what the document covers
+2. Explain the key concepts in a logical order (not necessarily page order), with simple examples or analogies
+3. Mention page numbers (e.g. "see page 4") when pointing to details
+4. End with a short summary and invite the student to ask questions
+
+Provide your teaching content as plain text (NOT JSON). Write naturally and engagingly.
+"""
@@ -0,0 +1,17 @@
+"""
+Feynman Learning Assistant - Services Module
+费曼学习助手 - 服务模块
+
+Server-side building blocks shared by the Flask routes
+供Flask路由共享的服务端组件
+"""
+
+from .retrieval import LessonIndex, LessonIndexStore, lesson_indexes
+from .fanout import KeyedLimiter, RateLimiter, key_fingerprint, run_ordered, section_executor
+from .response_cache import ResponseCache, RequestLog, prompt_version, top_topics
+
+__all__ = [
+    'LessonIndex', 'LessonIndexStore', 'lesson_indexes',
+    'KeyedLimiter', 'RateLimiter', 'key_fingerprint', 'run_ordered', 'section_executor',
+    'ResponseCache', 'RequestLog', 'prompt_version', 'top_topics'
+]
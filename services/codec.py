@@ -0,0 +1,163 @@
+"""
+HTTP Codec - fast JSON, early body-size rejection and response compression
+HTTP编解码 - 快速JSON、提前拒绝超大请求体与响应压缩
+
+orjson is used for request parsing and jsonify when installed (standard
+json otherwise). Oversized requests are rejected from their Content-Length
+header before the body is read, and large JSON responses are gzip/brotli
+compressed according to Accept-Encoding.
+安装了 orjson 时用于请求解析和 jsonify（否则使用标准json）。超大请求在读取请求体之前
+即根据 Content-Length 请求头被拒绝，大型JSON响应根据 Accept-Encoding 进行gzip/brotli压缩。
+"""
+
+import gzip
+import json
+
+from flask import jsonify, request
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def dumps_text(obj):
+    """
+    Serialize to a JSON string with the fastest available codec
+    使用最快的可用编解码器序列化为JSON字符串
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+    return json.dumps(obj, ensure_ascii=False)
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """
+    Flask JSON provider backed by orjson, falling back to the default
+    基于 orjson 的 Flask JSON提供器，不可用时回退到默认实现
+    """
+
+    sort_keys = False
+
+    def dumps(self, obj, **kwargs):
+        # jsonify always passes separators (compact) or indent (debug) jsonify总会传入separators或indent
+        options = dict(kwargs)
+        options.pop('separators', None)
+        indent = options.pop('indent', None)
+        if orjson is None or options:
+            return super().dumps(obj, **kwargs)
+        option = orjson.OPT_NON_STR_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=option).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        # orjson.JSONDecodeError subclasses json.JSONDecodeError, so Flask still answers 400
+        # orjson.JSONDecodeError 是 json.JSONDecodeError 的子类，Flask仍返回400
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+
+def install_body_limits(app, limits, default_limit):
+    """
+    Reject requests whose declared size exceeds the endpoint's limit
+    拒绝声明大小超过接口限制的请求
+
+    The check runs before the body is read. Bodies without a Content-Length
+    (chunked uploads) are capped while being read: the app's request class
+    reports the endpoint's limit as request.max_content_length, which the
+    body stream and form parser enforce with a 413. MAX_CONTENT_LENGTH is
+    the largest limit, for paths outside /api/.
+    检查在读取请求体之前执行。没有 Content-Length 的请求体（分块上传）在读取时受限：应用的请求类
+    将接口的限制作为 request.max_content_length 返回，由请求体流和表单解析器以413强制执行。
+    MAX_CONTENT_LENGTH 为最大限制，用于 /api/ 以外的路径。
+
+    Args:
+        app: Flask app Flask应用
+        limits: {path: max bytes} for specific endpoints 指定接口的 {路径: 最大字节数}
+        default_limit: Max bytes for other /api/ endpoints 其他 /api/ 接口的最大字节数
+    """
+    app.config['MAX_CONTENT_LENGTH'] = max([default_limit, *limits.values()])
+
+    class LimitedRequest(app.request_class):
+        # Per-request override; Flask 3.0's property only reads the app config 按请求覆盖；Flask 3.0 的属性只读取应用配置
+        body_limit = None
+
+        @property
+        def max_content_length(self):
+            if self.body_limit is not None:
+                return self.body_limit
+            return super().max_content_length
+
+    app.request_class = LimitedRequest
+
+    @app.before_request
+    def reject_oversized_body():
+        if not request.path.startswith('/api/'):
+            return None
+        limit = limits.get(request.path, default_limit)
+        request.body_limit = limit
+        length = request.content_length
+        if length is not None and length > limit:
+            return jsonify({
+                'error': '请求内容过大',
+                'message': f'Request body is {length} bytes; the limit for {request.path} is {limit} bytes'
+            }), 413
+        return None
+
+    @app.errorhandler(413)
+    def body_too_large(e):
+        return jsonify({'error': '请求内容过大', 'message': str(e)}), 413
+
+
+def install_compression(app, min_size=1024, gzip_level=6, brotli_quality=5):
+    """
+    Compress JSON responses according to Accept-Encoding
+    根据 Accept-Encoding 压缩JSON响应
+
+    Brotli is preferred when the client accepts it and the brotli package is
+    installed; otherwise gzip. Streaming responses are left untouched.
+    客户端接受且安装了 brotli 时优先使用Brotli，否则使用gzip。流式响应不做处理。
+
+    Args:
+        app: Flask app Flask应用
+        min_size: Smallest body worth compressing, in bytes 值得压缩的最小字节数
+        gzip_level: gzip compression level gzip压缩级别
+        brotli_quality: Brotli quality Brotli压缩质量
+    """
+
+    @app.after_request
+    def compress_response(response):
+        if (response.mimetype != 'application/json'
+                or response.direct_passthrough
+                or response.is_streamed
+                or response.status_code < 200 or response.status_code >= 300
+                or 'Content-Encoding' in response.headers):
+            return response
+
+        body = response.get_data()
+        if len(body) < min_size:
+            return response
+
+        accepted = request.accept_encodings
+        if brotli is not None and accepted.quality('br') > 0:
+            body, encoding = brotli.compress(body, quality=brotli_quality), 'br'
+        elif accepted.quality('gzip') > 0:
+            body, encoding = gzip.compress(body, compresslevel=gzip_level), 'gzip'
+        else:
+            return response
+
+        response.set_data(body)
+        response.headers['Content-Encoding'] = encoding
+        response.headers['Content-Length'] = str(len(body))
+        response.vary.add('Accept-Encoding')
+        return response
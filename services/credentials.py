@@ -0,0 +1,279 @@
+"""
+Credentials - validate API keys once and remember their health
+凭据 - 只验证一次API密钥并记住其健康状态
+
+A custom key is checked with a cheap upstream call the first time it is
+seen. Its state (valid, invalid, exhausted) is cached per key fingerprint
+with a TTL, and failures of real calls update it, so a known-bad key is
+rejected before any prompt is built. Full keys are never stored or logged.
+自定义密钥首次出现时通过一次低成本的上游调用进行检查。其状态（有效、无效、配额耗尽）按密钥指纹
+缓存并带有TTL，实际调用的失败也会更新状态，因此已知无效的密钥会在构建提示词之前被拒绝。
+完整密钥永远不会被存储或记录。
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+from .fanout import key_fingerprint
+
+KEY_UNKNOWN = 'unknown'
+KEY_VALID = 'valid'
+KEY_INVALID = 'invalid'
+KEY_EXHAUSTED = 'exhausted'
+
+
+class CredentialError(Exception):
+    """
+    Raised for a key known to be invalid or out of quota
+    密钥已知无效或配额耗尽时抛出
+
+    Attributes:
+        state: KEY_INVALID or KEY_EXHAUSTED 密钥状态
+        status: HTTP status to answer with (401 / 429) 应返回的HTTP状态码
+        retry_after: Seconds until the key is worth retrying, or None 可重试前的秒数
+    """
+
+    def __init__(self, message, state, retry_after=None):
+        super().__init__(message)
+        self.state = state
+        self.status = 401 if state == KEY_INVALID else 429
+        self.retry_after = retry_after
+
+
+def classify_error(error):
+    """
+    Map an upstream exception to a key state
+    将上游异常映射为密钥状态
+
+    google.api_core exceptions carry an HTTP code; the message is checked as
+    well because an invalid key is reported as a 400 "API key not valid".
+    A 403 is not treated as invalid: it is also returned for model or region
+    access, which says nothing about the key.
+    google.api_core 异常带有HTTP状态码；同时检查错误信息，因为无效密钥会以400 "API key not valid" 报告。
+    403 不视为无效：模型或地区访问受限时也会返回403，这与密钥本身无关。
+
+    Returns:
+        str or None: KEY_INVALID, KEY_EXHAUSTED, or None if unrelated to the key
+                     KEY_INVALID、KEY_EXHAUSTED，与密钥无关时为None
+    """
+    code = getattr(error, 'code', None)
+    code = getattr(code, 'value', code)
+    message = str(error).lower()
+    if code == 429 or type(error).__name__ == 'ResourceExhausted':
+        return KEY_EXHAUSTED
+    if (code == 401 or type(error).__name__ == 'Unauthenticated'
+            or 'api key not valid' in message or 'api_key_invalid' in message):
+        return KEY_INVALID
+    return None
+
+
+class _KeyRecord:
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self.state = KEY_UNKNOWN
+        self.expires_at = 0.0
+        self.checked_at = None
+        self.last_error = None
+        self.requests = 0
+        self.failures = 0
+        self.last_used = None
+        self.lock = threading.Lock()  # One validation per key at a time 每个密钥同时只验证一次
+
+
+class CredentialStore:
+    """
+    Per-key validity, quota and exhaustion state with TTLs
+    带TTL的每密钥有效性、配额与耗尽状态
+
+    Args:
+        validator: fn(api_key) making a cheap upstream call; raises on failure
+                   执行低成本上游调用的函数；失败时抛出异常
+        valid_ttl: Seconds a validated key is trusted 已验证密钥的信任秒数
+        invalid_ttl: Seconds an invalid key is rejected without a check 无效密钥免检查拒绝的秒数
+        exhausted_ttl: Seconds an exhausted key is rejected 配额耗尽密钥被拒绝的秒数
+        unknown_ttl: Seconds a key whose check failed for other reasons (network) is
+                     not checked again 因其他原因（网络）检查失败的密钥在此秒数内不再检查
+        capacity: Max keys remembered 最多记住的密钥数
+    """
+
+    def __init__(self, validator, valid_ttl=3600, invalid_ttl=86400, exhausted_ttl=60, unknown_ttl=30,
+                 capacity=4096):
+        self.validator = validator
+        self.valid_ttl = valid_ttl
+        self.invalid_ttl = invalid_ttl
+        self.exhausted_ttl = exhausted_ttl
+        self.unknown_ttl = unknown_ttl
+        self.capacity = capacity
+        self._records = {}
+        self._trusted = set()
+        self._lock = threading.Lock()
+        self.validations = 0
+        self.rejections = 0
+
+    def _record(self, api_key):
+        fingerprint = key_fingerprint(api_key)
+        with self._lock:
+            record = self._records.get(fingerprint)
+            if record is None:
+                if len(self._records) >= self.capacity:
+                    # Forget the least recently used key 遗忘最久未使用的密钥
+                    oldest = min(self._records.values(), key=lambda r: r.last_used or 0)
+                    del self._records[oldest.fingerprint]
+                record = _KeyRecord(fingerprint)
+                self._records[fingerprint] = record
+            return record
+
+    def trust(self, api_key):
+        """
+        Mark the server's own key: call results never make it invalid, since a
+        rejection there would lock out every user for invalid_ttl
+        标记服务器自身的密钥：调用结果永远不会使其变为无效，否则会在 invalid_ttl 内拒绝所有用户
+        """
+        with self._lock:
+            self._trusted.add(key_fingerprint(api_key))
+
+    def _set_state(self, record, state, error=None):
+        ttl = {KEY_VALID: self.valid_ttl, KEY_INVALID: self.invalid_ttl, KEY_EXHAUSTED: self.exhausted_ttl,
+               KEY_UNKNOWN: self.unknown_ttl}[state]
+        record.state = state
+        record.checked_at = time.time()
+        record.expires_at = time.monotonic() + ttl
+        if error is not None:
+            record.last_error = str(error)[:200]
+
+    def _reject_if_bad(self, record):
+        now = time.monotonic()
+        if record.state in (KEY_INVALID, KEY_EXHAUSTED) and now < record.expires_at:
+            with self._lock:
+                self.rejections += 1
+            if record.state == KEY_INVALID:
+                raise CredentialError('API密钥无效 API key is not valid', KEY_INVALID)
+            raise CredentialError('API密钥配额已用尽 API key quota exhausted', KEY_EXHAUSTED,
+                                  retry_after=max(int(record.expires_at - now), 1))
+
+    def check(self, api_key, validate=True):
+        """
+        Reject a known-bad key; validate an unseen or expired one
+        拒绝已知无效的密钥；验证未见过或已过期的密钥
+
+        Args:
+            api_key: Key about to be used 即将使用的密钥
+            validate: Run the validator for unknown keys (False for the server key)
+                      对未知密钥运行验证（服务器密钥为False）
+
+        Raises:
+            CredentialError: The key is invalid or exhausted 密钥无效或配额耗尽
+        """
+        record = self._record(api_key)
+        record.last_used = time.time()
+        self._reject_if_bad(record)
+        if not validate or self._fresh(record):
+            return
+
+        with record.lock:
+            # Another request may have validated it meanwhile 其他请求可能已完成验证
+            self._reject_if_bad(record)
+            if self._fresh(record):
+                return
+            with self._lock:
+                self.validations += 1
+            try:
+                self.validator(api_key)
+            except Exception as e:
+                state = classify_error(e)
+                if state is None:
+                    # Network trouble etc.: let the real call decide, and don't
+                    # re-check on every request meanwhile
+                    # 网络问题等：交由实际调用决定，期间也不在每个请求上重复检查
+                    self._set_state(record, KEY_UNKNOWN, e)
+                    return
+                self._set_state(record, state, e)
+                self._reject_if_bad(record)
+            else:
+                self._set_state(record, KEY_VALID)
+
+    def _fresh(self, record):
+        """
+        Valid, or recently checked without an answer 有效，或最近检查过但没有结论
+        """
+        return record.state in (KEY_VALID, KEY_UNKNOWN) and time.monotonic() < record.expires_at
+
+    def record_success(self, api_key):
+        record = self._record(api_key)
+        record.requests += 1
+        if record.state != KEY_VALID:
+            self._set_state(record, KEY_VALID)
+
+    def record_failure(self, api_key, error):
+        """
+        Update a key's state from a failed upstream call
+        根据失败的上游调用更新密钥状态
+
+        Returns:
+            str or None: New state if the failure was about the key 若失败与密钥相关则返回新状态
+        """
+        state = classify_error(error)
+        record = self._record(api_key)
+        record.requests += 1
+        record.failures += 1
+        if state == KEY_INVALID and record.fingerprint in self._trusted:
+            # Keep serving; a misconfigured server key shows up in the logs 继续服务；服务器密钥配置错误会体现在日志中
+            record.last_error = str(error)[:200]
+            return None
+        if state is not None:
+            self._set_state(record, state, error)
+        return state
+
+    @contextmanager
+    def track(self, api_key, ignore=()):
+        """
+        Record the outcome of the upstream call made inside the block
+        记录代码块内上游调用的结果
+
+        Args:
+            api_key: Key used for the call 调用使用的密钥
+            ignore: Exception types that say nothing about the key (cancellations)
+                    与密钥无关的异常类型（如取消）
+        """
+        try:
+            yield
+        except ignore:
+            raise
+        except Exception as e:
+            self.record_failure(api_key, e)
+            raise
+        else:
+            self.record_success(api_key)
+
+    def forget(self, fingerprint):
+        """
+        Drop a key's cached state so it is validated again
+        删除密钥的缓存状态以便重新验证
+        """
+        with self._lock:
+            return self._records.pop(fingerprint, None) is not None
+
+    def snapshot(self):
+        """
+        Key health by fingerprint, for the admin endpoint
+        按指纹列出的密钥健康状态，供管理接口使用
+        """
+        now = time.monotonic()
+        with self._lock:
+            records = list(self._records.values())
+            totals = {'validations': self.validations, 'rejections': self.rejections}
+        keys = []
+        for record in sorted(records, key=lambda r: r.last_used or 0, reverse=True):
+            expired = now >= record.expires_at
+            keys.append({
+                'key': record.fingerprint,
+                'state': KEY_UNKNOWN if expired else record.state,
+                'checkedAt': record.checked_at,
+                'expiresIn': None if expired else round(record.expires_at - now, 1),
+                'requests': record.requests,
+                'failures': record.failures,
+                'lastError': record.last_error,
+                'lastUsed': record.last_used,
+            })
+        return dict(totals, keys=keys)
@@ -0,0 +1,304 @@
+"""
+Document Ingestion - multi-page PDFs and slide images, one page at a time
+文档导入 - 多页PDF和幻灯片图片，逐页处理
+
+Uploads are streamed to disk, then pages are read through memory-mapped
+files in a process pool: PDF pages with a text layer yield their text,
+scanned pages are rasterized to PNG, and image files are passed through.
+Only a bounded window of pages is in memory at once, whatever the size of
+the document.
+上传内容以流式写入磁盘，然后在进程池中通过内存映射文件读取页面：有文本层的PDF页面提取文本，
+扫描页面栅格化为PNG，图片文件直接传递。无论文档多大，同一时刻内存中只有有限窗口内的页面。
+
+PDF support needs pypdfium2 (and Pillow for rasterizing); image uploads
+work without them.
+PDF支持需要 pypdfium2（栅格化还需要 Pillow）；图片上传不需要它们。
+"""
+
+import base64
+import io
+import mmap
+import multiprocessing
+import os
+import shutil
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from .jobs import detach_main_module
+
+try:
+    import pypdfium2 as pdfium  # Optional: PDF text and rendering 可选：PDF文本与渲染
+except ImportError:
+    pdfium = None
+
+DOC_PDF = 'pdf'
+DOC_IMAGE = 'image'
+
+# Magic bytes of accepted files 可接受文件的魔数
+_SIGNATURES = [
+    (b'%PDF-', DOC_PDF, 'application/pdf'),
+    (b'\x89PNG\r\n\x1a\n', DOC_IMAGE, 'image/png'),
+    (b'\xff\xd8\xff', DOC_IMAGE, 'image/jpeg'),
+    (b'RIFF', DOC_IMAGE, 'image/webp'),
+    (b'GIF8', DOC_IMAGE, 'image/gif'),
+]
+
+
+class DocumentError(ValueError):
+    """
+    Upload that cannot be ingested (bad type, too large, no PDF support)
+    无法导入的上传（类型错误、过大、不支持PDF）
+    """
+
+
+def save_upload(stream, path, max_bytes, chunk_size=1 << 20):
+    """
+    Copy an upload stream to disk in fixed-size chunks
+    以固定大小的块将上传流复制到磁盘
+
+    Returns:
+        int: Bytes written 写入的字节数
+
+    Raises:
+        DocumentError: The upload exceeds max_bytes 上传超过 max_bytes
+    """
+    written = 0
+    with open(path, 'wb') as f:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            written += len(chunk)
+            if written > max_bytes:
+                raise DocumentError(f'Document is larger than {max_bytes} bytes')
+            f.write(chunk)
+    return written
+
+
+def detect_type(path):
+    """
+    (kind, mime type) of a saved file from its magic bytes
+    根据魔数判断已保存文件的 (类型, MIME类型)
+    """
+    with open(path, 'rb') as f:
+        head = f.read(16)
+    if not head:
+        raise DocumentError('Uploaded file is empty')
+    for signature, kind, mime_type in _SIGNATURES:
+        if head.startswith(signature):
+            if mime_type == 'image/webp' and head[8:12] != b'WEBP':
+                continue
+            return kind, mime_type
+    raise DocumentError('Unsupported file type; upload a PDF or PNG/JPEG/WebP/GIF images')
+
+
+def _open_mapped(path):
+    f = open(path, 'rb')
+    try:
+        return f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except Exception:
+        f.close()
+        raise
+
+
+class _MappedReader(io.RawIOBase):
+    """
+    Seekable read-only file view over a memory map, for pdfium's buffer reader
+    内存映射上的可定位只读文件视图，供pdfium的缓冲读取器使用
+    """
+
+    def __init__(self, mapped):
+        self._mapped = mapped
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: len(self._mapped)}[whence]
+        self._pos = max(base + offset, 0)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def readinto(self, buffer):
+        end = min(self._pos + len(buffer), len(self._mapped))
+        count = max(end - self._pos, 0)
+        buffer[:count] = self._mapped[self._pos:end]
+        self._pos = end
+        return count
+
+
+def pdf_page_count(path):
+    """
+    Number of pages in a PDF (runs in the process pool)
+    PDF的页数（在进程池中运行）
+    """
+    if pdfium is None:
+        raise DocumentError('PDF support requires the pypdfium2 package')
+    f, mapped = _open_mapped(path)
+    try:
+        pdf = pdfium.PdfDocument(_MappedReader(mapped))
+        try:
+            return len(pdf)
+        finally:
+            pdf.close()
+    finally:
+        mapped.close()
+        f.close()
+
+
+def read_pdf_page(path, index, page_number, max_image_bytes, max_text_chars=4000, min_text_chars=200, scale=1.5):
+    """
+    Extract one PDF page, rasterizing it when it has too little text (runs in the process pool)
+    提取一个PDF页面；文本过少时将其栅格化（在进程池中运行）
+
+    The document is read through a memory map, so only the pages pdfium
+    touches are paged in. A rendered page larger than max_image_bytes is
+    rendered again at a smaller scale. Text beyond max_text_chars (0: no
+    limit) is cut off and the page is marked truncated.
+    文档通过内存映射读取，因此只有pdfium访问到的页面会被载入。渲染结果超过 max_image_bytes 的页面
+    会以更小的比例重新渲染。超过 max_text_chars（0：不限制）的文本会被截断，并将该页标记为已截断。
+
+    Returns:
+        dict: {'page': n, 'text': str, 'truncated': bool, 'image': {'mime_type', 'data'} or None}
+              页码、文本、文本是否被截断，以及扫描页面的PNG图片
+    """
+    f, mapped = _open_mapped(path)
+    try:
+        pdf = pdfium.PdfDocument(_MappedReader(mapped))
+        try:
+            page = pdf[index]
+            try:
+                textpage = page.get_textpage()
+                try:
+                    text = textpage.get_text_range().strip()
+                finally:
+                    textpage.close()
+                image = None
+                if len(text) < min_text_chars:
+                    # Scanned or slide-like page: send a picture instead 扫描页或幻灯片式页面：改为发送图片
+                    while True:
+                        buffer = io.BytesIO()
+                        page.render(scale=scale).to_pil().save(buffer, format='PNG', optimize=True)
+                        if buffer.tell() <= max_image_bytes or scale <= 0.5:
+                            break
+                        scale /= 1.5
+                    if buffer.tell() > max_image_bytes:
+                        raise DocumentError(f'Page {page_number} is too large to send as an image')
+                    image = {'mime_type': 'image/png', 'data': base64.b64encode(buffer.getvalue()).decode('ascii')}
+                truncated = 0 < max_text_chars < len(text)
+                if truncated:
+                    text = text[:max_text_chars]
+                return {'page': page_number, 'text': text, 'truncated': truncated, 'image': image}
+            finally:
+                page.close()
+        finally:
+            pdf.close()
+    finally:
+        mapped.close()
+        f.close()
+
+
+def read_image_page(path, page_number, mime_type):
+    """
+    Load one uploaded image as a page (runs in the process pool)
+    将一张上传的图片作为一页载入（在进程池中运行）
+    """
+    f, mapped = _open_mapped(path)
+    try:
+        data = base64.b64encode(mapped).decode('ascii')
+    finally:
+        mapped.close()
+        f.close()
+    return {'page': page_number, 'text': '', 'truncated': False, 'image': {'mime_type': mime_type, 'data': data}}
+
+
+def plan_pages(paths, max_pages, executor, max_image_bytes, max_text_chars=4000):
+    """
+    List the pages of an upload as (function, args) jobs for the process pool
+    将上传内容的各页列为进程池任务 (函数, 参数)
+
+    Args:
+        paths: Saved files, in upload order 已保存的文件，按上传顺序
+        max_pages: Max pages accepted 最多接受的页数
+        executor: Process pool used to count PDF pages 用于统计PDF页数的进程池
+        max_image_bytes: Max size of one page image, before base64 单页图片的最大大小（base64编码前）
+        max_text_chars: Max text kept per PDF page, 0 for no limit 每个PDF页面保留的最大文本长度，0为不限制
+
+    Returns:
+        list: (fn, args) per page 每页的 (函数, 参数)
+
+    Raises:
+        DocumentError: Unsupported file, too many pages or an oversized image 文件不受支持、页数过多或图片过大
+    """
+    pages = []
+    for path in paths:
+        kind, mime_type = detect_type(path)
+        if kind == DOC_PDF:
+            if pdfium is None:
+                raise DocumentError('PDF support requires the pypdfium2 package')
+            count = executor.submit(pdf_page_count, path).result()
+            if len(pages) + count > max_pages:
+                raise DocumentError(f'Documents are limited to {max_pages} pages')
+            # Pages are numbered across files 页码跨文件连续编号
+            offset = len(pages)
+            pages.extend((read_pdf_page, (path, i, offset + i + 1, max_image_bytes, max_text_chars))
+                         for i in range(count))
+        else:
+            if os.path.getsize(path) > max_image_bytes:
+                raise DocumentError(f'Images are limited to {max_image_bytes} bytes each')
+            pages.append((read_image_page, (path, len(pages) + 1, mime_type)))
+        if len(pages) > max_pages:
+            raise DocumentError(f'Documents are limited to {max_pages} pages')
+    return pages
+
+
+class DocumentWorkspace:
+    """
+    Per-upload directory under a root, removed once the document is processed
+    每次上传在根目录下的独立目录，文档处理完成后删除
+    """
+
+    def __init__(self, root, document_id):
+        self.path = os.path.join(root, document_id)
+        os.makedirs(self.path, exist_ok=True)
+        self.files = []
+
+    def new_file(self):
+        path = os.path.join(self.path, f'part-{len(self.files):04d}')
+        self.files.append(path)
+        return path
+
+    def open_file(self, *_args, **_kwargs):
+        """
+        New writable file in the workspace; usable as werkzeug's multipart stream_factory
+        在工作区中新建可写文件；可用作werkzeug的multipart stream_factory
+        """
+        return open(self.new_file(), 'wb+')
+
+    def remove(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def document_executor(workers):
+    """
+    Shared process pool for page extraction, created on first use
+    页面提取的共享进程池，首次使用时创建
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # Spawn, not fork: the web process already runs threads 使用spawn而非fork：Web进程已有多个线程
+            # Workers only need this module, not the server script that imported it 工作进程只需要本模块，而不是导入它的服务脚本
+            detach_main_module()
+            _executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        return _executor
@@ -0,0 +1,482 @@
+"""
+Prompt Experiments - compare prompt/config variants offline and in a live canary
+提示词实验 - 离线比较提示词/配置变体，并进行线上金丝雀发布
+
+A variant overrides prompt templates (PROMPT_FINAL, PROMPT_RESPOND,
+PROMPT_TEACH), generation_config and the model. Offline, a fixed corpus is
+run through each variant against recorded responses, so runs are free and
+repeatable; prompt/output tokens, latency, JSON parse failures and schema
+validity are reported per variant. Online, CanaryRouter sends a percentage
+of sessions to one variant and keeps the same measurements.
+变体可覆盖提示词模板（PROMPT_FINAL、PROMPT_RESPOND、PROMPT_TEACH）、generation_config 和模型。
+离线时，固定语料通过每个变体并使用录制的响应回放，因此运行免费且可重复；按变体报告提示/输出token、
+延迟、JSON解析失败率和结构有效率。线上时，CanaryRouter 将一定比例的会话路由到某个变体，并记录相同的指标。
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .response_cache import prompt_version
+
+KIND_ANALYZE = 'analyze'
+KIND_RESPOND = 'respond'
+KIND_TEACH = 'teach'
+KINDS = (KIND_ANALYZE, KIND_RESPOND, KIND_TEACH)
+
+DEFAULT_MODEL = 'gemini-2.0-flash'
+
+
+# ---------- Variants 变体 ----------
+
+class Variant:
+    """
+    A named set of prompt, generation_config and model overrides
+    一组命名的提示词、generation_config 和模型覆盖
+
+    Args:
+        name: Variant name 变体名称
+        prompts: {kind: template} overrides; missing kinds use the default 各类型的模板覆盖；缺失的类型使用默认模板
+        generation_config: Keys merged over the base generation_config 合并到基础 generation_config 之上的键
+        model: Model name override, or None 模型名覆盖，或None
+    """
+
+    def __init__(self, name, prompts=None, generation_config=None, model=None):
+        self.name = name
+        self.prompts = dict(prompts or {})
+        self.generation_config = dict(generation_config or {})
+        self.model = model
+
+    def prompt(self, kind, default):
+        return self.prompts.get(kind, default)
+
+    def config(self, base):
+        return dict(base, **self.generation_config)
+
+    def model_name(self, default=DEFAULT_MODEL):
+        return self.model or default
+
+    def version(self, kind, default_template):
+        """
+        Short hash of what this variant sends for a kind (cache key part)
+        该变体对某类型发送内容的简短哈希（缓存键的一部分）
+        """
+        if kind not in self.prompts and not self.generation_config and not self.model:
+            return prompt_version(default_template)
+        return prompt_version(json.dumps(
+            [self.prompt(kind, default_template), self.generation_config, self.model], sort_keys=True
+        ))
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'prompts': sorted(self.prompts),
+            'generationConfig': self.generation_config,
+            'model': self.model
+        }
+
+
+BASELINE = Variant('baseline')
+
+
+def load_variants(path):
+    """
+    Read variants from a JSON file
+    从JSON文件读取变体
+
+    The file holds a list of {"name", "prompts", "generationConfig", "model"}.
+    A prompt value starting with '@' is a template file path, relative to the
+    variants file.
+    文件包含 {"name", "prompts", "generationConfig", "model"} 列表。以 '@' 开头的提示词值
+    是模板文件路径（相对于变体文件）。
+
+    Returns:
+        list: Variant objects Variant对象列表
+    """
+    with open(path, encoding='utf-8') as f:
+        items = json.load(f)
+    base_dir = os.path.dirname(os.path.abspath(path))
+    variants = []
+    for item in items:
+        prompts = {}
+        for kind, template in (item.get('prompts') or {}).items():
+            if kind not in KINDS:
+                raise ValueError(f'Unknown prompt kind in variant {item.get("name")}: {kind}')
+            if template.startswith('@'):
+                with open(os.path.join(base_dir, template[1:]), encoding='utf-8') as f:
+                    template = f.read()
+            prompts[kind] = template
+        variants.append(Variant(item['name'], prompts, item.get('generationConfig'), item.get('model')))
+    names = [v.name for v in variants]
+    if len(set(names)) != len(names):
+        raise ValueError('Variant names must be unique')
+    return variants
+
+
+# ---------- Schemas 结构校验 ----------
+
+def validate_analysis(data):
+    """
+    PROMPT_FINAL output: a non-empty list of comments with the fields the UI reads
+    PROMPT_FINAL 输出：非空评论列表，且含有界面读取的字段
+    """
+    if not isinstance(data, list) or not data:
+        return False
+    for comment in data:
+        if not isinstance(comment, dict):
+            return False
+        if not all(isinstance(comment.get(field), str) and comment.get(field) for field in ('type', 'title', 'content')):
+            return False
+        if not isinstance(comment.get('needsResponse'), bool):
+            return False
+    return True
+
+
+def validate_feedback(data):
+    """
+    PROMPT_RESPOND output: understood (bool), feedback (str), followUpQuestion (str or null)
+    PROMPT_RESPOND 输出：understood（布尔）、feedback（字符串）、followUpQuestion（字符串或null）
+    """
+    return (isinstance(data, dict)
+            and isinstance(data.get('understood'), bool)
+            and isinstance(data.get('feedback'), str) and bool(data['feedback'].strip())
+            and (data.get('followUpQuestion') is None or isinstance(data['followUpQuestion'], str)))
+
+
+def validate_feedback_batch(data):
+    """
+    PROMPT_RESPOND_BATCH output: a non-empty list of feedback objects
+    PROMPT_RESPOND_BATCH 输出：非空的反馈对象列表
+    """
+    return isinstance(data, list) and bool(data) and all(validate_feedback(item) for item in data)
+
+
+def validate_answer(data):
+    """
+    PROMPT_ANSWER_QUESTION output: an object with a non-empty answer (str)
+    PROMPT_ANSWER_QUESTION 输出：含非空 answer（字符串）的对象
+    """
+    return isinstance(data, dict) and isinstance(data.get('answer'), str) and bool(data['answer'].strip())
+
+
+# Kinds that answer in JSON, with their schema check 以JSON回答的类型及其结构校验
+SCHEMAS = {
+    KIND_ANALYZE: validate_analysis,
+    KIND_RESPOND: validate_feedback,
+}
+
+
+def check_output(kind, text, clean_json):
+    """
+    Parse and validate a response the way the route would
+    按路由的方式解析并校验响应
+
+    Args:
+        kind: Prompt kind 提示词类型
+        text: Raw response text 原始响应文本
+        clean_json: The app's clean_json_response 应用的 clean_json_response
+
+    Returns:
+        tuple: (json_ok, schema_ok); (None, bool) for plain-text kinds 纯文本类型返回 (None, bool)
+    """
+    validator = SCHEMAS.get(kind)
+    if validator is None:
+        return None, bool((text or '').strip())
+    try:
+        data = json.loads(clean_json(text or ''))
+    except (ValueError, TypeError):
+        return False, False
+    return True, validator(data)
+
+
+def estimate_tokens(text):
+    """
+    Rough token count (4 characters per token), used when usage metadata is missing
+    粗略token数（每4个字符一个token），在缺少用量元数据时使用
+    """
+    return len(text or '') // 4
+
+
+# ---------- Backends 后端 ----------
+
+class ReplayMiss(KeyError):
+    """
+    No recorded response for a prompt and no live backend to fall back to
+    某提示词没有录制的响应，且没有可回退的实时后端
+    """
+
+
+def recording_key(model, prompt, config):
+    """
+    Stable key of one upstream request 一次上游请求的稳定键
+    """
+    payload = json.dumps([model, prompt, config], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class GeminiBackend:
+    """
+    Live Gemini calls, measured
+    带测量的实时Gemini调用
+
+    Args:
+        api_key: API key to call with 调用使用的API密钥
+    """
+
+    def __init__(self, api_key):
+        from .gemini import model_for
+        self._api_key = api_key
+        self._model_for = model_for
+
+    def generate(self, model, prompt, config):
+        started = time.monotonic()
+        response = self._model_for(model, self._api_key).generate_content(prompt, generation_config=config)
+        latency = time.monotonic() - started
+        try:
+            text = response.text
+        except ValueError:
+            text = ''
+        usage = getattr(response, 'usage_metadata', None)
+        prompt_tokens = getattr(usage, 'prompt_token_count', 0) or 0
+        return {
+            'text': text,
+            'promptTokens': prompt_tokens or estimate_tokens(prompt),
+            'outputTokens': (getattr(usage, 'candidates_token_count', 0) or 0) if prompt_tokens else estimate_tokens(text),
+            'latency': latency,
+            'estimated': not prompt_tokens
+        }
+
+
+class ReplayBackend:
+    """
+    Recorded responses keyed by (model, prompt, config), with optional recording
+    以 (模型, 提示词, 配置) 为键的录制响应，可选择录制新响应
+
+    Recordings are JSON lines of {"key", "model", "text", "promptTokens",
+    "outputTokens", "latency"}; the recorded latency is reported, not slept.
+    With a live backend, misses are called live and appended to the file.
+    录制文件为JSON行 {"key", "model", "text", "promptTokens", "outputTokens", "latency"}；
+    报告录制的延迟而不实际等待。提供实时后端时，未命中的请求会实时调用并追加到文件。
+
+    Args:
+        path: Recordings file 录制文件
+        live: Backend used for misses (record mode), or None for replay only 未命中时使用的后端（录制模式），仅回放时为None
+    """
+
+    def __init__(self, path, live=None):
+        self.path = path
+        self.live = live
+        self._recordings = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if path and os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        self._recordings[record['key']] = record
+
+    def generate(self, model, prompt, config):
+        key = recording_key(model, prompt, config)
+        with self._lock:
+            record = self._recordings.get(key)
+            if record is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if record is not None:
+            return dict(record, replayed=True)
+        if self.live is None:
+            raise ReplayMiss(key)
+        result = self.live.generate(model, prompt, config)
+        record = dict(result, key=key, model=model)
+        with self._lock:
+            self._recordings[key] = record
+            if self.path:
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        return dict(record, replayed=False)
+
+
+# ---------- Offline runs 离线运行 ----------
+
+def load_corpus(path):
+    """
+    Read evaluation cases from a JSON-lines file
+    从JSON行文件读取评测用例
+
+    Each line is {"kind": "analyze", "content": ...},
+    {"kind": "respond", "response": ..., "originalQuestion": ..., "conversationHistory": [...]}
+    or {"kind": "teach", "topic": ...}; an optional "id" names the case.
+    每行为 analyze / respond / teach 类型的用例；可选的 "id" 为用例命名。
+    """
+    cases = []
+    with open(path, encoding='utf-8') as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            case = json.loads(line)
+            if case.get('kind') not in KINDS:
+                raise ValueError(f'{path}:{number}: kind must be one of {", ".join(KINDS)}')
+            case.setdefault('id', f'{case["kind"]}-{number}')
+            cases.append(case)
+    return cases
+
+
+def run_experiment(cases, variants, backend, build_prompt, clean_json, base_config, workers=4):
+    """
+    Run every case through every variant
+    让每个用例通过每个变体
+
+    Args:
+        cases: From load_corpus() 来自 load_corpus()
+        variants: Variant objects 变体列表
+        backend: ReplayBackend or GeminiBackend 回放或实时后端
+        build_prompt: fn(variant, case) -> prompt text 构建提示词的函数
+        clean_json: The app's clean_json_response 应用的 clean_json_response
+        base_config: generation_config the variants are merged over 变体合并所基于的 generation_config
+        workers: Parallel calls 并行调用数
+
+    Returns:
+        list: One result dict per (variant, case) 每个 (变体, 用例) 一个结果
+    """
+    def run(variant, case):
+        result = {'variant': variant.name, 'case': case['id'], 'kind': case['kind']}
+        prompt = build_prompt(variant, case)
+        try:
+            output = backend.generate(variant.model_name(), prompt, variant.config(base_config))
+        except ReplayMiss:
+            # Prompt size is still known without a recording 没有录制也能得知提示词大小
+            return dict(result, status='miss', promptTokens=estimate_tokens(prompt))
+        except Exception as e:
+            return dict(result, status='error', error=str(e)[:200], promptTokens=estimate_tokens(prompt))
+        json_ok, schema_ok = check_output(case['kind'], output['text'], clean_json)
+        return dict(result, status='ok', promptTokens=output['promptTokens'], outputTokens=output['outputTokens'],
+                    latency=output['latency'], jsonOk=json_ok, schemaOk=schema_ok)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(run, variant, case) for variant in variants for case in cases]
+        return [future.result() for future in futures]
+
+
+def _mean(values):
+    return round(sum(values) / len(values), 1) if values else None
+
+
+def _percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(int(q * len(values)), len(values) - 1)] * 1000, 1)
+
+
+def summarize(results):
+    """
+    Per-variant, per-kind metrics from run_experiment() results
+    根据 run_experiment() 结果计算每个变体、每种类型的指标
+
+    Returns:
+        dict: {variant: {kind: metrics}} 变体 -> 类型 -> 指标
+    """
+    groups = {}
+    for result in results:
+        groups.setdefault(result['variant'], {}).setdefault(result['kind'], []).append(result)
+    report = {}
+    for variant, kinds in groups.items():
+        report[variant] = {}
+        for kind, rows in kinds.items():
+            done = [r for r in rows if r['status'] == 'ok']
+            parsed = [r for r in done if r['jsonOk'] is not None]
+            report[variant][kind] = {
+                'cases': len(rows),
+                'completed': len(done),
+                'misses': sum(1 for r in rows if r['status'] == 'miss'),
+                'errors': sum(1 for r in rows if r['status'] == 'error'),
+                'promptTokens': _mean([r['promptTokens'] for r in rows]),
+                'outputTokens': _mean([r['outputTokens'] for r in done]),
+                'latencyP50Ms': _percentile([r['latency'] for r in done], 0.50),
+                'latencyP95Ms': _percentile([r['latency'] for r in done], 0.95),
+                'jsonFailureRate': round(sum(1 for r in parsed if not r['jsonOk']) / len(parsed), 3) if parsed else None,
+                'schemaValidRate': round(sum(1 for r in done if r['schemaOk']) / len(done), 3) if done else None,
+            }
+    return report
+
+
+# ---------- Live canary 线上金丝雀 ----------
+
+class CanaryRouter:
+    """
+    Send a fixed share of sessions to one variant and measure both arms
+    将固定比例的会话路由到某个变体，并测量两组
+
+    Assignment hashes the session id, so a session stays on one arm and
+    the split holds across processes without shared state.
+    分配基于会话ID的哈希，因此会话始终留在同一组，且无需共享状态即可在多进程间保持比例。
+
+    Args:
+        variant: Variant under test, or None to disable 待测变体，None为禁用
+        percent: Share of sessions routed to it, 0-100 路由到变体的会话百分比
+        window: Recent calls kept per arm and kind for latency percentiles 每组每类型保留的近期调用数
+    """
+
+    def __init__(self, variant=None, percent=0.0, window=1000):
+        self.variant = variant
+        self.percent = max(0.0, min(float(percent), 100.0))
+        self.window = window
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.variant is not None and self.percent > 0
+
+    def assign(self, session_id):
+        """
+        Variant for a session: the canary variant or BASELINE
+        会话对应的变体：金丝雀变体或 BASELINE
+        """
+        if not self.enabled:
+            return BASELINE
+        digest = hashlib.sha256(f'{self.variant.name}:{session_id}'.encode('utf-8')).digest()
+        bucket = int.from_bytes(digest[:4], 'big') % 10000
+        return self.variant if bucket < self.percent * 100 else BASELINE
+
+    def observe(self, variant_name, kind, latency, json_ok=None, schema_ok=None):
+        """
+        Record one live call of an arm 记录某组的一次线上调用
+        """
+        with self._lock:
+            stats = self._stats.get((variant_name, kind))
+            if stats is None:
+                stats = {'calls': 0, 'jsonFailures': 0, 'schemaFailures': 0,
+                         'latencies': deque(maxlen=self.window)}
+                self._stats[(variant_name, kind)] = stats
+            stats['calls'] += 1
+            stats['latencies'].append(latency)
+            if json_ok is False:
+                stats['jsonFailures'] += 1
+            if schema_ok is False:
+                stats['schemaFailures'] += 1
+
+    def snapshot(self):
+        with self._lock:
+            items = [(key, dict(stats, latencies=list(stats['latencies']))) for key, stats in self._stats.items()]
+        arms = {}
+        for (variant_name, kind), stats in items:
+            arms.setdefault(variant_name, {})[kind] = {
+                'calls': stats['calls'],
+                'jsonFailureRate': round(stats['jsonFailures'] / stats['calls'], 3),
+                'schemaFailureRate': round(stats['schemaFailures'] / stats['calls'], 3),
+                'latencyP50Ms': _percentile(stats['latencies'], 0.50),
+                'latencyP95Ms': _percentile(stats['latencies'], 0.95),
+            }
+        return {
+            'variant': self.variant.to_dict() if self.variant else None,
+            'percent': self.percent,
+            'arms': arms
+        }
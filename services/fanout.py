@@ -0,0 +1,156 @@
+"""
+Fan-out Limiter - cap concurrent upstream calls per API key
+并发扇出限制器 - 限制每个API密钥的并发上游调用数
+
+Used by sectioned lesson generation so one lesson cannot open an unbounded
+number of simultaneous requests against a single key. Tasks over a key's cap
+wait in that key's queue, not on a pool thread, so a busy key (e.g. the shared
+default key) never occupies the shared pool with blocked threads.
+用于分节课程生成，避免单个课程对同一密钥发起无限数量的并发请求。超出密钥上限的任务在该密钥的队列中等待，
+而不是占用线程池线程等待，因此繁忙的密钥（如共享默认密钥）不会用阻塞线程占满共享池。
+"""
+
+import hashlib
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+def key_fingerprint(api_key):
+    """
+    Short, non-reversible fingerprint of an API key, safe to log
+    API密钥的简短不可逆指纹，可安全记录日志
+    """
+    return hashlib.sha256((api_key or '').encode('utf-8')).hexdigest()[:12]
+
+
+class KeyedLimiter:
+    """
+    Per-key submission queue in front of an executor
+    位于执行器之前的按密钥提交队列
+
+    At most `limit` tasks per key are handed to the executor at once; the rest
+    wait here and are submitted as earlier ones finish.
+    每个密钥同时最多有 `limit` 个任务交给执行器；其余任务在此等待，并在之前的任务完成后提交。
+    """
+
+    def __init__(self, limit):
+        self.limit = max(int(limit), 1)
+        self._keys = {}  # fingerprint -> [running count, deque of waiting tasks] 指纹 -> [运行数, 等待任务队列]
+        self._lock = threading.Lock()
+
+    def submit(self, executor, api_key, fn):
+        """
+        Run fn on the executor once the key has a free slot
+        在密钥有空闲槽位时于执行器上运行 fn
+
+        Returns:
+            Future: Cancellable until the task is handed to the executor 在任务交给执行器之前可取消
+        """
+        fingerprint = key_fingerprint(api_key)
+        future = Future()
+        with self._lock:
+            state = self._keys.setdefault(fingerprint, [0, deque()])
+            if state[0] >= self.limit:
+                state[1].append((executor, fn, future))
+                return future
+            state[0] += 1
+        self._start(fingerprint, executor, fn, future)
+        return future
+
+    def _start(self, fingerprint, executor, fn, future):
+        while not future.set_running_or_notify_cancel():
+            # Cancelled while waiting: hand the slot to the next task 等待期间被取消：把槽位交给下一个任务
+            task = self._next(fingerprint)
+            if task is None:
+                return
+            executor, fn, future = task
+
+        def run():
+            try:
+                result = fn()
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+            finally:
+                task = self._next(fingerprint)
+                if task is not None:
+                    self._start(fingerprint, *task)
+
+        executor.submit(run)
+
+    def _next(self, fingerprint):
+        # Pass the slot on, or give it back 传递槽位或归还
+        with self._lock:
+            state = self._keys[fingerprint]
+            if state[1]:
+                return state[1].popleft()
+            state[0] -= 1
+            if not state[0]:
+                del self._keys[fingerprint]
+            return None
+
+
+class RateLimiter:
+    """
+    Blocking limiter that spaces calls at most `rate` per second
+    阻塞式限速器，使调用间隔满足每秒最多 `rate` 次
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate and rate > 0 else 0.0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def run_ordered(executor, tasks, window=None, limiter=None, api_key=''):
+    """
+    Submit tasks and yield results in submission order
+    提交任务，并按提交顺序产出结果
+
+    Each result is yielded as soon as it and every earlier task are done.
+    With a window, at most that many tasks are submitted ahead of the
+    consumer, which bounds memory for long task streams.
+    每个结果在其自身及之前所有任务完成后立即产出。指定窗口时，最多提前提交该数量的任务，
+    从而限制长任务流的内存占用。
+
+    Args:
+        executor: Executor to run on 执行器
+        tasks: Iterable of zero-argument callables 无参可调用对象的可迭代对象
+        window: Max tasks in flight, or None to submit all at once 最大在途任务数；None表示一次性提交全部
+        limiter: Optional KeyedLimiter capping the tasks of api_key on the executor 可选的按密钥限制器
+        api_key: Key the tasks call upstream with 任务调用上游使用的密钥
+
+    Yields:
+        Task results, in order 按顺序的任务结果
+    """
+    tasks = iter(tasks)
+    futures = deque()
+    try:
+        while True:
+            while window is None or len(futures) < window:
+                task = next(tasks, None)
+                if task is None:
+                    break
+                futures.append(limiter.submit(executor, api_key, task) if limiter else executor.submit(task))
+            if not futures:
+                return
+            yield futures.popleft().result()
+    finally:
+        # Client went away or a section failed: drop work not yet started 客户端断开或某节失败：取消尚未开始的任务
+        for future in futures:
+            future.cancel()
+
+
+# Shared worker pool for section generation 分节生成的共享线程池
+section_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix='lesson-section')
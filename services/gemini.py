@@ -0,0 +1,65 @@
+"""
+Gemini Clients - one upstream client per API key
+Gemini客户端 - 每个API密钥一个上游客户端
+
+genai.configure(api_key=...) replaces a process-wide default client, so two
+requests configuring different keys from concurrent threads can send a call
+with the other request's key. model_for() gives each model a client bound to
+the key of its own call instead; clients are cached per key, since gRPC
+channels are thread-safe and expensive to open.
+genai.configure(api_key=...) 会替换进程级的默认客户端，因此两个请求在并发线程中配置不同密钥时，
+调用可能使用另一个请求的密钥发出。model_for() 改为给每个模型绑定其自身调用密钥的客户端；
+客户端按密钥缓存，因为gRPC通道是线程安全的且建立成本较高。
+"""
+
+import threading
+from collections import OrderedDict
+
+import google.generativeai as genai
+from google.ai import generativelanguage as glm
+
+from .fanout import key_fingerprint
+
+
+class ClientPool:
+    """
+    LRU cache of GenerativeServiceClient per API key
+    按API密钥缓存的 GenerativeServiceClient（LRU）
+
+    Args:
+        max_clients: Clients kept before the least recently used is dropped 淘汰最久未用客户端前保留的数量
+    """
+
+    def __init__(self, max_clients=64):
+        self.max_clients = max_clients
+        self._clients = OrderedDict()  # fingerprint -> (api_key, client) 指纹 -> (API密钥, 客户端)
+        self._lock = threading.Lock()
+
+    def get(self, api_key):
+        fingerprint = key_fingerprint(api_key)
+        with self._lock:
+            entry = self._clients.get(fingerprint)
+            if entry is not None and entry[0] == api_key:
+                self._clients.move_to_end(fingerprint)
+                return entry[1]
+        client = glm.GenerativeServiceClient(client_options={'api_key': api_key})
+        with self._lock:
+            self._clients[fingerprint] = (api_key, client)
+            self._clients.move_to_end(fingerprint)
+            while len(self._clients) > self.max_clients:
+                # In-flight calls keep their own reference 进行中的调用仍持有自己的引用
+                self._clients.popitem(last=False)
+        return client
+
+
+gemini_clients = ClientPool()
+
+
+def model_for(model_name, api_key):
+    """
+    genai.GenerativeModel that calls with the given key, without touching global config
+    使用给定密钥调用的 genai.GenerativeModel，不修改全局配置
+    """
+    model = genai.GenerativeModel(model_name)
+    model._client = gemini_clients.get(api_key)
+    return model
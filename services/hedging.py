@@ -0,0 +1,347 @@
+"""
+Hedged Requests - cut tail latency on short interactive calls
+对冲请求 - 降低短交互调用的尾延迟
+
+If an upstream call has not produced its first token within an adaptive
+threshold (a rolling percentile of recent first-token latencies for the
+endpoint), an identical second attempt is started. Whichever finishes first
+wins and the other is cancelled. A token bucket caps hedges to a fraction of
+primary traffic.
+若上游调用在自适应阈值（该接口近期首个token延迟的滚动百分位）内未产出首个token，
+则发起一个相同的第二次尝试。先完成者胜出，另一个被取消。令牌桶将对冲请求限制为主请求流量的一定比例。
+"""
+
+import math
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+class HedgeCancelled(Exception):
+    """Raised inside an attempt that lost the race 在竞争中落败的尝试内部抛出"""
+
+
+def _run_quietly(callback):
+    try:
+        callback()
+    except Exception:
+        pass
+
+
+class Attempt:
+    """
+    Handle passed to each attempt so it can report progress and see cancellation
+    传递给每次尝试的句柄，用于报告进度和感知取消
+    """
+
+    def __init__(self, hedge=False):
+        self.hedge = hedge
+        self.started_at = time.monotonic()
+        self.started = threading.Event()
+        self.first_token = threading.Event()
+        self.cancelled = threading.Event()
+        self.first_token_latency = None
+        self._on_cancel = []
+        self._lock = threading.Lock()
+
+    def mark_started(self):
+        """
+        Record that the request was sent (e.g. its scheduler slot was granted);
+        first-token latency is measured from here, so queueing is not counted
+        记录请求已发出（如已获得调度槽位）；首个token延迟从此刻起计，因此不计入排队时间
+        """
+        if not self.started.is_set():
+            self.started_at = time.monotonic()
+            self.started.set()
+
+    def mark_first_token(self):
+        """Record that the first token arrived 记录首个token已到达"""
+        if not self.first_token.is_set():
+            self.first_token_latency = time.monotonic() - self.started_at
+            self.first_token.set()
+
+    def on_cancel(self, callback):
+        """
+        Run callback when the attempt is cancelled, e.g. to abort a blocking read;
+        runs at once if it already was
+        尝试被取消时运行回调（如中止阻塞的读取）；若已被取消则立即运行
+        """
+        with self._lock:
+            if not self.cancelled.is_set():
+                self._on_cancel.append(callback)
+                return
+        _run_quietly(callback)
+
+    def cancel(self):
+        """Mark the attempt as lost and run its cancel callbacks 将尝试标记为落败并运行其取消回调"""
+        with self._lock:
+            if self.cancelled.is_set():
+                return
+            self.cancelled.set()
+            callbacks, self._on_cancel = self._on_cancel, []
+        for callback in callbacks:
+            _run_quietly(callback)
+
+    def check_cancelled(self):
+        """Raise HedgeCancelled if the other attempt already won 若另一尝试已胜出则抛出 HedgeCancelled"""
+        if self.cancelled.is_set():
+            raise HedgeCancelled()
+
+
+class LatencyTracker:
+    """
+    Rolling window of first-token latencies per endpoint
+    每个接口的首个token延迟滚动窗口
+    """
+
+    def __init__(self, window=200):
+        self.window = window
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, seconds):
+        with self._lock:
+            self._samples.setdefault(endpoint, deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, endpoint, q):
+        """
+        Rolling percentile, or None until enough samples exist
+        滚动百分位；样本不足时返回None
+        """
+        with self._lock:
+            samples = sorted(self._samples.get(endpoint, ()))
+        if not samples:
+            return None
+        return samples[min(int(q * len(samples)), len(samples) - 1)]
+
+    def count(self, endpoint):
+        with self._lock:
+            return len(self._samples.get(endpoint, ()))
+
+
+class HedgeBudget:
+    """
+    Token bucket: every primary call earns `ratio` tokens, every hedge spends one
+    令牌桶：每次主调用获得 `ratio` 个令牌，每次对冲消耗一个
+    """
+
+    def __init__(self, ratio=0.1, burst=5.0):
+        self.ratio = ratio
+        self.burst = burst
+        self._tokens = burst
+        self._lock = threading.Lock()
+
+    def earn(self):
+        with self._lock:
+            self._tokens = min(self._tokens + self.ratio, self.burst)
+
+    def try_spend(self):
+        with self._lock:
+            if self._tokens >= 1.0:
+                self._tokens -= 1.0
+                return True
+            return False
+
+
+class Hedger:
+    """
+    Runs attempts with optional hedging for designated endpoints
+    为指定接口运行可选对冲的尝试
+
+    Args:
+        endpoints: Endpoint names that may be hedged 可对冲的接口名
+        percentile: Rolling percentile used as the hedge threshold 用作对冲阈值的滚动百分位
+        min_samples: Samples needed before the percentile is trusted 信任百分位前所需的样本数
+        default_delay: Threshold (seconds) used until then 样本不足时使用的阈值（秒）
+        min_delay: Lower bound on the threshold 阈值下限
+        max_delay: Upper bound on the threshold 阈值上限
+        budget_ratio: Max hedges per primary call, long-run 长期平均每次主调用的最大对冲数
+        budget_burst: Hedges that may be spent in a burst 可突发使用的对冲数
+        max_workers: Threads available for attempts 可用于尝试的线程数
+    """
+
+    def __init__(self, endpoints=(), percentile=0.9, min_samples=20, default_delay=1.5,
+                 min_delay=0.2, max_delay=5.0, budget_ratio=0.1, budget_burst=5.0, max_workers=16):
+        self.endpoints = set(endpoints)
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.default_delay = default_delay
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.latencies = LatencyTracker()
+        self.budget = HedgeBudget(budget_ratio, budget_burst)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='hedge')
+        self._stats_lock = threading.Lock()
+        self._stats = {'calls': 0, 'hedged': 0, 'hedgeWins': 0, 'budgetDenied': 0}
+
+    def configure(self, endpoints, percentile, budget_ratio):
+        """
+        Replace the hedged endpoints, percentile and budget at runtime 运行时替换对冲接口、百分位和预算
+        """
+        self.endpoints = set(endpoints)
+        self.percentile = percentile
+        self.budget.ratio = budget_ratio
+
+    def _count(self, name):
+        with self._stats_lock:
+            self._stats[name] += 1
+
+    def threshold(self, endpoint):
+        """
+        Current hedge threshold for an endpoint, in seconds
+        接口当前的对冲阈值（秒）
+        """
+        if self.latencies.count(endpoint) < self.min_samples:
+            return self.default_delay
+        value = self.latencies.percentile(endpoint, self.percentile)
+        return min(max(value, self.min_delay), self.max_delay)
+
+    def _record(self, endpoint, attempt):
+        if attempt.first_token_latency is not None:
+            self.latencies.record(endpoint, attempt.first_token_latency)
+
+    def call(self, endpoint, fn):
+        """
+        Run fn(attempt), hedging it if the endpoint is designated
+        运行 fn(attempt)；若接口被指定则进行对冲
+
+        Args:
+            endpoint: Endpoint name 接口名
+            fn: Callable taking an Attempt; must call attempt.mark_started() when
+                the request is actually sent and attempt.mark_first_token() when
+                output starts, and should stop early once attempt.cancelled is set;
+                a blocking read should be aborted via attempt.on_cancel().
+                No hedge is sent while the primary is still queued.
+                接收 Attempt 的可调用对象；请求实际发出时须调用 attempt.mark_started()，
+                输出开始时调用 attempt.mark_first_token()，并在 attempt.cancelled 被设置后尽早停止；
+                阻塞的读取应通过 attempt.on_cancel() 中止。
+                主请求仍在排队时不会发送对冲请求。
+
+        Returns:
+            Result of the winning attempt 胜出尝试的结果
+        """
+        self._count('calls')
+
+        if endpoint not in self.endpoints:
+            attempt = Attempt()
+            try:
+                return fn(attempt)
+            finally:
+                self._record(endpoint, attempt)
+
+        # Only hedge-eligible calls earn budget 只有可对冲的调用才积累预算
+        self.budget.earn()
+        primary = Attempt()
+        primary_future = self._executor.submit(fn, primary)
+        attempts = {primary_future: primary}
+
+        # A queued primary is waiting for capacity, which a hedge would only add to
+        # 排队中的主请求在等待容量，对冲只会加重排队
+        while not primary.started.wait(0.05) and not primary_future.done():
+            pass
+
+        # Wait for first token or completion, up to the threshold after the send 在发出后的阈值内等待首个token或完成
+        deadline = primary.started_at + self.threshold(endpoint)
+        while not primary.first_token.is_set() and not primary_future.done():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            primary.first_token.wait(min(remaining, 0.05))
+
+        if not primary.first_token.is_set() and not primary_future.done():
+            if self.budget.try_spend():
+                self._count('hedged')
+                hedge = Attempt(hedge=True)
+                attempts[self._executor.submit(fn, hedge)] = hedge
+            else:
+                self._count('budgetDenied')
+
+        pending = set(attempts)
+        first_error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                attempt = attempts[future]
+                error = future.exception()
+                if error is None:
+                    # Winner: cancel the others now, so their slots free up 胜出者：立即取消其他尝试，以释放其槽位
+                    for other in pending:
+                        attempts[other].cancel()
+                    self._record(endpoint, attempt)
+                    if attempt is not primary and primary.first_token_latency is None:
+                        # Slow primary still counts, or the threshold drifts down 慢的主请求也要计入，否则阈值会向下漂移
+                        self.latencies.record(endpoint, time.monotonic() - primary.started_at)
+                    if attempt.hedge:
+                        self._count('hedgeWins')
+                    return future.result()
+                if first_error is None and not isinstance(error, HedgeCancelled):
+                    first_error = error
+        raise first_error or HedgeCancelled()
+
+    def snapshot(self):
+        """
+        Hedging counters and current thresholds
+        对冲计数器与当前阈值
+        """
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['budgetTokens'] = round(self.budget._tokens, 2)
+        stats['thresholdsMs'] = {
+            endpoint: round(self.threshold(endpoint) * 1000, 1) for endpoint in sorted(self.endpoints)
+        }
+        return stats
+
+
+class FakeBackend:
+    """
+    Offline stand-in for an upstream model with a configurable latency distribution
+    可配置延迟分布的离线上游模型替身
+
+    Example 示例:
+        backend = FakeBackend(FakeBackend.lognormal(median=0.4, sigma=0.8))
+        hedger = Hedger(endpoints={'respond'})
+        hedger.call('respond', backend)
+
+    Args:
+        latency: Callable returning total latency in seconds 返回总延迟（秒）的可调用对象
+        first_token_fraction: Share of the latency spent before the first token 首个token前所占延迟比例
+        response: Text returned by every call 每次调用返回的文本
+    """
+
+    def __init__(self, latency, first_token_fraction=0.5, response='{"understood": true, "feedback": "ok"}'):
+        self.latency = latency
+        self.first_token_fraction = first_token_fraction
+        self.response = response
+        self.calls = 0
+        self.cancelled = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def lognormal(median, sigma, seed=None):
+        """Log-normal latency sampler with the given median 给定中位数的对数正态延迟采样器"""
+        rng = random.Random(seed)
+        mu = math.log(median)
+        return lambda: rng.lognormvariate(mu, sigma)
+
+    def _sleep(self, seconds, attempt):
+        end = time.monotonic() + seconds
+        while True:
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                return
+            if attempt.cancelled.wait(min(remaining, 0.01)):
+                with self._lock:
+                    self.cancelled += 1
+                raise HedgeCancelled()
+
+    def __call__(self, attempt):
+        with self._lock:
+            self.calls += 1
+        attempt.mark_started()
+        total = self.latency()
+        self._sleep(total * self.first_token_fraction, attempt)
+        attempt.mark_first_token()
+        self._sleep(total * (1 - self.first_token_fraction), attempt)
+        return self.response
@@ -0,0 +1,434 @@
+"""
+Learning History - persistent sessions, lessons, comments and Q&A turns
+学习历史 - 持久化的会话、课程、评论与问答轮次
+
+Everything a learner generates is kept on SQLite so a returning learner
+gets their lessons and history back from disk instead of regenerating
+them. Writes are queued and committed in batches by a background thread;
+reads use keyset pagination, and turns can also be streamed row by row.
+Reads never wait for the writer: lessons still in the queue are served from
+memory, and lists may lag writes by up to flush_interval.
+学习者生成的所有内容都保存在SQLite中，回访的学习者可以直接从磁盘取回课程和历史，而无需重新生成。
+写入先排队，再由后台线程批量提交；读取使用键集分页，轮次也可以逐行流式读取。
+读取从不等待写入线程：仍在队列中的课程从内存返回，列表最多滞后 flush_interval 秒。
+"""
+
+import atexit
+import json
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from .response_cache import normalize_input
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    mode TEXT NOT NULL DEFAULT '',
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_sessions_user_time ON sessions (user_id, updated_at);
+
+CREATE TABLE IF NOT EXISTS lessons (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    lesson_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    session_id TEXT NOT NULL DEFAULT '',
+    topic TEXT NOT NULL DEFAULT '',
+    topic_key TEXT NOT NULL DEFAULT '',
+    source TEXT NOT NULL DEFAULT '',
+    prompt_version TEXT NOT NULL DEFAULT '',
+    content TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    UNIQUE (user_id, lesson_id)
+);
+CREATE INDEX IF NOT EXISTS idx_lessons_user_time ON lessons (user_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_lessons_user_topic ON lessons (user_id, topic_key, created_at);
+
+CREATE TABLE IF NOT EXISTS comments (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    analysis_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    session_id TEXT NOT NULL DEFAULT '',
+    position INTEGER NOT NULL,
+    body TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_comments_user_time ON comments (user_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_comments_analysis ON comments (analysis_id, position);
+
+CREATE TABLE IF NOT EXISTS analyses (
+    id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    session_id TEXT NOT NULL DEFAULT '',
+    content TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_analyses_user_time ON analyses (user_id, created_at);
+
+CREATE TABLE IF NOT EXISTS turns (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    session_id TEXT NOT NULL DEFAULT '',
+    lesson_id TEXT NOT NULL DEFAULT '',
+    thread_id TEXT NOT NULL DEFAULT '',
+    kind TEXT NOT NULL,
+    message TEXT NOT NULL,
+    reply TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_turns_user_lesson ON turns (user_id, lesson_id, id);
+CREATE INDEX IF NOT EXISTS idx_turns_user_time ON turns (user_id, created_at);
+"""
+
+_UPSERT_SESSION = (
+    'INSERT INTO sessions (id, user_id, mode, created_at, updated_at) VALUES (?, ?, ?, ?, ?) '
+    'ON CONFLICT (id) DO UPDATE SET updated_at = excluded.updated_at, user_id = excluded.user_id'
+)
+
+
+def _encode_cursor(created_at, row_id):
+    return f'{created_at!r}:{row_id}'
+
+
+def _decode_cursor(cursor):
+    """
+    (created_at, id) from a page cursor, or None for the first page
+    从分页游标解析 (created_at, id)，首页时为None
+    """
+    if not cursor:
+        return None
+    try:
+        created_at, row_id = cursor.rsplit(':', 1)
+        return float(created_at), int(row_id)
+    except ValueError:
+        raise ValueError('Invalid cursor') from None
+
+
+class HistoryStore:
+    """
+    Write-behind store for learner history
+    学习历史的延迟写入存储
+
+    Args:
+        path: SQLite database file 数据库文件路径
+        flush_interval: Max seconds a write waits before being committed 写入提交前的最长等待秒数
+        batch_size: Max writes per transaction 每个事务的最大写入数
+    """
+
+    def __init__(self, path, flush_interval=0.5, batch_size=200):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._queue = queue.Queue()
+        # Queued lessons by (user id, lesson id), until committed 排队中的课程，按 (用户ID, 课程ID) 索引，直到提交
+        self._pending_lessons = {}
+        self._pending_lock = threading.Lock()
+        self.dropped = 0
+        with self._connection() as conn:
+            conn.executescript(_SCHEMA)
+            # Databases created before lessons kept their prompt version 在课程记录提示词版本之前创建的数据库
+            columns = {row['name'] for row in conn.execute('PRAGMA table_info(lessons)')}
+            if 'prompt_version' not in columns:
+                conn.execute("ALTER TABLE lessons ADD COLUMN prompt_version TEXT NOT NULL DEFAULT ''")
+        self._writer = threading.Thread(target=self._write_loop, name='history-writer', daemon=True)
+        self._writer.start()
+        atexit.register(self.flush)
+
+    @contextmanager
+    def _connection(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            yield conn
+        finally:
+            conn.close()
+
+    # ---------- Writes 写入 ----------
+
+    def _enqueue(self, user_id, session_id, mode, statements, pending=None):
+        now = time.time()
+        if session_id:
+            statements = [(_UPSERT_SESSION, (session_id, user_id, mode, now, now))] + statements
+        self._queue.put((statements, pending))
+
+    def _settle(self, pending):
+        # Committed (or dropped): the database is the source again 已提交（或已丢弃）：重新以数据库为准
+        key, lesson = pending
+        with self._pending_lock:
+            if self._pending_lessons.get(key) is lesson:
+                del self._pending_lessons[key]
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            batch = [] if item is None else [item]
+            deadline = time.monotonic() + self.flush_interval
+            # None is a flush marker: commit what we have right away None是刷新标记：立即提交已有内容
+            while item is not None and len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.task_done()
+                    break
+                batch.append(item)
+            if batch:
+                try:
+                    with self._connection() as conn:
+                        conn.execute('BEGIN')
+                        for statements, _ in batch:
+                            for sql, params in statements:
+                                conn.execute(sql, params)
+                        conn.execute('COMMIT')
+                except sqlite3.Error as e:
+                    print(f'History write failed 历史记录写入失败: {e}')
+                    self.dropped += len(batch)
+                for _, pending in batch:
+                    if pending is not None:
+                        self._settle(pending)
+            for _ in range(len(batch) or 1):
+                self._queue.task_done()
+
+    def flush(self, timeout=5.0):
+        """
+        Commit queued writes now and wait for them (used at shutdown)
+        立即提交排队中的写入并等待完成（关闭时调用）
+        """
+        if not self._queue.unfinished_tasks:
+            return
+        self._queue.put(None)
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.001)
+
+    def record_lesson(self, user_id, session_id, lesson_id, topic, content, source='teach', prompt_version=''):
+        """
+        Save a generated lesson (a repeat of the same lesson only refreshes its time)
+        保存生成的课程（重复的相同课程只刷新时间）
+
+        Args:
+            source: 'teach', 'image', 'document' or 'sectioned' 课程来源
+            prompt_version: Version of the prompt that generated it 生成课程所用提示词的版本
+        """
+        if not user_id or not content:
+            return
+        now = time.time()
+        key = (user_id, lesson_id)
+        lesson = {'lessonId': lesson_id, 'topic': topic or '', 'topicKey': normalize_input(topic),
+                  'source': source, 'promptVersion': prompt_version or '', 'createdAt': now, 'content': content}
+        with self._pending_lock:
+            self._pending_lessons[key] = lesson
+        self._enqueue(user_id, session_id, 'teacher', [(
+            'INSERT INTO lessons (lesson_id, user_id, session_id, topic, topic_key, source, prompt_version, '
+            'content, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT (user_id, lesson_id) DO UPDATE SET created_at = excluded.created_at, '
+            'session_id = excluded.session_id',
+            (lesson_id, user_id, session_id or '', topic or '', normalize_input(topic), source, prompt_version or '',
+             content, now)
+        )], pending=(key, lesson))
+
+    def record_analysis(self, user_id, session_id, content, comments):
+        """
+        Save an analysis of the learner's explanation and its comments
+        保存对学习者讲解的分析及其评论
+        """
+        if not user_id:
+            return
+        now = time.time()
+        analysis_id = uuid.uuid4().hex
+        statements = [(
+            'INSERT INTO analyses (id, user_id, session_id, content, created_at) VALUES (?, ?, ?, ?, ?)',
+            (analysis_id, user_id, session_id or '', content, now)
+        )]
+        for position, comment in enumerate(comments or []):
+            statements.append((
+                'INSERT INTO comments (analysis_id, user_id, session_id, position, body, created_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (analysis_id, user_id, session_id or '', position, json.dumps(comment, ensure_ascii=False), now)
+            ))
+        self._enqueue(user_id, session_id, 'student', statements)
+
+    def record_turn(self, user_id, session_id, kind, message, reply, lesson_id='', thread_id=''):
+        """
+        Save one Q&A turn: the learner's message and the structured reply
+        保存一个问答轮次：学习者的消息和结构化回复
+
+        Args:
+            kind: 'answer' (teacher mode) or 'respond' (student mode) 轮次类型
+            message: Learner's question or answer 学习者的问题或回答
+            reply: Reply dict as returned to the client 返回给客户端的回复字典
+            lesson_id: Lesson the turn belongs to 所属课程
+            thread_id: Student-mode question thread 学生模式的问题线程
+        """
+        if not user_id:
+            return
+        self._enqueue(user_id, session_id, 'teacher' if kind == 'answer' else 'student', [(
+            'INSERT INTO turns (user_id, session_id, lesson_id, thread_id, kind, message, reply, created_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (user_id, session_id or '', lesson_id or '', thread_id or '', kind, message,
+             json.dumps(reply, ensure_ascii=False), time.time())
+        )])
+
+    # ---------- Reads 读取 ----------
+
+    def find_lesson(self, user_id, topic, source='teach', prompt_version=''):
+        """
+        Learner's most recent lesson on a topic from one source and prompt version, or None
+        学习者关于某主题、来自指定来源和提示词版本的最新课程；没有时为None
+
+        Lessons made from images or documents, and lessons from an older
+        prompt, never stand in for a plain lesson on the same topic.
+        基于图片或文档生成的课程，以及旧版提示词生成的课程，都不会代替同主题的普通课程。
+        """
+        if not user_id:
+            return None
+        topic_key = normalize_input(topic)
+        with self._pending_lock:
+            pending = [lesson for (owner, _), lesson in self._pending_lessons.items()
+                       if owner == user_id and lesson['topicKey'] == topic_key and lesson['source'] == source
+                       and lesson['promptVersion'] == (prompt_version or '')]
+        with self._connection() as conn:
+            row = conn.execute(
+                'SELECT * FROM lessons WHERE user_id = ? AND topic_key = ? AND source = ? AND prompt_version = ? '
+                'ORDER BY created_at DESC LIMIT 1',
+                (user_id, topic_key, source, prompt_version or '')
+            ).fetchone()
+        stored = self._lesson(row, include_content=True)
+        candidates = [self._pending_copy(lesson) for lesson in pending] + ([stored] if stored else [])
+        return max(candidates, key=lambda lesson: lesson['createdAt']) if candidates else None
+
+    def get_lesson(self, user_id, lesson_id):
+        with self._pending_lock:
+            pending = self._pending_lessons.get((user_id, lesson_id))
+        if pending is not None:
+            return self._pending_copy(pending)
+        with self._connection() as conn:
+            row = conn.execute(
+                'SELECT * FROM lessons WHERE user_id = ? AND lesson_id = ?', (user_id, lesson_id)
+            ).fetchone()
+        return self._lesson(row, include_content=True)
+
+    @staticmethod
+    def _pending_copy(lesson):
+        return {k: v for k, v in lesson.items() if k not in ('topicKey', 'promptVersion')}
+
+    @staticmethod
+    def _lesson(row, include_content=False):
+        if row is None:
+            return None
+        lesson = {
+            'lessonId': row['lesson_id'],
+            'topic': row['topic'],
+            'source': row['source'],
+            'createdAt': row['created_at'],
+        }
+        if include_content:
+            lesson['content'] = row['content']
+        else:
+            lesson['preview'] = row['content'][:200]
+        return lesson
+
+    def recent_lessons(self, user_id, limit=20, cursor=None):
+        """
+        A page of the learner's lessons, newest first
+        学习者课程的一页，最新的在前
+
+        Returns:
+            tuple: (lessons, next cursor or None) (课程列表, 下一页游标)
+        """
+        after = _decode_cursor(cursor)
+        sql = 'SELECT * FROM lessons WHERE user_id = ?'
+        params = [user_id]
+        if after:
+            sql += ' AND (created_at, id) < (?, ?)'
+            params.extend(after)
+        sql += ' ORDER BY created_at DESC, id DESC LIMIT ?'
+        with self._connection() as conn:
+            rows = conn.execute(sql, params + [limit + 1]).fetchall()
+        next_cursor = _encode_cursor(rows[limit - 1]['created_at'], rows[limit - 1]['id']) if len(rows) > limit else None
+        return [self._lesson(row) for row in rows[:limit]], next_cursor
+
+    def recent_analyses(self, user_id, limit=10, cursor=None):
+        """
+        A page of the learner's analyses with their comments, newest first
+        学习者分析及其评论的一页，最新的在前
+
+        Returns:
+            tuple: (analyses, next cursor or None) (分析列表, 下一页游标)
+        """
+        after = _decode_cursor(cursor)
+        sql = 'SELECT rowid, * FROM analyses WHERE user_id = ?'
+        params = [user_id]
+        if after:
+            sql += ' AND (created_at, rowid) < (?, ?)'
+            params.extend(after)
+        sql += ' ORDER BY created_at DESC, rowid DESC LIMIT ?'
+        with self._connection() as conn:
+            rows = conn.execute(sql, params + [limit + 1]).fetchall()
+            analyses = []
+            for row in rows[:limit]:
+                comments = conn.execute(
+                    'SELECT body FROM comments WHERE analysis_id = ? ORDER BY position', (row['id'],)
+                ).fetchall()
+                analyses.append({
+                    'analysisId': row['id'],
+                    'content': row['content'],
+                    'comments': [json.loads(c['body']) for c in comments],
+                    'createdAt': row['created_at'],
+                })
+        next_cursor = _encode_cursor(rows[limit - 1]['created_at'], rows[limit - 1]['rowid']) if len(rows) > limit else None
+        return analyses, next_cursor
+
+    @staticmethod
+    def _turn(row):
+        return {
+            'turnId': row['id'],
+            'kind': row['kind'],
+            'lessonId': row['lesson_id'],
+            'threadId': row['thread_id'],
+            'message': row['message'],
+            'reply': json.loads(row['reply']),
+            'createdAt': row['created_at'],
+        }
+
+    def turns(self, user_id, lesson_id='', limit=50, after=0):
+        """
+        A page of turns in a lesson (or student-mode turns when lesson_id is ''), oldest first
+        某课程中轮次的一页（lesson_id 为空时为学生模式轮次），最早的在前
+
+        Returns:
+            tuple: (turns, next cursor or None) (轮次列表, 下一页游标)
+        """
+        with self._connection() as conn:
+            rows = conn.execute(
+                'SELECT * FROM turns WHERE user_id = ? AND lesson_id = ? AND id > ? ORDER BY id LIMIT ?',
+                (user_id, lesson_id or '', int(after or 0), limit + 1)
+            ).fetchall()
+        next_cursor = str(rows[limit - 1]['id']) if len(rows) > limit else None
+        return [self._turn(row) for row in rows[:limit]], next_cursor
+
+    def iter_turns(self, user_id, lesson_id='', chunk_size=200):
+        """
+        Stream every turn of a lesson without loading them all at once
+        流式读取课程的所有轮次，而不一次性全部载入
+        """
+        with self._connection() as conn:
+            cursor = conn.execute(
+                'SELECT * FROM turns WHERE user_id = ? AND lesson_id = ? ORDER BY id',
+                (user_id, lesson_id or '')
+            )
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield self._turn(row)
@@ -0,0 +1,534 @@
+"""
+Background Jobs - SQLite-backed durable queue with a worker process pool
+后台任务 - 基于SQLite的持久队列与工作进程池
+
+Long analyses and lessons are submitted as jobs instead of holding an HTTP
+connection open. Jobs survive restarts: a worker claims a job with a lease,
+and a job whose worker died is re-claimed once the lease expires. Results
+are kept for a TTL; idempotency keys make resubmission safe.
+长时间的分析和课程以任务形式提交，而不是一直占用HTTP连接。任务在重启后依然存在：
+工作进程以租约方式领取任务，若工作进程崩溃，租约到期后任务会被重新领取。
+结果保留一段时间（TTL）；幂等键使重复提交是安全的。
+
+Workers do not run their own admission control: each one is connected to
+the web process by a pipe, and its upstream calls wait for a slot in the
+web tier's scheduler, so background work yields to interactive traffic.
+工作进程不自行做准入控制：每个工作进程通过管道连接到Web进程，其上游调用在Web层的调度器中
+等待槽位，因此后台工作会让位于交互流量。
+"""
+
+import importlib
+import importlib.machinery
+import json
+import multiprocessing
+import os
+import signal
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+import uuid
+from contextlib import contextmanager
+
+STATUS_QUEUED = 'queued'
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    idempotency_key TEXT UNIQUE,
+    session_id TEXT NOT NULL DEFAULT '',
+    result TEXT,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    lease_until REAL,
+    expires_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_claim ON jobs (status, created_at);
+CREATE INDEX IF NOT EXISTS idx_jobs_expires ON jobs (expires_at);
+CREATE INDEX IF NOT EXISTS idx_jobs_updated ON jobs (updated_at);
+"""
+
+
+class JobStore:
+    """
+    Durable job table; safe to share between threads and processes
+    持久任务表；可在线程和进程之间共享
+
+    Args:
+        path: SQLite database file 数据库文件路径
+        result_ttl: Seconds finished jobs are kept 已完成任务的保留秒数
+        lease_seconds: How long a claimed job is reserved for its worker 已领取任务为工作进程保留的时长
+        max_attempts: Attempts before a job is marked failed 任务标记为失败前的最大尝试次数
+    """
+
+    def __init__(self, path, result_ttl=86400, lease_seconds=600, max_attempts=3):
+        self.path = path
+        self.result_ttl = result_ttl
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        with self._connection() as conn:
+            conn.executescript(_SCHEMA)
+
+    @contextmanager
+    def _connection(self):
+        conn = self._connect()
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    @staticmethod
+    def _to_dict(row, include_payload=False):
+        if row is None:
+            return None
+        job = {
+            'jobId': row['id'],
+            'kind': row['kind'],
+            'status': row['status'],
+            'attempts': row['attempts'],
+            'createdAt': row['created_at'],
+            'updatedAt': row['updated_at'],
+        }
+        if row['result'] is not None:
+            job['result'] = json.loads(row['result'])
+        if row['error'] is not None:
+            job['error'] = row['error']
+        if include_payload:
+            job['payload'] = json.loads(row['payload'])
+            job['sessionId'] = row['session_id']
+        return job
+
+    def submit(self, kind, payload, idempotency_key=None, session_id=''):
+        """
+        Queue a job, or return the existing one for the same idempotency key
+        将任务加入队列；若幂等键已存在则返回已有任务
+
+        Returns:
+            tuple: (job dict, created bool) (任务字典, 是否新建)
+        """
+        now = time.time()
+        job_id = uuid.uuid4().hex
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            if idempotency_key:
+                row = conn.execute(
+                    'SELECT * FROM jobs WHERE idempotency_key = ?', (idempotency_key,)
+                ).fetchone()
+                if row is not None and (row['expires_at'] is None or row['expires_at'] > now):
+                    conn.execute('COMMIT')
+                    return self._to_dict(row), False
+                if row is not None:
+                    # Expired result: the key may be reused 结果已过期：键可以复用
+                    conn.execute('DELETE FROM jobs WHERE id = ?', (row['id'],))
+            conn.execute(
+                'INSERT INTO jobs (id, kind, payload, status, idempotency_key, session_id, created_at, updated_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (job_id, kind, json.dumps(payload, ensure_ascii=False), STATUS_QUEUED,
+                 idempotency_key or None, session_id or '', now, now)
+            )
+            row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            conn.execute('COMMIT')
+            return self._to_dict(row), True
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    def get(self, job_id):
+        """
+        Job status and result, or None if unknown or expired
+        任务状态和结果；未知或已过期时返回None
+        """
+        with self._connection() as conn:
+            row = conn.execute(
+                'SELECT * FROM jobs WHERE id = ? AND (expires_at IS NULL OR expires_at > ?)',
+                (job_id, time.time())
+            ).fetchone()
+        return self._to_dict(row)
+
+    def claim(self):
+        """
+        Lease the oldest runnable job (queued, or running with an expired lease)
+        以租约方式领取最早的可运行任务（排队中，或租约已过期的运行中任务）
+
+        Returns:
+            dict or None: Job including payload 包含负载的任务
+        """
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute(
+                'SELECT * FROM jobs WHERE status = ? OR (status = ? AND lease_until < ?) '
+                'ORDER BY created_at LIMIT 1',
+                (STATUS_QUEUED, STATUS_RUNNING, now)
+            ).fetchone()
+            if row is None:
+                conn.execute('COMMIT')
+                return None
+            if row['attempts'] >= self.max_attempts:
+                # Worker died on every attempt 每次尝试工作进程都崩溃
+                conn.execute(
+                    'UPDATE jobs SET status = ?, error = ?, payload = ?, updated_at = ?, expires_at = ? WHERE id = ?',
+                    (STATUS_FAILED, 'Job abandoned after repeated worker failures', '{}',
+                     now, now + self.result_ttl, row['id'])
+                )
+                conn.execute('COMMIT')
+                return None
+            conn.execute(
+                'UPDATE jobs SET status = ?, attempts = attempts + 1, lease_until = ?, updated_at = ? WHERE id = ?',
+                (STATUS_RUNNING, now + self.lease_seconds, now, row['id'])
+            )
+            row = conn.execute('SELECT * FROM jobs WHERE id = ?', (row['id'],)).fetchone()
+            conn.execute('COMMIT')
+            return self._to_dict(row, include_payload=True)
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    def finish(self, job_id, result=None, error=None):
+        """
+        Store a job's result (or error) and drop its payload, which may hold an API key
+        保存任务结果（或错误）并删除其负载（负载中可能含有API密钥）
+        """
+        now = time.time()
+        with self._connection() as conn:
+            conn.execute(
+                'UPDATE jobs SET status = ?, result = ?, error = ?, payload = ?, lease_until = NULL, '
+                'updated_at = ?, expires_at = ? WHERE id = ?',
+                (STATUS_FAILED if error is not None else STATUS_DONE,
+                 json.dumps(result, ensure_ascii=False) if error is None else None,
+                 error, '{}', now, now + self.result_ttl, job_id)
+            )
+
+    def set_result(self, job_id, result):
+        """
+        Replace a finished job's result (web-side additions such as a lesson id)
+        替换已完成任务的结果（Web端补充的内容，如课程ID）
+        """
+        with self._connection() as conn:
+            conn.execute('UPDATE jobs SET result = ? WHERE id = ?',
+                         (json.dumps(result, ensure_ascii=False), job_id))
+
+    def finished_since(self, since):
+        """
+        Jobs finished after a timestamp, for notifying sessions
+        某时间戳之后完成的任务，用于通知会话
+
+        Returns:
+            list: (job id, kind, status, session id, updated_at) 任务元组列表
+        """
+        with self._connection() as conn:
+            rows = conn.execute(
+                'SELECT id, kind, status, session_id, updated_at FROM jobs '
+                'WHERE updated_at > ? AND status IN (?, ?) ORDER BY updated_at',
+                (since, STATUS_DONE, STATUS_FAILED)
+            ).fetchall()
+        return [tuple(row) for row in rows]
+
+    def purge_expired(self):
+        """
+        Delete jobs whose results have expired
+        删除结果已过期的任务
+        """
+        with self._connection() as conn:
+            return conn.execute('DELETE FROM jobs WHERE expires_at < ?', (time.time(),)).rowcount
+
+    def counts(self):
+        """
+        Number of jobs per status
+        每种状态的任务数量
+        """
+        with self._connection() as conn:
+            rows = conn.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall()
+        return {status: count for status, count in rows}
+
+
+def detach_main_module():
+    """
+    Stop spawned processes from re-running the script that started the server
+    阻止派生进程重新执行启动服务的脚本
+
+    A spawned child imports the parent's __main__ script as __mp_main__
+    before running its target; with `python app.py` that repeats the whole
+    web setup in every worker. Targets here live in importable modules, so
+    __main__ is given a spec named '__main__', which multiprocessing skips.
+    派生的子进程在运行目标函数前会将父进程的 __main__ 脚本作为 __mp_main__ 导入；使用 `python app.py` 启动时，
+    这会在每个工作进程中重复全部Web初始化。这里的目标函数都位于可导入的模块中，因此为 __main__ 设置名为
+    '__main__' 的spec，multiprocessing 会跳过该步骤。
+    """
+    main = sys.modules.get('__main__')
+    if main is not None and getattr(main, '__spec__', None) is None:
+        main.__spec__ = importlib.machinery.ModuleSpec('__main__', None)
+
+
+class BrokerError(RuntimeError):
+    """
+    A web-side broker function failed (e.g. the API key was rejected)
+    Web端代理函数失败（如API密钥被拒绝）
+    """
+
+
+class UpstreamClient:
+    """
+    Worker end of the broker pipe: scheduler slots and calls into the web process
+    代理管道的工作进程端：调度槽位以及对Web进程的调用
+
+    Args:
+        conn: multiprocessing Connection 多进程连接
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._lock = threading.Lock()
+
+    def call(self, name, *args):
+        """
+        Run a broker function in the web process and return its result
+        在Web进程中运行代理函数并返回结果
+
+        Raises:
+            BrokerError: The function raised 函数抛出异常
+        """
+        with self._lock:
+            self._conn.send(('call', name, args))
+            status, value = self._conn.recv()
+        if status == 'error':
+            raise BrokerError(value)
+        return value
+
+    def notify(self, name, *args):
+        """
+        Run a broker function without waiting for it 运行代理函数但不等待
+        """
+        with self._lock:
+            self._conn.send(('notify', name, args))
+
+    @contextmanager
+    def slot(self, lane, api_key='', session_id=''):
+        """
+        Hold a slot of the web tier's UpstreamScheduler for the block
+        在代码块期间占用Web层 UpstreamScheduler 的一个槽位
+        """
+        self.call('acquire', lane, api_key, session_id)
+        try:
+            yield
+        finally:
+            self.notify('release')
+
+
+def serve_broker(conn, scheduler, functions):
+    """
+    Web end of a worker's broker pipe; runs on a thread until the worker exits
+    工作进程代理管道的Web端；在线程中运行直到工作进程退出
+
+    Slots still held when the worker dies are given back.
+    工作进程退出时仍占用的槽位会被归还。
+
+    Args:
+        conn: multiprocessing Connection 多进程连接
+        scheduler: UpstreamScheduler granting slots 分配槽位的上游调度器
+        functions: {name: fn} callable by workers 可供工作进程调用的函数
+    """
+    held = []
+    try:
+        while True:
+            kind, name, args = conn.recv()
+            if name == 'acquire':
+                try:
+                    slot = scheduler.slot(*args)
+                    slot.__enter__()
+                except Exception as e:
+                    conn.send(('error', str(e)))
+                    continue
+                held.append(slot)
+                conn.send(('ok', None))
+            elif name == 'release':
+                if held:
+                    held.pop().__exit__(None, None, None)
+            elif kind == 'call':
+                try:
+                    conn.send(('ok', functions[name](*args)))
+                except Exception as e:
+                    conn.send(('error', str(e)))
+            else:
+                try:
+                    functions[name](*args)
+                except Exception:
+                    traceback.print_exc()
+    except (EOFError, OSError):
+        pass
+    finally:
+        while held:
+            held.pop().__exit__(None, None, None)
+        conn.close()
+
+
+def worker_main(db_path, handler_module, handler_attr, poll_interval=1.0, store_options=None, stop_event=None,
+                upstream_conn=None):
+    """
+    Worker process loop: claim, run, store result, repeat
+    工作进程循环：领取、执行、保存结果，循环往复
+
+    Handlers are looked up by importing handler_module in the worker. It
+    should be a small module: importing the web app would repeat its whole
+    setup in every worker.
+    处理函数通过在工作进程中导入 handler_module 获取。它应是一个小模块：导入Web应用会在每个工作进程中重复其全部初始化。
+
+    Args:
+        db_path: SQLite database file 数据库文件路径
+        handler_module: Module defining the handlers, e.g. 'job_worker' 定义处理函数的模块
+        handler_attr: Name of its {kind: fn(job, upstream) -> result} dict 其 {类型: 处理函数} 字典的名字
+        poll_interval: Seconds to sleep when the queue is empty 队列为空时的休眠秒数
+        store_options: JobStore keyword arguments JobStore 关键字参数
+        stop_event: Event set when the worker should exit after its current job 设置后工作进程在当前任务完成后退出
+        upstream_conn: Broker pipe to the web process, wrapped in UpstreamClient 到Web进程的代理管道
+    """
+    # SIGTERM finishes the running job instead of abandoning it (its lease would re-run it)
+    # SIGTERM 会先完成正在运行的任务，而不是丢弃它（租约到期后会被重新执行）
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    
+    def should_stop():
+        return stopping.is_set() or (stop_event is not None and stop_event.is_set())
+
+    handlers = getattr(importlib.import_module(handler_module), handler_attr)
+    upstream = UpstreamClient(upstream_conn) if upstream_conn is not None else None
+    store = JobStore(db_path, **(store_options or {}))
+    last_purge = 0.0
+
+    while not should_stop():
+        if time.time() - last_purge > 300:
+            store.purge_expired()
+            last_purge = time.time()
+
+        job = store.claim()
+        if job is None:
+            if stop_event is not None:
+                stop_event.wait(poll_interval)
+            else:
+                time.sleep(poll_interval)
+            continue
+
+        handler = handlers.get(job['kind'])
+        if handler is None:
+            store.finish(job['jobId'], error=f"Unknown job kind: {job['kind']}")
+            continue
+        try:
+            store.finish(job['jobId'], result=handler(job, upstream))
+        except Exception as e:
+            print(f'===== Background Job Error 后台任务错误 =====')
+            print(f"Job 任务: {job['jobId']} ({job['kind']})")
+            traceback.print_exc()
+            print(f'=====================')
+            store.finish(job['jobId'], error=str(e))
+
+
+class JobWorkerPool:
+    """
+    Fixed pool of worker processes, restarted if one dies
+    固定大小的工作进程池，进程退出时自动重启
+
+    Args:
+        store: JobStore (its path and options are passed to workers) 任务存储
+        workers: Number of processes 进程数
+        handler_module: Module defining the handlers 定义处理函数的模块
+        handler_attr: Name of the handler dict 处理函数字典的名字
+        scheduler: UpstreamScheduler whose slots workers' calls wait for 工作进程调用所等待的上游调度器
+        functions: Broker functions workers may call, see UpstreamClient 工作进程可调用的代理函数
+    """
+
+    def __init__(self, store, workers, handler_module, handler_attr, scheduler=None, functions=None):
+        self.store = store
+        self.workers = workers
+        self.handler_module = handler_module
+        self.handler_attr = handler_attr
+        self.scheduler = scheduler
+        self.functions = functions or {}
+        # Spawn, not fork: the web process already runs threads 使用spawn而非fork：Web进程已有多个线程
+        self._context = multiprocessing.get_context('spawn')
+        self._processes = []
+        self._stop_event = self._context.Event()
+
+    def _start_one(self):
+        kwargs = {'store_options': {
+            'result_ttl': self.store.result_ttl,
+            'lease_seconds': self.store.lease_seconds,
+            'max_attempts': self.store.max_attempts,
+        }, 'stop_event': self._stop_event}
+        if self.scheduler is not None:
+            broker_conn, kwargs['upstream_conn'] = self._context.Pipe()
+        process = self._context.Process(
+            target=worker_main,
+            args=(self.store.path, self.handler_module, self.handler_attr),
+            kwargs=kwargs,
+            daemon=True
+        )
+        process.start()
+        if self.scheduler is not None:
+            # Only the worker keeps its end, so its exit closes the pipe 只有工作进程保留其一端，因此其退出会关闭管道
+            kwargs['upstream_conn'].close()
+            threading.Thread(target=serve_broker, args=(broker_conn, self.scheduler, self.functions),
+                             name='job-broker', daemon=True).start()
+        return process
+
+    def start(self):
+        self._processes = [self._start_one() for _ in range(self.workers)]
+        return self
+
+    def ensure_alive(self):
+        """
+        Replace dead workers 替换已退出的工作进程
+        """
+        if self._stop_event.is_set():
+            return
+        for i, process in enumerate(self._processes):
+            if not process.is_alive():
+                self._processes[i] = self._start_one()
+
+    def alive(self):
+        return sum(1 for p in self._processes if p.is_alive())
+
+    def drain(self, timeout=30.0):
+        """
+        Let workers finish their current job and exit; terminate stragglers at the deadline
+        让工作进程完成当前任务后退出；截止时间到达后终止仍未退出的进程
+
+        Returns:
+            bool: True if every worker exited in time 所有工作进程按时退出时返回True
+        """
+        self._stop_event.set()
+        deadline = time.monotonic() + timeout
+        for process in self._processes:
+            process.join(max(deadline - time.monotonic(), 0))
+        clean = self.alive() == 0
+        if not clean:
+            # Abandoned jobs are retried once their lease expires 被放弃的任务在租约到期后重试
+            self.stop()
+        return clean
+
+    def stop(self, timeout=5.0):
+        for process in self._processes:
+            process.terminate()
+        for process in self._processes:
+            process.join(timeout)
@@ -0,0 +1,175 @@
+"""
+Lifecycle - readiness, graceful draining and signal handling
+生命周期 - 就绪状态、优雅排空与信号处理
+
+On SIGTERM the server turns not-ready and answers new /api/ work with
+503, while requests already running (including streamed bodies) finish
+within a deadline; then the process exits. Load balancers see readiness
+fail first and stop routing here, so a deploy neither cuts generations
+short nor pays for them twice. SIGHUP reloads configuration in place.
+收到 SIGTERM 时，服务变为未就绪并对新的 /api/ 请求返回503，已在运行的请求（包括流式响应体）
+在截止时间内完成，然后进程退出。负载均衡器会先看到就绪检查失败并停止向此处路由，
+因此部署既不会中断生成，也不会为其重复付费。SIGHUP 会就地重新加载配置。
+"""
+
+import os
+import signal
+import threading
+import time
+
+from flask import g, jsonify, request
+
+STATE_STARTING = 'starting'
+STATE_READY = 'ready'
+STATE_DRAINING = 'draining'
+
+
+class Lifecycle:
+    """
+    Process state plus a count of in-flight requests
+    进程状态以及进行中的请求计数
+
+    Args:
+        drain_timeout: Seconds in-flight work may take to finish once draining 排空时进行中工作的最长完成秒数
+    """
+
+    def __init__(self, drain_timeout=30.0):
+        self.drain_timeout = drain_timeout
+        self.state = STATE_STARTING
+        self.started_at = time.time()
+        self.drain_started_at = None
+        self.rejected = 0
+        self._inflight = 0
+        self._idle = threading.Condition()
+
+    @property
+    def ready(self):
+        return self.state == STATE_READY
+
+    @property
+    def draining(self):
+        return self.state == STATE_DRAINING
+
+    def mark_ready(self):
+        if self.state == STATE_STARTING:
+            self.state = STATE_READY
+
+    def begin_drain(self):
+        """
+        Stop accepting new work; returns False if already draining
+        停止接受新工作；已在排空时返回False
+        """
+        with self._idle:
+            if self.state == STATE_DRAINING:
+                return False
+            self.state = STATE_DRAINING
+            self.drain_started_at = time.time()
+            self._idle.notify_all()
+            return True
+
+    def enter(self):
+        with self._idle:
+            self._inflight += 1
+
+    def leave(self):
+        with self._idle:
+            self._inflight -= 1
+            self._idle.notify_all()
+
+    @property
+    def inflight(self):
+        with self._idle:
+            return self._inflight
+
+    def wait_idle(self, timeout=None, busy=None):
+        """
+        Wait until no request is in flight (and busy() is 0), or the timeout
+        等待直到没有进行中的请求（且 busy() 为0），或超时
+
+        Args:
+            timeout: Max seconds, default drain_timeout 最长秒数，默认 drain_timeout
+            busy: Optional fn() -> count of other in-flight work (e.g. WebSocket turns)
+                  可选函数，返回其他进行中工作的数量（如WebSocket轮次）
+
+        Returns:
+            bool: True if idle, False if the deadline passed 空闲时返回True，超时返回False
+        """
+        deadline = time.monotonic() + (self.drain_timeout if timeout is None else timeout)
+        with self._idle:
+            while True:
+                if self._inflight <= 0 and (busy is None or busy() == 0):
+                    return True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                # Short waits so busy() is re-polled 短暂等待以便重新检查 busy()
+                self._idle.wait(min(remaining, 0.2))
+
+    def snapshot(self):
+        return {
+            'state': self.state,
+            'uptimeSeconds': round(time.time() - self.started_at, 1),
+            'inflight': self.inflight,
+            'rejected': self.rejected,
+            'drainingForSeconds': round(time.time() - self.drain_started_at, 1) if self.drain_started_at else None,
+            'drainTimeout': self.drain_timeout,
+        }
+
+
+def install_lifecycle(app, lifecycle, exempt_prefixes=(), retry_after=5):
+    """
+    Count in-flight /api/ requests and refuse new ones while draining
+    统计进行中的 /api/ 请求，并在排空期间拒绝新请求
+
+    The count is released in teardown_request, which Flask runs after a
+    streamed body is fully sent, so streams are waited for as well.
+    计数在 teardown_request 中释放，Flask 在流式响应体完全发送后才运行它，因此流式响应也会被等待。
+
+    Args:
+        app: Flask app Flask应用
+        lifecycle: Lifecycle 生命周期对象
+        exempt_prefixes: Paths always served and not counted (health, admin) 始终服务且不计数的路径前缀（健康检查、管理）
+        retry_after: Retry-After seconds on 503 503响应的 Retry-After 秒数
+    """
+    @app.before_request
+    def gate_request():
+        if not request.path.startswith('/api/') or request.path.startswith(tuple(exempt_prefixes)):
+            return None
+        if lifecycle.draining:
+            lifecycle.rejected += 1
+            response = jsonify({'error': '服务正在重启', 'message': 'Server is restarting, please retry'})
+            response.status_code = 503
+            response.headers['Retry-After'] = str(retry_after)
+            response.headers['Connection'] = 'close'
+            return response
+        lifecycle.enter()
+        g.lifecycle_tracked = True
+        return None
+
+    @app.teardown_request
+    def release_request(exc):
+        if g.pop('lifecycle_tracked', False):
+            lifecycle.leave()
+
+
+def install_signal_handlers(on_terminate, on_reload=None):
+    """
+    SIGTERM runs on_terminate() on a background thread (a second SIGTERM
+    exits at once); SIGHUP runs on_reload()
+    SIGTERM 在后台线程运行 on_terminate()（第二次 SIGTERM 立即退出）；SIGHUP 运行 on_reload()
+
+    Must be called from the main thread. 必须在主线程调用。
+    """
+    terminating = threading.Event()
+
+    def handle_term(signum, frame):
+        if terminating.is_set():
+            os._exit(128 + signum)
+        terminating.set()
+        threading.Thread(target=on_terminate, name='drain', daemon=True).start()
+
+    signal.signal(signal.SIGTERM, handle_term)
+    if on_reload is not None and hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(
+            target=on_reload, name='reload', daemon=True
+        ).start())
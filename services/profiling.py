@@ -0,0 +1,400 @@
+"""
+Profiling - on-demand CPU sampling, per-request cProfile and memory snapshots
+性能剖析 - 按需CPU采样、单请求cProfile与内存快照
+
+Everything here is standard library and off until an admin turns it on.
+Captures are saved as files: collapsed stacks (one "frame;frame;frame
+count" line per stack, readable by flamegraph.pl, speedscope and inferno),
+a rendered SVG flamegraph, raw pstats and a text summary.
+这里的一切只使用标准库，并且在管理员开启前处于关闭状态。采集结果保存为文件：折叠栈（每个栈一行
+"frame;frame;frame count"，可被 flamegraph.pl、speedscope 和 inferno 读取）、渲染好的SVG火焰图、
+原始pstats以及文本摘要。
+
+The sampler also records how late each sample wakes up: a thread that
+should wake every few milliseconds but is consistently late is waiting for
+the GIL, which tells CPU contention apart from upstream waits.
+采样器还会记录每次采样的唤醒延迟：本应每几毫秒唤醒一次却持续迟到的线程在等待GIL，
+据此可以区分CPU争用与上游等待。
+"""
+
+import cProfile
+import html
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+import zlib
+
+FORMAT_COLLAPSED = 'collapsed'
+FORMAT_SVG = 'svg'
+FORMAT_PSTATS = 'pstats'
+FORMAT_TEXT = 'txt'
+FORMATS = {
+    FORMAT_COLLAPSED: 'text/plain; charset=utf-8',
+    FORMAT_SVG: 'image/svg+xml',
+    FORMAT_PSTATS: 'application/octet-stream',
+    FORMAT_TEXT: 'text/plain; charset=utf-8',
+}
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+def _stack(frame):
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    labels.reverse()
+    return labels
+
+
+def _percentile_ms(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return round(values[min(int(q * len(values)), len(values) - 1)] * 1000, 2)
+
+
+class SamplingProfiler:
+    """
+    Wall-clock stack sampler over sys._current_frames()
+    基于 sys._current_frames() 的挂钟栈采样器
+
+    Args:
+        interval: Seconds between samples 采样间隔秒数
+        thread_ids: Only sample these threads (None = all but the sampler) 只采样这些线程（None为除采样器外所有线程）
+        max_seconds: Stop sampling on its own after this long (None = never) 超过该时长后自动停止采样（None为不限）
+    """
+
+    def __init__(self, interval=0.005, thread_ids=None, max_seconds=None):
+        self.interval = interval
+        self.thread_ids = set(thread_ids) if thread_ids else None
+        self.max_seconds = max_seconds
+        self.stacks = {}   # collapsed stack -> samples 折叠栈 -> 样本数
+        self.lags = []     # seconds each wake-up was late 每次唤醒的迟到秒数
+        self.samples = 0
+        self.started_at = None
+        self.stopped_at = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        self.started_at = time.time()
+        self._thread = threading.Thread(target=self._run, name='profiler-sampler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.stopped_at = time.time()
+        return self
+
+    def _run(self):
+        own_id = threading.get_ident()
+        names = {}
+        next_at = time.perf_counter()
+        deadline = next_at + self.max_seconds if self.max_seconds else None
+        while not self._stop.is_set() and (deadline is None or next_at < deadline):
+            next_at += self.interval
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                self._stop.wait(delay)
+            woke = time.perf_counter()
+            if len(self.lags) < 100000:
+                self.lags.append(max(woke - next_at, 0.0))
+            if woke - next_at > self.interval * 10:
+                # Far behind (e.g. a long GIL hold): resync instead of bursting 大幅落后（如长时间持有GIL）：重新同步而不是连续补采
+                next_at = woke
+            if len(names) != threading.active_count():
+                names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id or (self.thread_ids is not None and thread_id not in self.thread_ids):
+                    continue
+                key = ';'.join([names.get(thread_id, str(thread_id))] + _stack(frame))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+
+    def collapsed(self):
+        """
+        Samples in collapsed-stack format 折叠栈格式的样本
+        """
+        return ''.join(f'{stack} {count}\n' for stack, count in sorted(self.stacks.items()))
+
+    def summary(self):
+        duration = (self.stopped_at or time.time()) - (self.started_at or time.time())
+        return {
+            'samples': self.samples,
+            'stacks': len(self.stacks),
+            'intervalMs': self.interval * 1000,
+            'durationSeconds': round(duration, 3),
+            # Sampler wake-up lag: high values mean GIL contention 采样器唤醒延迟：值高说明GIL争用
+            'lagP50Ms': _percentile_ms(self.lags, 0.50),
+            'lagP95Ms': _percentile_ms(self.lags, 0.95),
+            'lagMaxMs': round(max(self.lags) * 1000, 2) if self.lags else 0.0,
+        }
+
+
+class RequestProfile:
+    """
+    cProfile plus a stack sampler for one request, on the request's thread
+    单个请求的cProfile加栈采样，作用于请求所在线程
+
+    Wall time against the thread's CPU time shows how much of a request was
+    Python work and how much was waiting (upstream calls, locks, the GIL).
+    挂钟时间与线程CPU时间的对比可以显示请求中有多少是Python计算、有多少是等待（上游调用、锁、GIL）。
+    """
+
+    def __init__(self, label, interval=0.002):
+        self.label = label
+        self.profile = cProfile.Profile()
+        self.sampler = SamplingProfiler(interval, thread_ids={threading.get_ident()})
+        self._wall = None
+        self._cpu = None
+
+    def start(self):
+        self.sampler.start()
+        self._wall = time.perf_counter()
+        self._cpu = time.thread_time()
+        self.profile.enable()
+        return self
+
+    def stop(self):
+        self.profile.disable()
+        self._cpu = time.thread_time() - self._cpu
+        self._wall = time.perf_counter() - self._wall
+        self.sampler.stop()
+        return self
+
+    def report(self, limit=40):
+        out = io.StringIO()
+        out.write(f'{self.label}\n')
+        out.write(f'wall {self._wall * 1000:.1f} ms, thread CPU {self._cpu * 1000:.1f} ms, '
+                  f'waiting {max(self._wall - self._cpu, 0) * 1000:.1f} ms\n')
+        out.write(f'sampler {self.sampler.summary()}\n\n')
+        stats = pstats.Stats(self.profile, stream=out)
+        stats.sort_stats('cumulative').print_stats(limit)
+        stats.sort_stats('tottime').print_stats(limit)
+        return out.getvalue()
+
+
+class MemoryTracer:
+    """
+    tracemalloc start/snapshot/stop with a diff against the starting snapshot
+    tracemalloc 启动/快照/停止，并与起始快照做差异比较
+
+    tracemalloc is process-wide, so one capture runs at a time: start() is
+    refused while another owner holds it, and only that owner can stop it.
+    tracemalloc 是进程级的，因此同一时间只运行一个采集：其他所有者持有时 start() 会被拒绝，
+    且只有该所有者可以停止它。
+    """
+
+    def __init__(self):
+        self._baseline = None
+        self._owner = None
+        self._lock = threading.Lock()
+
+    @property
+    def tracing(self):
+        return self._owner is not None
+
+    @property
+    def owner(self):
+        return self._owner
+
+    def start(self, owner, frames=10):
+        """
+        Begin a capture for owner 为所有者开始一次采集
+
+        Returns:
+            bool: False if another capture (or tracemalloc itself) is already running
+                  若已有其他采集（或tracemalloc本身）在运行则返回 False
+        """
+        with self._lock:
+            if self._owner is not None or tracemalloc.is_tracing():
+                return False
+            tracemalloc.start(frames)
+            tracemalloc.reset_peak()
+            self._baseline = self._take()
+            self._owner = owner
+            return True
+
+    @staticmethod
+    def _take():
+        return tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ])
+
+    def snapshot(self, limit=30):
+        """
+        Text report of the largest allocation growth since start()
+        自 start() 以来分配增长最多的文本报告
+        """
+        with self._lock:
+            if not tracemalloc.is_tracing():
+                raise RuntimeError('tracemalloc is not running')
+            snapshot = self._take()
+            current, peak = tracemalloc.get_traced_memory()
+            out = io.StringIO()
+            out.write(f'traced {current / 1024 / 1024:.1f} MiB, peak {peak / 1024 / 1024:.1f} MiB\n\n')
+            out.write('Top growth by traceback since start:\n')
+            stats = snapshot.compare_to(self._baseline, 'traceback') if self._baseline else snapshot.statistics('traceback')
+            for stat in stats[:limit]:
+                out.write(f'\n{stat}\n')
+                for line in stat.traceback.format(limit=8):
+                    out.write(f'{line}\n')
+            return out.getvalue()
+
+    def stop(self, owner):
+        """
+        End owner's capture 结束所有者的采集
+
+        Returns:
+            bool: False if owner does not hold the capture 若所有者未持有采集则返回 False
+        """
+        with self._lock:
+            if self._owner is None or self._owner != owner:
+                return False
+            self._owner = None
+            self._baseline = None
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+            return True
+
+
+def render_flamegraph(collapsed, title='Flame Graph', width=1200, row_height=16):
+    """
+    Render collapsed stacks as a standalone SVG flamegraph
+    将折叠栈渲染为独立的SVG火焰图
+    """
+    root = {'name': 'all', 'value': 0, 'children': {}}
+    for line in collapsed.splitlines():
+        stack, _, count = line.rpartition(' ')
+        if not stack or not count.isdigit():
+            continue
+        count = int(count)
+        node = root
+        node['value'] += count
+        for name in stack.split(';'):
+            node = node['children'].setdefault(name, {'name': name, 'value': 0, 'children': {}})
+            node['value'] += count
+
+    def depth_of(node):
+        return 1 + max((depth_of(child) for child in node['children'].values()), default=0)
+
+    total = root['value'] or 1
+    height = (depth_of(root) + 2) * row_height
+    rects = []
+
+    def place(node, x, depth):
+        w = node['value'] / total * width
+        if w < 0.3:
+            return
+        y = height - (depth + 1) * row_height
+        # Warm colours keyed by name, as in flamegraph.pl 与 flamegraph.pl 一致的按名称取暖色
+        hue = zlib.crc32(node['name'].encode('utf-8')) % 55
+        label = html.escape(node['name'])
+        share = node['value'] / total * 100
+        text = label if w > 40 else ''
+        rects.append(
+            f'<g><title>{label} ({node["value"]} samples, {share:.2f}%)</title>'
+            f'<rect x="{x:.2f}" y="{y}" width="{w:.2f}" height="{row_height - 1}" fill="hsl({hue},85%,60%)"/>'
+            f'<text x="{x + 3:.2f}" y="{y + row_height - 4}">'
+            f'{text[:max(int(w / 7), 0)]}</text></g>'
+        )
+        offset = x
+        for child in sorted(node['children'].values(), key=lambda c: c['name']):
+            place(child, offset, depth + 1)
+            offset += child['value'] / total * width
+
+    place(root, 0.0, 0)
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" '
+        f'font-family="Verdana" font-size="11">'
+        f'<text x="{width / 2}" y="{row_height}" text-anchor="middle" font-size="14">{html.escape(title)}</text>'
+        + ''.join(rects) + '</svg>'
+    )
+
+
+class ProfileStore:
+    """
+    Directory of saved captures, pruned to the newest `keep`
+    已保存采集结果的目录，只保留最新的 `keep` 个
+
+    Args:
+        directory: Where capture files are written 采集文件写入目录
+        keep: Captures kept 保留的采集数
+    """
+
+    def __init__(self, directory, keep=50):
+        self.directory = directory
+        self.keep = keep
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def new_id(kind):
+        return f'{time.strftime("%Y%m%d-%H%M%S")}-{kind}-{uuid.uuid4().hex[:6]}'
+
+    def save(self, kind, label, collapsed=None, profile=None, text=None, capture_id=None):
+        """
+        Write a capture's files 写入一次采集的文件
+
+        Returns:
+            str: Capture id 采集ID
+        """
+        capture_id = capture_id or self.new_id(kind)
+        base = os.path.join(self.directory, capture_id)
+        if collapsed is not None:
+            with open(f'{base}.{FORMAT_COLLAPSED}', 'w', encoding='utf-8') as f:
+                f.write(collapsed)
+            with open(f'{base}.{FORMAT_SVG}', 'w', encoding='utf-8') as f:
+                f.write(render_flamegraph(collapsed, title=label))
+        if profile is not None:
+            profile.dump_stats(f'{base}.{FORMAT_PSTATS}')
+        if text is not None:
+            with open(f'{base}.{FORMAT_TEXT}', 'w', encoding='utf-8') as f:
+                f.write(text)
+        self._prune()
+        return capture_id
+
+    def _prune(self):
+        with self._lock:
+            ids = sorted({name.rsplit('.', 1)[0] for name in os.listdir(self.directory)})
+            for capture_id in ids[:-self.keep] if len(ids) > self.keep else []:
+                for fmt in FORMATS:
+                    try:
+                        os.remove(os.path.join(self.directory, f'{capture_id}.{fmt}'))
+                    except FileNotFoundError:
+                        pass
+
+    def list(self):
+        captures = {}
+        for name in os.listdir(self.directory):
+            capture_id, _, fmt = name.rpartition('.')
+            if fmt in FORMATS:
+                captures.setdefault(capture_id, []).append(fmt)
+        return [{'id': capture_id, 'formats': sorted(formats)}
+                for capture_id, formats in sorted(captures.items(), reverse=True)]
+
+    def path(self, capture_id, fmt):
+        """
+        File path of a capture in a format, or None 某采集某格式的文件路径，不存在时为None
+        """
+        if fmt not in FORMATS or os.path.basename(capture_id) != capture_id or capture_id.startswith('.'):
+            return None
+        path = os.path.join(self.directory, f'{capture_id}.{fmt}')
+        return path if os.path.exists(path) else None
@@ -0,0 +1,189 @@
+"""
+Response Cache - reuse generated content keyed by prompt version
+响应缓存 - 按提示词版本复用已生成的内容
+
+Entries are keyed by endpoint, prompt version and normalized input, so
+editing a prompt template invalidates its entries automatically. The cache
+can be exported to and imported from a compact gzip JSON-lines file, which
+lets a deploy start with lessons generated ahead of time.
+条目以接口、提示词版本和规范化输入为键，因此修改提示词模板会自动使相关条目失效。
+缓存可以导出/导入为紧凑的gzip JSON行文件，使部署时即可使用预先生成的课程。
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+
+def prompt_version(template):
+    """
+    Short content hash of a prompt template
+    提示词模板的简短内容哈希
+    """
+    return hashlib.sha1(template.encode('utf-8')).hexdigest()[:10]
+
+
+def normalize_input(text):
+    """
+    Case- and whitespace-insensitive form of a cache input
+    缓存输入的大小写与空白不敏感形式
+    """
+    return re.sub(r'\s+', ' ', (text or '').strip().lower())
+
+
+class ResponseCache:
+    """
+    Thread-safe LRU cache with per-entry TTL
+    线程安全、条目带TTL的LRU缓存
+
+    Args:
+        capacity: Max entries 最大条目数
+        ttl: Seconds an entry stays valid 条目有效秒数
+    """
+
+    def __init__(self, capacity=2048, ttl=7 * 86400):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._entries = OrderedDict()  # (endpoint, version, key) -> (value, created_at)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, endpoint, version, key):
+        """
+        Cached value, or None if missing or expired
+        缓存值；缺失或过期时返回None
+        """
+        cache_key = (endpoint, version, normalize_input(key))
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is None or time.time() - entry[1] > self.ttl:
+                if entry is not None:
+                    del self._entries[cache_key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(cache_key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, endpoint, version, key, value, created_at=None):
+        cache_key = (endpoint, version, normalize_input(key))
+        with self._lock:
+            self._entries[cache_key] = (value, created_at or time.time())
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def export(self, path, endpoint=None):
+        """
+        Write live entries to a gzip JSON-lines file
+        将有效条目写入gzip JSON行文件
+
+        Returns:
+            int: Entries written 写入的条目数
+        """
+        now = time.time()
+        with self._lock:
+            entries = [
+                (k, v) for k, v in self._entries.items()
+                if now - v[1] <= self.ttl and (endpoint is None or k[0] == endpoint)
+            ]
+        tmp_path = f'{path}.tmp'
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+            for (ep, version, key), (value, created_at) in entries:
+                f.write(json.dumps({
+                    'endpoint': ep,
+                    'version': version,
+                    'key': key,
+                    'value': value,
+                    'createdAt': created_at
+                }, ensure_ascii=False, separators=(',', ':')) + '\n')
+        os.replace(tmp_path, path)
+        return len(entries)
+
+    def load(self, path, current_versions=None):
+        """
+        Import entries from an exported file
+        从导出文件导入条目
+
+        Args:
+            path: File written by export() 由 export() 写出的文件
+            current_versions: Optional {endpoint: version}; entries from other
+                              prompt versions are skipped
+                              可选 {接口: 版本}；跳过其他提示词版本的条目
+
+        Returns:
+            int: Entries imported 导入的条目数
+        """
+        loaded = 0
+        now = time.time()
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if current_versions is not None and current_versions.get(entry['endpoint']) != entry['version']:
+                    continue
+                if now - entry.get('createdAt', now) > self.ttl:
+                    continue
+                self.put(entry['endpoint'], entry['version'], entry['key'], entry['value'], entry.get('createdAt'))
+                loaded += 1
+        return loaded
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+class RequestLog:
+    """
+    Optional append-only JSON-lines log of requested inputs, for mining popular topics
+    可选的只追加JSON行请求日志，用于挖掘热门主题
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, **fields):
+        if not self.path:
+            return
+        line = json.dumps(dict(fields, endpoint=endpoint, ts=round(time.time(), 3)), ensure_ascii=False)
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+
+
+def top_topics(log_path, endpoint='teach', limit=50):
+    """
+    Most requested topics in a request log
+    请求日志中请求次数最多的主题
+
+    Args:
+        log_path: File written by RequestLog 由 RequestLog 写出的文件
+        endpoint: Endpoint to count 统计的接口
+        limit: Number of topics 主题数量
+
+    Returns:
+        list: (topic, count) pairs, most requested first (主题, 次数) 列表，按次数降序
+    """
+    counts = {}
+    display = {}
+    with open(log_path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry.get('endpoint') != endpoint or not entry.get('topic'):
+                continue
+            key = normalize_input(entry['topic'])
+            counts[key] = counts.get(key, 0) + 1
+            display.setdefault(key, entry['topic'].strip())
+    ranked = sorted(counts.items(), key=lambda item: item[1], reverse=True)[:limit]
+    return [(display[key], count) for key, count in ranked]
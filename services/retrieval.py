@@ -0,0 +1,241 @@
+"""
+Lesson Retrieval - BM25 index over generated lessons
+课程检索 - 基于BM25的课程内容索引
+
+Lessons are chunked into overlapping passages when they are generated, so
+follow-up questions only carry the few passages relevant to them instead of
+the whole lesson.
+课程生成时被切分为带重叠的段落，后续提问只携带相关段落而不是整篇课程。
+"""
+
+import hashlib
+import math
+import re
+import threading
+from collections import Counter, OrderedDict
+
+# Tokenizer: latin words/numbers, and single CJK characters 分词：拉丁词/数字，以及单个中日韩字符
+_TOKEN_RE = re.compile(r'[a-z0-9]+|[一-鿿]')
+
+_STOPWORDS = frozenset("""
+a an and are as at be but by can do does for from has have how i in into is it its
+of on or so that the their then there these this to was what when where which who
+why will with you your
+""".split())
+
+
+def tokenize(text):
+    """
+    Split text into lowercase search terms
+    将文本切分为小写检索词
+
+    Args:
+        text: Text to tokenize 待分词文本
+
+    Returns:
+        list: Search terms 检索词列表
+    """
+    return [t for t in _TOKEN_RE.findall(text.lower()) if t not in _STOPWORDS]
+
+
+def chunk_lesson(text, max_words=120, overlap_words=30):
+    """
+    Split a lesson into passages along paragraph boundaries
+    按段落边界将课程切分为段落块
+
+    Paragraphs are packed into passages of about max_words words; paragraphs
+    longer than that are split with a sliding window.
+    段落被打包成约 max_words 个词的块；超长段落用滑动窗口切分。
+
+    Args:
+        text: Lesson text 课程文本
+        max_words: Target passage size in words 每块目标词数
+        overlap_words: Words shared between consecutive windows 相邻窗口重叠词数
+
+    Returns:
+        list: Passage strings 段落块列表
+    """
+    paragraphs = [p.strip() for p in re.split(r'\n\s*\n', text or '') if p.strip()]
+    passages = []
+    current = []
+    current_len = 0
+
+    for paragraph in paragraphs:
+        words = paragraph.split()
+        if len(words) > max_words:
+            # Flush pending passage, then window the long paragraph 先输出已累积的块，再滑窗切分长段落
+            if current:
+                passages.append('\n\n'.join(current))
+                current, current_len = [], 0
+            step = max(max_words - overlap_words, 1)
+            for start in range(0, len(words), step):
+                passages.append(' '.join(words[start:start + max_words]))
+                if start + max_words >= len(words):
+                    break
+            continue
+
+        if current and current_len + len(words) > max_words:
+            passages.append('\n\n'.join(current))
+            current, current_len = [], 0
+        current.append(paragraph)
+        current_len += len(words)
+
+    if current:
+        passages.append('\n\n'.join(current))
+
+    return passages
+
+
+def lesson_id_for(text):
+    """
+    Stable identifier for a lesson's content
+    根据课程内容生成稳定的标识符
+    """
+    return hashlib.sha1((text or '').encode('utf-8')).hexdigest()[:16]
+
+
+class LessonIndex:
+    """
+    Okapi BM25 index over the passages of one lesson
+    单个课程段落的 Okapi BM25 索引
+    """
+
+    def __init__(self, text, k1=1.5, b=0.75, max_words=120, extra_texts=()):
+        self.lesson_id = lesson_id_for(text)
+        self.passages = chunk_lesson(text, max_words=max_words)
+        # Source material indexed alongside the lesson (e.g. document pages) 与课程一同索引的原始材料（如文档页面）
+        for extra in extra_texts:
+            self.passages.extend(chunk_lesson(extra, max_words=max_words))
+        self.k1 = k1
+        self.b = b
+
+        self._term_freqs = [Counter(tokenize(p)) for p in self.passages]
+        self._lengths = [sum(tf.values()) for tf in self._term_freqs]
+        self._avg_len = (sum(self._lengths) / len(self._lengths)) if self._lengths else 0.0
+
+        doc_freq = Counter()
+        for tf in self._term_freqs:
+            doc_freq.update(tf.keys())
+        n = len(self.passages)
+        self._idf = {
+            term: math.log(1 + (n - df + 0.5) / (df + 0.5))
+            for term, df in doc_freq.items()
+        }
+
+    def score(self, query):
+        """
+        BM25 score of every passage for a query
+        计算每个段落对查询的BM25得分
+
+        Args:
+            query: Query text 查询文本
+
+        Returns:
+            list: Score per passage, in passage order 按段落顺序的得分列表
+        """
+        terms = set(tokenize(query))
+        scores = []
+        for tf, length in zip(self._term_freqs, self._lengths):
+            norm = self.k1 * (1 - self.b + self.b * length / self._avg_len) if self._avg_len else self.k1
+            s = 0.0
+            for term in terms:
+                f = tf.get(term)
+                if f:
+                    s += self._idf[term] * f * (self.k1 + 1) / (f + norm)
+            scores.append(s)
+        return scores
+
+    def top_k(self, query, k=3):
+        """
+        Most relevant passages for a query, kept in lesson order
+        查询最相关的段落，按课程原顺序返回
+
+        Falls back to the opening passages when nothing matches, since the
+        introduction usually frames the topic.
+        若无任何匹配则回退到开头段落，因为开头通常概述主题。
+
+        Args:
+            query: Query text 查询文本
+            k: Number of passages 返回段落数
+
+        Returns:
+            list: Passage strings 段落列表
+        """
+        if not self.passages:
+            return []
+        scores = self.score(query)
+        ranked = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)[:k]
+        if not any(scores[i] > 0 for i in ranked):
+            ranked = list(range(min(k, len(self.passages))))
+        return [self.passages[i] for i in sorted(ranked)]
+
+
+class LessonIndexStore:
+    """
+    Bounded, thread-safe LRU of lesson indexes keyed by lesson id
+    以课程ID为键、有容量上限且线程安全的课程索引LRU缓存
+    """
+
+    def __init__(self, capacity=512):
+        self.capacity = capacity
+        self._indexes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, text, extra_texts=()):
+        """
+        Index a lesson (no-op if already indexed) and return its id
+        索引一篇课程（已索引则跳过）并返回其ID
+
+        Args:
+            text: Lesson text; its hash is the lesson id 课程文本；其哈希即课程ID
+            extra_texts: Source passages to retrieve from as well, e.g. document pages
+                         同样参与检索的原始段落，如文档页面
+        """
+        lesson_id = lesson_id_for(text)
+        with self._lock:
+            if lesson_id in self._indexes and not extra_texts:
+                self._indexes.move_to_end(lesson_id)
+                return lesson_id
+        index = LessonIndex(text, extra_texts=extra_texts)
+        with self._lock:
+            self._indexes[lesson_id] = index
+            self._indexes.move_to_end(lesson_id)
+            while len(self._indexes) > self.capacity:
+                self._indexes.popitem(last=False)
+        return lesson_id
+
+    def get(self, lesson_id):
+        with self._lock:
+            index = self._indexes.get(lesson_id)
+            if index is not None:
+                self._indexes.move_to_end(lesson_id)
+            return index
+
+    def retrieve(self, question, lesson_id='', teaching_context='', k=3):
+        """
+        Relevant lesson passages for a question
+        获取与问题相关的课程段落
+
+        Looks the lesson up by id first; if the client only sent the full
+        text (or the index was evicted), the text is indexed on the fly.
+        先按ID查找索引；若客户端只发送了全文（或索引已被淘汰），则即时建立索引。
+
+        Args:
+            question: Student's question 学生的问题
+            lesson_id: Id returned when the lesson was generated 课程生成时返回的ID
+            teaching_context: Full lesson text, optional 完整课程文本（可选）
+            k: Number of passages 返回段落数
+
+        Returns:
+            list or None: Passages, or None if no lesson is known 段落列表；若未知课程则为None
+        """
+        index = self.get(lesson_id) if lesson_id else None
+        if index is None and teaching_context:
+            index = self.get(self.add(teaching_context))
+        if index is None:
+            return None
+        return index.top_k(question, k=k)
+
+
+# Process-wide lesson index store 进程级课程索引存储
+lesson_indexes = LessonIndexStore()
@@ -0,0 +1,292 @@
+"""
+Upstream Scheduler - priority lanes and weighted fair queuing for model calls
+上游调度器 - 模型调用的优先级通道与加权公平排队
+
+Every Gemini call takes a slot from a fixed pool. Waiting calls are served
+by lane first (interactive > lesson > batch) and, within a lane, fairly
+across API keys and then across sessions of the same key, so a classroom
+sharing the default key cannot starve everyone else. A few slots are kept
+for the interactive lane, so lessons and background work can never hold the
+whole pool and quick follow-ups do not wait for a long generation to end.
+每次Gemini调用都需要从固定大小的池中获取槽位。等待中的调用先按通道优先级
+（交互 > 课程 > 批处理）服务，同一通道内先在API密钥之间、再在同一密钥的会话之间公平分配，
+因此共享默认密钥的整个班级无法使其他用户饥饿。部分槽位为交互通道保留，因此课程和后台任务
+永远无法占满整个池，快速追问也不必等待长时间的生成结束。
+"""
+
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from .fanout import key_fingerprint
+
+# Lanes, highest priority first 通道，按优先级从高到低
+LANE_INTERACTIVE = 'interactive'
+LANE_LESSON = 'lesson'
+LANE_BATCH = 'batch'
+LANES = (LANE_INTERACTIVE, LANE_LESSON, LANE_BATCH)
+
+
+class SchedulerTimeout(Exception):
+    """Raised when a call waited longer than its timeout for a slot 等待槽位超时时抛出"""
+
+
+class _Ticket:
+    __slots__ = ('lane', 'key', 'session', 'cost', 'enqueued_at', 'event')
+
+    def __init__(self, lane, key, session, cost):
+        self.lane = lane
+        self.key = key
+        self.session = session
+        self.cost = cost
+        self.enqueued_at = time.monotonic()
+        self.event = threading.Event()
+
+
+class _FairQueue:
+    """
+    Two-level start-time fair queue: keys, then sessions within a key
+    两级起始时间公平队列：先按密钥，再按密钥内的会话
+
+    Each flow carries a virtual finish tag; the flow with the smallest
+    start tag (max of its finish tag and the queue's virtual time) is served
+    next, and its tag advances by cost / weight.
+    每个流带有虚拟完成标签；起始标签（其完成标签与队列虚拟时间的较大值）最小的流先被服务，
+    其标签随后增加 cost / weight。
+    """
+
+    def __init__(self):
+        self.vtime = 0.0
+        self.key_finish = {}
+        self.session_vtime = {}
+        self.session_finish = {}
+        self.pending = {}  # key -> session -> deque of tickets 密钥 -> 会话 -> 票据队列
+        self.depth = 0
+
+    def push(self, ticket):
+        sessions = self.pending.setdefault(ticket.key, {})
+        sessions.setdefault(ticket.session, deque()).append(ticket)
+        self.depth += 1
+
+    def oldest_wait(self, now):
+        oldest = None
+        for sessions in self.pending.values():
+            for tickets in sessions.values():
+                waited = now - tickets[0].enqueued_at
+                if oldest is None or waited > oldest:
+                    oldest = waited
+        return oldest or 0.0
+
+    def pop(self, key_weight):
+        if not self.depth:
+            return None
+
+        # Pick key with smallest start tag 选择起始标签最小的密钥
+        key = min(self.pending, key=lambda k: max(self.key_finish.get(k, 0.0), self.vtime))
+        key_start = max(self.key_finish.get(key, 0.0), self.vtime)
+
+        # Pick session within key the same way 以同样方式在密钥内选择会话
+        sessions = self.pending[key]
+        key_vtime = self.session_vtime.get(key, 0.0)
+        finish = self.session_finish.setdefault(key, {})
+        session = min(sessions, key=lambda s: max(finish.get(s, 0.0), key_vtime))
+        session_start = max(finish.get(session, 0.0), key_vtime)
+
+        tickets = sessions[session]
+        ticket = tickets.popleft()
+        if not tickets:
+            del sessions[session]
+        if not sessions:
+            del self.pending[key]
+        self.depth -= 1
+
+        # Advance virtual clocks 推进虚拟时钟
+        self.vtime = key_start
+        self.key_finish[key] = key_start + ticket.cost / key_weight(key)
+        self.session_vtime[key] = session_start
+        finish[session] = session_start + ticket.cost
+
+        # Forget idle flows so tag tables stay bounded 清理空闲流，使标签表保持有界
+        if not self.depth:
+            self.key_finish.clear()
+            self.session_vtime.clear()
+            self.session_finish.clear()
+            self.vtime = 0.0
+        elif key not in self.pending:
+            self.session_vtime.pop(key, None)
+            self.session_finish.pop(key, None)
+        return ticket
+
+
+class UpstreamScheduler:
+    """
+    Admission control for upstream model calls
+    上游模型调用的准入控制
+
+    Args:
+        capacity: Max concurrent upstream calls 最大并发上游调用数
+        interactive_reserve: Slots only the interactive lane may use; lesson
+                             and batch calls together hold at most
+                             capacity - interactive_reserve
+                             仅交互通道可用的槽位数；课程与批处理调用合计最多占用
+                             capacity - interactive_reserve 个
+        key_weights: Optional {key fingerprint: weight} 可选的 {密钥指纹: 权重}
+        max_lane_wait: Seconds after which a lower lane's head is served
+                       ahead of higher lanes, so batch work is never starved
+                       低优先级通道队首等待超过该秒数后优先于高优先级通道服务，避免批处理饥饿
+        sample_size: Wait-time samples kept per lane 每个通道保留的等待时间样本数
+    """
+
+    def __init__(self, capacity=8, interactive_reserve=2, key_weights=None, max_lane_wait=30.0, sample_size=1000):
+        self.capacity = max(int(capacity), 1)
+        self.interactive_reserve = 0
+        self._set_reserve(interactive_reserve)
+        self.key_weights = dict(key_weights or {})
+        self.max_lane_wait = max_lane_wait
+        self._lock = threading.Lock()
+        self._queues = {lane: _FairQueue() for lane in LANES}
+        self._active = {lane: 0 for lane in LANES}
+        self._granted = {lane: 0 for lane in LANES}
+        self._timeouts = {lane: 0 for lane in LANES}
+        self._waits = {lane: deque(maxlen=sample_size) for lane in LANES}
+
+    def _key_weight(self, key):
+        return float(self.key_weights.get(key, 1.0)) or 1.0
+
+    def _set_reserve(self, reserve):
+        # At least one slot stays usable by the other lanes 至少保留一个槽位给其他通道
+        self.interactive_reserve = min(max(int(reserve), 0), self.capacity - 1)
+
+    @property
+    def shared_capacity(self):
+        """Slots lesson and batch calls may hold together 课程与批处理调用合计可占用的槽位数"""
+        return self.capacity - self.interactive_reserve
+
+    def _next_ticket(self):
+        now = time.monotonic()
+        # Lower lanes only while they are under their share 低优先级通道仅在未超出份额时可被服务
+        lower_lanes = LANES[1:]
+        if sum(self._active[lane] for lane in lower_lanes) >= self.shared_capacity:
+            lower_lanes = ()
+        # Aged lower lanes jump the queue 等待过久的低优先级通道插队
+        for lane in reversed(lower_lanes):
+            queue = self._queues[lane]
+            if queue.depth and queue.oldest_wait(now) >= self.max_lane_wait:
+                return queue.pop(self._key_weight)
+        for lane in (LANE_INTERACTIVE,) + lower_lanes:
+            queue = self._queues[lane]
+            if queue.depth:
+                return queue.pop(self._key_weight)
+        return None
+
+    def _dispatch(self):
+        # Caller holds the lock 调用方须持有锁
+        while sum(self._active.values()) < self.capacity:
+            ticket = self._next_ticket()
+            if ticket is None:
+                return
+            self._active[ticket.lane] += 1
+            self._granted[ticket.lane] += 1
+            self._waits[ticket.lane].append(time.monotonic() - ticket.enqueued_at)
+            ticket.event.set()
+
+    def _remove(self, ticket):
+        queue = self._queues[ticket.lane]
+        sessions = queue.pending.get(ticket.key, {})
+        tickets = sessions.get(ticket.session)
+        if tickets and ticket in tickets:
+            tickets.remove(ticket)
+            queue.depth -= 1
+            if not tickets:
+                del sessions[ticket.session]
+            if not sessions:
+                queue.pending.pop(ticket.key, None)
+            return True
+        return False
+
+    def set_capacity(self, capacity, interactive_reserve=None):
+        """
+        Change the number of concurrent upstream calls at runtime 运行时修改上游并发调用数
+        """
+        with self._lock:
+            self.capacity = max(int(capacity), 1)
+            self._set_reserve(self.interactive_reserve if interactive_reserve is None else interactive_reserve)
+            self._dispatch()
+
+    @contextmanager
+    def slot(self, lane, api_key='', session_id='', cost=1.0, timeout=None):
+        """
+        Wait for an upstream slot and hold it for the duration of the block
+        等待上游槽位，并在代码块执行期间占用
+
+        Args:
+            lane: One of LANES 通道名
+            api_key: API key the call will use (only its fingerprint is kept) 调用使用的API密钥（仅保留指纹）
+            session_id: Client session id 客户端会话ID
+            cost: Relative cost of the call 调用的相对成本
+            timeout: Max seconds to wait, None to wait indefinitely 最长等待秒数，None表示无限等待
+        """
+        if lane not in self._queues:
+            raise ValueError(f'Unknown scheduler lane: {lane}')
+
+        ticket = _Ticket(lane, key_fingerprint(api_key), session_id or '', max(float(cost), 0.01))
+        with self._lock:
+            self._queues[lane].push(ticket)
+            self._dispatch()
+
+        if not ticket.event.wait(timeout):
+            with self._lock:
+                if self._remove(ticket):
+                    self._timeouts[lane] += 1
+                    raise SchedulerTimeout(f'Waited more than {timeout}s for an upstream slot')
+            # Granted between the timeout and taking the lock 在超时与加锁之间已获得槽位
+
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._active[lane] -= 1
+                self._dispatch()
+
+    def snapshot(self):
+        """
+        Queue depth, concurrency and wait-time percentiles per lane
+        每个通道的队列深度、并发数和等待时间百分位
+
+        Returns:
+            dict: Metrics snapshot 指标快照
+        """
+        with self._lock:
+            now = time.monotonic()
+            lanes = {}
+            for lane in LANES:
+                waits = sorted(self._waits[lane])
+                queue = self._queues[lane]
+                lanes[lane] = {
+                    'queued': queue.depth,
+                    'queuedKeys': len(queue.pending),
+                    'active': self._active[lane],
+                    'granted': self._granted[lane],
+                    'timeouts': self._timeouts[lane],
+                    'oldestWaitMs': round(queue.oldest_wait(now) * 1000, 1),
+                    'waitMs': {
+                        'p50': _percentile_ms(waits, 0.50),
+                        'p90': _percentile_ms(waits, 0.90),
+                        'p99': _percentile_ms(waits, 0.99),
+                    },
+                }
+            return {
+                'capacity': self.capacity,
+                'interactiveReserve': self.interactive_reserve,
+                'sharedCapacity': self.shared_capacity,
+                'active': sum(self._active.values()),
+                'lanes': lanes,
+            }
+
+
+def _percentile_ms(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    index = min(int(q * len(sorted_values)), len(sorted_values) - 1)
+    return round(sorted_values[index] * 1000, 1)
@@ -0,0 +1,227 @@
+"""
+Structured Output - stop a streamed JSON reply once the value is complete
+结构化输出 - 流式JSON回复在值完整后即停止
+
+Structured endpoints only keep the first JSON object or array of a reply;
+clean_json_response throws away any prose around it. JsonEarlyStop scans
+streamed chunks as they arrive and reports when a top-level value has
+closed, parsed and passed its schema check, so the caller can stop reading
+the stream instead of paying for the model's trailing commentary.
+结构化接口只保留回复中的第一个JSON对象或数组；clean_json_response 会丢弃其周围的文字。
+JsonEarlyStop 在流式块到达时进行扫描，当顶层值闭合、可解析且通过结构校验时报告完成，
+调用方即可停止读取流，而不必为模型的结尾评论付费。
+
+Merely leaving the read loop does not end the upstream call; cancel_stream
+cancels it so the model stops generating. open_stream exposes the transport
+call before the first chunk arrives, so it can be cancelled while still waiting.
+仅退出读取循环并不会结束上游调用；cancel_stream 会取消它，使模型停止生成。
+open_stream 在首个块到达之前就暴露传输层调用，因此等待期间也可以取消。
+"""
+
+import json
+
+try:
+    from google.generativeai import client as genai_client
+    from google.generativeai.types import generation_types
+except ImportError:
+    genai_client = None
+    generation_types = None
+
+
+def clean_json_response(text):
+    """
+    Clean AI response, remove markdown code block markers
+    清理AI响应，移除markdown代码块标记
+
+    Args:
+        text: Raw text returned by AI AI返回的原始文本
+
+    Returns:
+        str: Cleaned JSON string 清理后的JSON字符串
+    """
+    text = text.strip()
+
+    # Remove markdown code block markers 移除markdown代码块标记
+    if text.startswith('```json'):
+        text = text[7:]  # Remove opening ```json 移除开头的 ```json
+    elif text.startswith('```'):
+        text = text[3:]  # Remove opening ``` 移除开头的 ```
+
+    if text.endswith('```'):
+        text = text[:-3]  # Remove closing ``` 移除结尾的 ```
+
+    # Clean all leading and trailing whitespace again (including newlines) 再次清理所有前后空白字符（包括换行符）
+    text = text.strip()
+
+    # Find position of first '[' or '{' (JSON start) 找到第一个 '[' 或 '{' 的位置（JSON的开始）
+    json_start = -1
+    for i, char in enumerate(text):
+        if char in '[{':
+            json_start = i
+            break
+
+    if json_start > 0:
+        text = text[json_start:]
+
+    # Find position of last ']' or '}' (JSON end) 找到最后一个 ']' 或 '}' 的位置（JSON的结束）
+    json_end = -1
+    for i in range(len(text) - 1, -1, -1):
+        if text[i] in ']}':
+            json_end = i + 1
+            break
+
+    if json_end > 0:
+        text = text[:json_end]
+
+    return text.strip()
+
+
+def cancel_call(iterator):
+    """
+    Cancel a transport stream: a gRPC stream with cancel(), or a REST iterator
+    over a requests response that can be closed
+    取消传输层流：带 cancel() 的gRPC流，或基于 requests 响应、可关闭的REST迭代器
+
+    Returns:
+        bool: Whether a cancel or close was issued 是否已发出取消或关闭
+    """
+    for target, method in ((iterator, 'cancel'), (getattr(iterator, '_response', None), 'close')):
+        stop = getattr(target, method, None)
+        if callable(stop):
+            try:
+                stop()
+                return True
+            except Exception:
+                pass
+    return False
+
+
+def cancel_stream(response):
+    """
+    Cancel the upstream call behind a streamed GenerateContentResponse
+    取消流式 GenerateContentResponse 背后的上游调用
+
+    google-generativeai keeps the transport iterator in `_iterator`.
+    Safe to call on a finished stream.
+    google-generativeai 将传输层迭代器保存在 `_iterator` 中。对已结束的流调用也是安全的。
+
+    Returns:
+        bool: Whether a cancel or close was issued 是否已发出取消或关闭
+    """
+    if response is None or getattr(response, '_done', False):
+        return False
+    return cancel_call(getattr(response, '_iterator', None))
+
+
+def open_stream(model, contents, generation_config=None, on_open=None):
+    """
+    model.generate_content(contents, stream=True), with a hook on the open call
+    等同于 model.generate_content(contents, stream=True)，但可在调用打开时挂钩
+
+    generate_content blocks until the first chunk arrives, so a caller cannot
+    cancel a call that is stuck before its first token. Here the request is
+    sent first and on_open(iterator) runs before waiting; pass the iterator
+    to cancel_call to abort it from another thread.
+    generate_content 会阻塞到首个块到达，因此调用方无法取消卡在首个token之前的调用。
+    这里先发送请求，并在等待前运行 on_open(iterator)；将该迭代器传给 cancel_call 即可从其他线程中止。
+
+    Args:
+        model: genai.GenerativeModel
+        contents: Prompt or content parts 提示词或内容部分
+        generation_config: generation_config override generation_config 覆盖
+        on_open: Callable receiving the transport iterator 接收传输层迭代器的可调用对象
+
+    Returns:
+        GenerateContentResponse: Streamed response 流式响应
+    """
+    if generation_types is None or not hasattr(model, '_prepare_request'):
+        return model.generate_content(contents, generation_config=generation_config, stream=True)
+    request = model._prepare_request(contents=contents, generation_config=generation_config)
+    if model._client is None:
+        model._client = genai_client.get_default_generative_client()
+    with generation_types.rewrite_stream_error():
+        iterator = model._client.stream_generate_content(request)
+    if on_open is not None:
+        on_open(iterator)
+    return generation_types.GenerateContentResponse.from_iterator(iterator)
+
+
+class JsonEarlyStop:
+    """
+    Incremental scanner for the first schema-valid top-level JSON value
+    增量扫描第一个通过结构校验的顶层JSON值
+
+    Brackets inside strings are ignored. A value that closes but does not
+    parse or validate (e.g. "[1]" in leading prose) is skipped and scanning
+    continues after it.
+    忽略字符串内的括号。闭合但无法解析或未通过校验的值（如前导文字中的 "[1]"）会被跳过，并在其后继续扫描。
+
+    Args:
+        validator: Optional fn(data) -> bool schema check 可选的结构校验函数
+    """
+
+    def __init__(self, validator=None):
+        self.validator = validator
+        self.text = ''
+        self.done = False
+        self.value = None
+        self.json_text = None
+        self._start = -1
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, chunk):
+        """
+        Scan one chunk 扫描一个块
+
+        Returns:
+            bool: True once a valid value is complete; stop reading then 有效值完整时返回True，此时应停止读取
+        """
+        if self.done or not chunk:
+            return self.done
+        base = len(self.text)
+        self.text += chunk
+        for i, char in enumerate(chunk):
+            if self._start < 0:
+                if char in '[{':
+                    self._start = base + i
+                    self._depth = 1
+                continue
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == '\\':
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in '[{':
+                self._depth += 1
+            elif char in ']}':
+                self._depth -= 1
+                if self._depth == 0:
+                    if self._accept(self.text[self._start:base + i + 1]):
+                        return True
+                    self._start = -1
+        return False
+
+    def result(self):
+        """
+        The JSON value's text once done, else everything received
+        完成后为JSON值的文本，否则为收到的全部内容
+        """
+        return self.json_text if self.done else self.text
+
+    def _accept(self, candidate):
+        try:
+            data = json.loads(candidate)
+        except ValueError:
+            return False
+        if self.validator is not None and not self.validator(data):
+            return False
+        self.done = True
+        self.value = data
+        self.json_text = candidate
+        return True
@@ -0,0 +1,337 @@
+"""
+Tutoring Sessions - one persistent WebSocket session per connection
+辅导会话 - 每个连接一个持久的WebSocket会话
+
+A session keeps the API key, topic, lesson and histories server-side so each
+turn only carries the new message. At most one turn generates at a time; a
+new request (or an explicit cancel) stops the running one, and any part of
+the server can push events to a connected session.
+会话在服务端保存API密钥、主题、课程和历史，因此每轮只需携带新消息。同一时间最多只有一轮在生成；
+新请求（或显式取消）会停止正在运行的一轮，服务端任何部分都可以向已连接的会话推送事件。
+"""
+
+import itertools
+import json
+import secrets
+import threading
+
+
+class TurnCancelled(Exception):
+    """Raised inside a turn that was superseded or cancelled 在被取代或取消的轮次内部抛出"""
+
+
+class Turn:
+    """
+    One request/response exchange within a session
+    会话中的一次请求/响应交换
+    """
+
+    def __init__(self, turn_id, kind):
+        self.turn_id = turn_id
+        self.kind = kind
+        self.cancelled = threading.Event()
+        self.thread = None
+
+    def check_cancelled(self):
+        if self.cancelled.is_set():
+            raise TurnCancelled()
+
+
+class TutorSession:
+    """
+    Server-side state and message loop for one WebSocket connection
+    单个WebSocket连接的服务端状态与消息循环
+
+    Args:
+        ws: WebSocket with send(str) / receive() 具有 send(str) / receive() 的WebSocket
+        handlers: {message type: fn(session, message, turn)} run on a worker
+                  thread; fn may call session.send_token() and returns the
+                  result payload (dict)
+                  {消息类型: fn(session, message, turn)}，在工作线程中运行；
+                  fn 可调用 session.send_token()，并返回结果负载（dict）
+        on_error: Optional fn(exception) for logging 可选的错误日志回调
+        registry: Optional TutorSessionRegistry to join while serving 可选的会话注册表，服务期间加入
+        modes: Optional {mode: message types allowed in it}; hello picks one
+               可选的 {模式: 该模式允许的消息类型}；由hello选择
+    """
+
+    def __init__(self, ws, handlers, on_error=None, registry=None, modes=None):
+        self.ws = ws
+        self.handlers = handlers
+        self.on_error = on_error
+        self.registry = registry
+        self.modes = modes
+        self.session_id = ''  # Scheduling fairness only, never used to route pushes 仅用于公平调度，从不用于推送路由
+        self.user_id = ''  # Learner id for persisted history 用于持久化历史的学习者ID
+        self.api_key = ''
+        self.mode = next(iter(modes)) if modes else ''
+        # Server-issued, unguessable push address; clients pass it to HTTP calls
+        # whose results should be pushed here (X-Push-Token)
+        # 服务端签发的不可猜测的推送地址；客户端在希望结果推送到此处的HTTP调用中携带（X-Push-Token）
+        self.push_token = secrets.token_urlsafe(24)
+        # Teacher mode state 教师模式状态
+        self.topic = ''
+        self.lesson = ''
+        self.lesson_id = ''
+        self.history = []
+        # Student mode state: {thread id: [{question, answer}]} 学生模式状态
+        self.threads = {}
+        self._send_lock = threading.Lock()
+        self._turn_lock = threading.Lock()
+        self._turn = None
+        self._turn_ids = itertools.count(1)
+        self.closed = False
+        self.draining = False
+
+    # ---------- Outgoing 发送 ----------
+
+    def send(self, event):
+        """
+        Send one JSON event; safe from any thread
+        发送一个JSON事件；可在任意线程中调用
+
+        Returns:
+            bool: False if the connection is gone 连接已断开时返回False
+        """
+        if self.closed:
+            return False
+        try:
+            with self._send_lock:
+                self.ws.send(json.dumps(event, ensure_ascii=False))
+            return True
+        except Exception:
+            self.closed = True
+            return False
+
+    def send_token(self, turn, text):
+        """
+        Stream a chunk of generated text for a turn
+        为某轮流式发送一段生成的文本
+        """
+        turn.check_cancelled()
+        self.send({'type': 'token', 'turnId': turn.turn_id, 'text': text})
+
+    def push(self, event):
+        """
+        Server-initiated event (e.g. a background result)
+        服务端主动推送的事件（如后台任务结果）
+        """
+        return self.send(dict(event, type='push'))
+
+    # ---------- Turns 轮次 ----------
+
+    def cancel_current(self):
+        """
+        Cancel the running turn, if any
+        取消正在运行的轮次（如有）
+        """
+        with self._turn_lock:
+            turn = self._turn
+        if turn is not None:
+            turn.cancelled.set()
+        return turn
+
+    def _run_turn(self, turn, handler, message):
+        try:
+            self.send({'type': 'start', 'turnId': turn.turn_id, 'kind': turn.kind})
+            result = handler(self, message, turn)
+            turn.check_cancelled()
+            self.send(dict(result or {}, type='result', turnId=turn.turn_id, kind=turn.kind))
+        except TurnCancelled:
+            self.send({'type': 'cancelled', 'turnId': turn.turn_id})
+        except Exception as e:
+            if self.on_error:
+                self.on_error(e)
+            self.send({
+                'type': 'error',
+                'turnId': turn.turn_id,
+                'error': f'{turn.kind} failed',
+                'message': str(e)
+            })
+        finally:
+            with self._turn_lock:
+                if self._turn is turn:
+                    self._turn = None
+            if self.draining and not self.busy:
+                self.close()
+
+    def start_turn(self, kind, message):
+        """
+        Cancel the running turn and start a new one on a worker thread
+        取消正在运行的轮次，并在工作线程中开始新一轮
+        """
+        handler = self.handlers[kind]
+        previous = self.cancel_current()
+        turn = Turn(next(self._turn_ids), kind)
+        with self._turn_lock:
+            self._turn = turn
+        thread = threading.Thread(
+            target=self._run_after,
+            args=(previous, turn, handler, message),
+            name=f'tutor-turn-{turn.turn_id}',
+            daemon=True
+        )
+        turn.thread = thread
+        thread.start()
+        return turn
+
+    def _run_after(self, previous, turn, handler, message):
+        # Let the cancelled turn unwind so session state is not interleaved 等待被取消的轮次退出，避免会话状态交错
+        if previous is not None and previous.thread is not None:
+            previous.thread.join()
+        if turn.cancelled.is_set():
+            self.send({'type': 'cancelled', 'turnId': turn.turn_id})
+            return
+        self._run_turn(turn, handler, message)
+
+    @property
+    def busy(self):
+        with self._turn_lock:
+            return self._turn is not None
+
+    def close(self, code=1012, reason='Service restart'):
+        """
+        Close the connection; 1012 tells the client to reconnect later
+        关闭连接；1012 告知客户端稍后重连
+        """
+        try:
+            self.ws.close(reason=code, message=reason)
+        except Exception:
+            pass
+
+    def begin_drain(self):
+        """
+        Refuse new turns and close once the running turn finishes
+        拒绝新轮次，并在正在运行的轮次结束后关闭连接
+        """
+        self.draining = True
+        if not self.busy:
+            self.close()
+
+    # ---------- Message loop 消息循环 ----------
+
+    def handle(self, message):
+        """
+        Dispatch one incoming message
+        分发一条收到的消息
+        """
+        kind = message.get('type')
+        if kind == 'hello':
+            self.session_id = str(message.get('sessionId', ''))[:64] or self.session_id
+            self.user_id = str(message.get('learnerId', '')).strip()[:64] or self.user_id
+            self.api_key = str(message.get('apiKey', '')).strip()
+            if self.modes and message.get('mode') in self.modes:
+                self.mode = message['mode']
+            self.send({'type': 'ready', 'sessionId': self.session_id, 'mode': self.mode,
+                       'pushToken': self.push_token})
+        elif kind == 'context':
+            # Lesson loaded over HTTP: adopt it and start a fresh Q&A history 通过HTTP加载的课程：采用并重置问答历史
+            self.topic = str(message.get('topic', '')).strip()
+            self.lesson = str(message.get('lesson', ''))
+            self.lesson_id = str(message.get('lessonId', ''))
+            self.history = []
+        elif kind == 'cancel':
+            self.cancel_current()
+        elif kind == 'ping':
+            self.send({'type': 'pong'})
+        elif kind in self.handlers and self.draining:
+            self.send({'type': 'error', 'error': 'Server is restarting', 'retryable': True})
+        elif kind in self.handlers and self.modes and kind not in self.modes[self.mode]:
+            self.send({'type': 'error', 'error': f'{kind} is not available in {self.mode} mode'})
+        elif kind in self.handlers:
+            self.start_turn(kind, message)
+        else:
+            self.send({'type': 'error', 'error': f'Unknown message type: {kind}'})
+
+    def serve(self):
+        """
+        Read messages until the connection closes
+        读取消息直到连接关闭
+        """
+        if self.registry:
+            self.registry.register(self)
+        try:
+            while True:
+                raw = self.ws.receive()
+                if raw is None:
+                    break
+                try:
+                    message = json.loads(raw)
+                except (TypeError, ValueError):
+                    self.send({'type': 'error', 'error': 'Invalid JSON message'})
+                    continue
+                if isinstance(message, dict):
+                    self.handle(message)
+        except Exception:
+            # Connection closed by peer 对端关闭连接
+            pass
+        finally:
+            self.closed = True
+            self.cancel_current()
+            if self.registry:
+                self.registry.unregister(self)
+
+
+class TutorSessionRegistry:
+    """
+    Connected sessions by push token, for server-initiated pushes
+    按推送令牌索引的已连接会话，用于服务端推送
+
+    Tokens are issued by the server per connection, so a client cannot
+    register under someone else's address and receive their events.
+    令牌由服务端为每个连接签发，因此客户端无法注册到他人的地址并接收其事件。
+    """
+
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def register(self, session):
+        with self._lock:
+            self._sessions[session.push_token] = session
+
+    def unregister(self, session):
+        with self._lock:
+            if self._sessions.get(session.push_token) is session:
+                del self._sessions[session.push_token]
+
+    def has(self, push_token):
+        with self._lock:
+            return bool(push_token) and push_token in self._sessions
+
+    def push(self, push_token, event):
+        """
+        Push an event to the connection holding a token
+        向持有令牌的连接推送事件
+
+        Returns:
+            bool: Whether the event was delivered 是否成功送达
+        """
+        with self._lock:
+            session = self._sessions.get(push_token)
+        return session is not None and session.push(event)
+
+    def count(self):
+        with self._lock:
+            return len(self._sessions)
+
+    def drain(self):
+        """
+        Ask every session to finish its turn and close 要求每个会话完成当前轮次后关闭
+        """
+        with self._lock:
+            sessions = list(self._sessions.values())
+        for session in sessions:
+            session.begin_drain()
+
+    def busy(self):
+        """
+        Sessions with a turn still generating 仍有轮次在生成的会话数
+        """
+        with self._lock:
+            sessions = list(self._sessions.values())
+        return sum(1 for session in sessions if session.busy)
+
+
+# Process-wide session registry 进程级会话注册表
+tutor_sessions = TutorSessionRegistry()
@@ -0,0 +1,336 @@
+"""
+Usage Ledger - token, image and cost accounting per key, session and endpoint
+用量账本 - 按密钥、会话和接口统计token、图片与费用
+
+Every upstream call is recorded with its input/output tokens, images and
+estimated cost. Records are queued in memory and written to SQLite in
+batches by a background thread, so the request path never waits on disk.
+Daily totals are kept in memory (refreshed from the database, which other
+processes also write to) so budget checks are cheap.
+每次上游调用都会记录其输入/输出token、图片数量和估算费用。记录先在内存中排队，再由后台线程
+批量写入SQLite，因此请求路径从不等待磁盘。每日汇总保存在内存中（从数据库刷新，其他进程也会写入数据库），
+使预算检查开销很小。
+"""
+
+import atexit
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from .fanout import key_fingerprint
+
+# USD per million tokens (input, output) 每百万token的美元价格（输入，输出）
+DEFAULT_PRICING = {
+    'gemini-2.0-flash': (0.10, 0.40),
+    'gemini-2.0-flash-lite': (0.075, 0.30),
+}
+# Tokens Gemini bills per image when usage metadata is missing 缺少用量元数据时每张图片计费的token数
+IMAGE_TOKENS = 258
+
+BUDGET_NORMAL = 'normal'
+BUDGET_ECONOMY = 'economy'
+BUDGET_DEFERRED = 'deferred'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts REAL NOT NULL,
+    day TEXT NOT NULL,
+    key_hash TEXT NOT NULL,
+    session_id TEXT NOT NULL DEFAULT '',
+    endpoint TEXT NOT NULL DEFAULT '',
+    model TEXT NOT NULL DEFAULT '',
+    input_tokens INTEGER NOT NULL DEFAULT 0,
+    output_tokens INTEGER NOT NULL DEFAULT 0,
+    images INTEGER NOT NULL DEFAULT 0,
+    cost REAL NOT NULL DEFAULT 0,
+    estimated INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_usage_day_key ON usage (day, key_hash);
+CREATE INDEX IF NOT EXISTS idx_usage_day_session ON usage (day, session_id);
+CREATE INDEX IF NOT EXISTS idx_usage_day_endpoint ON usage (day, endpoint);
+"""
+
+_GROUP_COLUMNS = {'key': 'key_hash', 'session': 'session_id', 'endpoint': 'endpoint', 'model': 'model'}
+
+
+def usage_day(ts=None):
+    """
+    UTC day a timestamp falls on, as YYYY-MM-DD
+    时间戳所在的UTC日期（YYYY-MM-DD）
+    """
+    return time.strftime('%Y-%m-%d', time.gmtime(ts if ts is not None else time.time()))
+
+
+def estimate_cost(model, input_tokens, output_tokens, pricing=None):
+    """
+    Estimated USD cost of a call
+    一次调用的估算美元费用
+    """
+    pricing = pricing or DEFAULT_PRICING
+    name = (model or '').split('/')[-1]
+    input_price, output_price = pricing.get(name, pricing['gemini-2.0-flash'])
+    return (input_tokens * input_price + output_tokens * output_price) / 1_000_000
+
+
+def usage_counts(response, contents, text):
+    """
+    Token and image counts of one call, estimated when usage metadata is missing
+    一次调用的token与图片数量；缺少用量元数据时进行估算
+
+    Token counts come from usage_metadata; when it is missing they are
+    estimated from text length (and a fixed count per image).
+    token数来自 usage_metadata；缺失时根据文本长度（及每张图片的固定数量）估算。
+
+    Returns:
+        tuple: (input_tokens, output_tokens, images, estimated) 输入token、输出token、图片数、是否估算
+    """
+    parts = contents if isinstance(contents, list) else [contents]
+    images = sum(1 for part in parts if isinstance(part, dict) and 'mime_type' in part)
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is not None and getattr(usage, 'prompt_token_count', 0):
+        return usage.prompt_token_count, getattr(usage, 'candidates_token_count', 0) or 0, images, False
+    prompt_chars = sum(len(part) for part in parts if isinstance(part, str))
+    return prompt_chars // 4 + images * IMAGE_TOKENS, len(text or '') // 4, images, True
+
+
+class UsageLedger:
+    """
+    Write-behind usage store on SQLite
+    基于SQLite的延迟写入用量存储
+
+    Args:
+        path: SQLite database file 数据库文件路径
+        flush_interval: Max seconds a record waits before being written 记录写入前的最长等待秒数
+        batch_size: Max records per transaction 每个事务的最大记录数
+        refresh_interval: Seconds between reloads of today's totals 重新加载当日汇总的间隔秒数
+        pricing: {model: (input, output) USD per million tokens} 模型价格表
+    """
+
+    def __init__(self, path, flush_interval=2.0, batch_size=500, refresh_interval=15.0, pricing=None):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.refresh_interval = refresh_interval
+        self.pricing = pricing or DEFAULT_PRICING
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._day = usage_day()
+        self._stored = {}   # (scope, id) -> cost written today, any process 今日已写入的费用（所有进程）
+        self._pending = {}  # (scope, id) -> cost queued in this process 本进程排队中的费用
+        self.dropped = 0
+        with self._connection() as conn:
+            conn.executescript(_SCHEMA)
+        self._reload_totals()
+        self._writer = threading.Thread(target=self._write_loop, name='usage-ledger', daemon=True)
+        self._writer.start()
+        atexit.register(self.flush)
+
+    @contextmanager
+    def _connection(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            yield conn
+        finally:
+            conn.close()
+
+    # ---------- Recording 记录 ----------
+
+    def record(self, api_key, session_id, endpoint, model, input_tokens, output_tokens, images=0, estimated=False):
+        """
+        Queue one upstream call for writing; returns its estimated cost
+        将一次上游调用加入写入队列；返回其估算费用
+        """
+        cost = estimate_cost(model, input_tokens, output_tokens, self.pricing)
+        now = time.time()
+        row = (now, usage_day(now), key_fingerprint(api_key), session_id or '', endpoint or '',
+               (model or '').split('/')[-1], int(input_tokens), int(output_tokens), int(images),
+               cost, 1 if estimated else 0)
+        with self._lock:
+            self._roll_day(row[1])
+            for scope in self._scopes(row):
+                self._pending[scope] = self._pending.get(scope, 0.0) + cost
+        self._queue.put(row)
+        return cost
+
+    @staticmethod
+    def _scopes(row):
+        return (('key', row[2]), ('session', row[2] + ':' + row[3]))
+
+    def _roll_day(self, day):
+        # Totals restart at UTC midnight 汇总在UTC零点重置
+        if day != self._day:
+            self._day = day
+            self._stored = {}
+            self._pending = {}
+
+    def _write_loop(self):
+        last_refresh = time.monotonic()
+        while True:
+            batch = []
+            try:
+                batch.append(self._queue.get(timeout=self.flush_interval))
+                while len(batch) < self.batch_size:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            if batch:
+                self._write(batch)
+                for _ in batch:
+                    self._queue.task_done()
+            if batch or time.monotonic() - last_refresh > self.refresh_interval:
+                try:
+                    self._reload_totals()
+                except sqlite3.Error as e:
+                    print(f'Usage ledger refresh failed 用量账本刷新失败: {e}')
+                last_refresh = time.monotonic()
+
+    def _write(self, batch):
+        try:
+            with self._connection() as conn:
+                conn.execute('BEGIN')
+                conn.executemany(
+                    'INSERT INTO usage (ts, day, key_hash, session_id, endpoint, model, input_tokens, '
+                    'output_tokens, images, cost, estimated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    batch
+                )
+                conn.execute('COMMIT')
+        except sqlite3.Error as e:
+            print(f'Usage ledger write failed 用量账本写入失败: {e}')
+            with self._lock:
+                self.dropped += len(batch)
+        with self._lock:
+            for row in batch:
+                if row[1] != self._day:
+                    continue
+                for scope in self._scopes(row):
+                    remaining = self._pending.get(scope, 0.0) - row[9]
+                    if remaining > 1e-12:
+                        self._pending[scope] = remaining
+                    else:
+                        self._pending.pop(scope, None)
+
+    def _reload_totals(self):
+        day = usage_day()
+        stored = {}
+        with self._connection() as conn:
+            for key_hash, session_id, cost in conn.execute(
+                'SELECT key_hash, session_id, SUM(cost) FROM usage WHERE day = ? GROUP BY key_hash, session_id',
+                (day,)
+            ):
+                stored[('key', key_hash)] = stored.get(('key', key_hash), 0.0) + cost
+                stored[('session', key_hash + ':' + session_id)] = cost
+        with self._lock:
+            self._roll_day(day)
+            self._stored = stored
+
+    def flush(self, timeout=5.0):
+        """
+        Wait until queued records are written
+        等待排队中的记录写入完成
+        """
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+    # ---------- Reading 读取 ----------
+
+    def spent_today(self, api_key, session_id=None):
+        """
+        Estimated USD spent today by a key, or by one session on that key
+        某密钥（或该密钥下某会话）今日的估算花费（美元）
+        """
+        scope = ('key', key_fingerprint(api_key))
+        if session_id is not None:
+            scope = ('session', scope[1] + ':' + session_id)
+        with self._lock:
+            self._roll_day(usage_day())
+            return self._stored.get(scope, 0.0) + self._pending.get(scope, 0.0)
+
+    def summary(self, day=None, group_by='key', limit=100):
+        """
+        Usage totals for a day grouped by key, session, endpoint or model
+        某日按密钥、会话、接口或模型分组的用量汇总
+        """
+        column = _GROUP_COLUMNS[group_by]
+        self.flush()
+        with self._connection() as conn:
+            rows = conn.execute(
+                f'SELECT {column}, COUNT(*), SUM(input_tokens), SUM(output_tokens), SUM(images), SUM(cost) '
+                f'FROM usage WHERE day = ? GROUP BY {column} ORDER BY SUM(cost) DESC LIMIT ?',
+                (day or usage_day(), limit)
+            ).fetchall()
+        return [{
+            group_by: row[0],
+            'requests': row[1],
+            'inputTokens': row[2],
+            'outputTokens': row[3],
+            'images': row[4],
+            'cost': round(row[5], 6)
+        } for row in rows]
+
+
+class DailyBudget:
+    """
+    Degrade instead of failing when a daily budget runs low
+    每日预算不足时降级而不是失败
+
+    Below soft_ratio of the budget calls run normally; above it they switch to
+    economy settings; past the budget they also move to the batch lane, so
+    they queue behind other traffic but still finish.
+    低于预算的 soft_ratio 时正常运行；超过后切换到经济设置；超出预算后还会移到批处理通道，
+    在其他流量之后排队但仍会完成。
+
+    Args:
+        ledger: UsageLedger 用量账本
+        key_budget: USD per day for the whole key (0 = unlimited) 整个密钥每日美元预算（0为不限）
+        session_budget: USD per day for each session on the key (0 = unlimited) 每个会话每日美元预算
+        soft_ratio: Fraction of a budget at which economy mode starts 开始经济模式的预算比例
+    """
+
+    def __init__(self, ledger, key_budget=0.0, session_budget=0.0, soft_ratio=0.8):
+        self.ledger = ledger
+        self.key_budget = key_budget
+        self.session_budget = session_budget
+        self.soft_ratio = soft_ratio
+        self.decisions = {BUDGET_NORMAL: 0, BUDGET_ECONOMY: 0, BUDGET_DEFERRED: 0}
+        self._lock = threading.Lock()
+
+    def _level(self, spent, budget):
+        if not budget:
+            return BUDGET_NORMAL
+        if spent >= budget:
+            return BUDGET_DEFERRED
+        if spent >= budget * self.soft_ratio:
+            return BUDGET_ECONOMY
+        return BUDGET_NORMAL
+
+    def decide(self, api_key, session_id=''):
+        """
+        Budget level for the next call: normal, economy or deferred
+        下一次调用的预算级别：normal、economy 或 deferred
+        """
+        levels = [
+            self._level(self.ledger.spent_today(api_key), self.key_budget),
+            self._level(self.ledger.spent_today(api_key, session_id or ''), self.session_budget),
+        ]
+        order = [BUDGET_NORMAL, BUDGET_ECONOMY, BUDGET_DEFERRED]
+        level = max(levels, key=order.index)
+        with self._lock:
+            self.decisions[level] += 1
+        return level
+
+    def snapshot(self, api_key):
+        with self._lock:
+            decisions = dict(self.decisions)
+        return {
+            'keyBudget': self.key_budget,
+            'sessionBudget': self.session_budget,
+            'softRatio': self.soft_ratio,
+            'spentToday': round(self.ledger.spent_today(api_key), 6),
+            'decisions': decisions
+        }
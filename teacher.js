@@ -3,6 +3,7 @@ class TeacherModeApp {
         // Left side: Teaching content 左侧：教学内容
         this.topicInput = document.getElementById('topicInput');
         this.startTeachingBtn = document.getElementById('startTeachingBtn');
+        this.detailedLessonToggle = document.getElementById('detailedLessonToggle');
         this.teachingContent = document.getElementById('teachingContent');
         this.teachingStatus = document.getElementById('teachingStatus');
         
@@ -12,7 +13,9 @@ class TeacherModeApp {
         this.imagePreviewSection = document.getElementById('imagePreviewSection');
         this.previewImg = document.getElementById('previewImg');
         this.removeImageBtn = document.getElementById('removeImageBtn');
+        this.previewDocumentInfo = document.getElementById('previewDocumentInfo');
         this.uploadedImage = null;
+        this.uploadedDocument = null;  // PDFs or several pages, sent as files PDF或多页文件，以文件形式发送
         
         // Right side: Q&A 右侧：问答
         this.qaContent = document.getElementById('qaContent');
@@ -32,12 +35,20 @@ class TeacherModeApp {
         this.saveSettingsBtn = document.getElementById('saveSettings');
         this.clearApiKeyBtn = document.getElementById('clearApiKey');
         this.toggleVisibilityBtn = document.getElementById('toggleApiKeyVisibility');
+        this.sessionId = this.loadSessionId();  // Per-tab id for fair server scheduling 每个标签页的ID，用于服务端公平调度
+        this.learnerId = this.loadLearnerId();  // Long-lived id for saved history 用于保存历史的长期ID
         this.customApiKey = this.loadApiKey();
         
         // Current lesson state 当前课程状态
         this.currentTopic = '';
         this.currentLesson = '';
+        this.currentLessonId = '';  // Server-side lesson index id 服务端课程索引ID
         this.conversationHistory = [];  // Q&A history 问答历史
+        this.historyLessonTopic = '';  // Topic last answered from saved history 上次由已保存历史应答的主题
+        
+        // Persistent tutoring channel (null = use HTTP) 持久辅导通道（null表示使用HTTP）
+        this.tutorSocket = null;
+        this.latestQuestionId = 0;
         
         // Welcome message flags 欢迎消息标志
         this.teachingWelcomeHidden = false;
@@ -52,6 +63,79 @@ class TeacherModeApp {
         this.showWelcomeMessages();
         this.updateApiKeyDisplay();
         this.initializeMarkdown();
+        this.connectTutorSocket();
+        this.restoreLastLesson();
+    }
+
+    // Returning learner: reload the latest lesson and its Q&A from the server 回访学习者：从服务器重新加载最新课程及问答
+    async restoreLastLesson() {
+        try {
+            const headers = { 'X-Session-Id': this.sessionId, 'X-Learner-Id': this.learnerId };
+            const list = await fetch('/api/history/lessons?limit=1', { headers });
+            if (!list.ok) return;
+            const { lessons } = await list.json();
+            if (!lessons || !lessons.length || this.currentTopic) return;
+            
+            const response = await fetch(`/api/history/lessons/${encodeURIComponent(lessons[0].lessonId)}`, { headers });
+            if (!response.ok || this.currentTopic) return;
+            const lesson = await response.json();
+            
+            this.currentTopic = lesson.topic;
+            this.currentLesson = lesson.content;
+            this.currentLessonId = lesson.lessonId;
+            this.conversationHistory = [];
+            this.displayLesson(lesson.content, lesson.topic);
+            lesson.turns.forEach(turn => {
+                this.displayStudentQuestion(turn.message);
+                this.displayTeacherAnswer(turn.reply);
+                this.conversationHistory.push({ question: turn.message, answer: turn.reply.answer });
+            });
+            if (this.useTutorSocket()) {
+                this.tutorSocket.setContext(this.currentTopic, this.currentLesson, this.currentLessonId);
+            }
+            this.enableQuestionInput();
+        } catch (error) {
+            console.error('Could not restore last lesson:', error);
+        }
+    }
+
+    // Open the WebSocket channel; HTTP stays the fallback 打开WebSocket通道；HTTP作为兜底
+    connectTutorSocket() {
+        if (typeof TutorSocket === 'undefined' || typeof WebSocket === 'undefined') {
+            return;
+        }
+        new TutorSocket({
+            sessionId: this.sessionId,
+            learnerId: this.learnerId,
+            apiKey: this.customApiKey,
+            mode: 'teacher',
+            onPush: (event) => this.showNotification(event.message || 'New update received', 'info'),
+            // Reconnect after a server restart or dropped connection 服务重启或连接断开后重连
+            onClose: () => this.scheduleTutorReconnect()
+        }).connect()
+            .then((socket) => {
+                this.tutorSocket = socket;
+                this.tutorReconnectDelay = 1000;
+                if (this.currentTopic) {
+                    socket.setContext(this.currentTopic, this.currentLesson, this.currentLessonId);
+                }
+            })
+            .catch(() => {
+                this.tutorSocket = null;
+                if (this.tutorReconnectDelay) this.scheduleTutorReconnect();
+            });
+    }
+
+    // Retry with exponential backoff, 1s up to 30s; HTTP is used meanwhile 指数退避重试（1秒至30秒），期间使用HTTP
+    scheduleTutorReconnect() {
+        this.tutorSocket = null;
+        const delay = this.tutorReconnectDelay || 1000;
+        this.tutorReconnectDelay = Math.min(delay * 2, 30000);
+        setTimeout(() => this.connectTutorSocket(), delay);
+    }
+
+    useTutorSocket() {
+        return this.tutorSocket !== null && this.tutorSocket.isOpen();
     }
 
     // Initialize Markdown renderer 初始化Markdown渲染器
@@ -186,13 +270,15 @@ class TeacherModeApp {
             const dt = e.dataTransfer;
             const files = dt.files;
             
-            if (files.length > 0) {
+            if (files.length > 1 || (files.length === 1 && files[0].type === 'application/pdf')) {
+                this.handleDocumentFiles(Array.from(files));
+            } else if (files.length > 0) {
                 const file = files[0];
                 
                 if (file.type.startsWith('image/')) {
                     this.handleImageFile(file);
                 } else {
-                    this.showNotification('Please drop an image file', 'warning');
+                    this.showNotification('Please drop an image or PDF file', 'warning');
                 }
             }
         }, false);
@@ -280,6 +366,7 @@ class TeacherModeApp {
         const apiKey = this.apiKeyInput.value.trim();
         this.customApiKey = apiKey;
         this.saveApiKey(apiKey);
+        if (this.tutorSocket) this.tutorSocket.updateApiKey(apiKey);
         this.showNotification('Settings saved! 设置已保存！', 'success');
         this.closeSettings();
         this.updateApiKeyDisplay();
@@ -289,6 +376,7 @@ class TeacherModeApp {
         this.customApiKey = '';
         this.apiKeyInput.value = '';
         localStorage.removeItem('gemini_api_key');
+        if (this.tutorSocket) this.tutorSocket.updateApiKey('');
         this.showNotification('Custom API key cleared! 已清除自定义API密钥！', 'success');
         this.updateApiKeyDisplay();
     }
@@ -311,6 +399,28 @@ class TeacherModeApp {
         return localStorage.getItem('gemini_api_key') || '';
     }
 
+    loadSessionId() {
+        let sessionId = sessionStorage.getItem('learning_session_id');
+        if (!sessionId) {
+            sessionId = (window.crypto && crypto.randomUUID)
+                ? crypto.randomUUID()
+                : `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+            sessionStorage.setItem('learning_session_id', sessionId);
+        }
+        return sessionId;
+    }
+
+    loadLearnerId() {
+        let learnerId = localStorage.getItem('learner_id');
+        if (!learnerId) {
+            learnerId = (window.crypto && crypto.randomUUID)
+                ? crypto.randomUUID()
+                : `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+            localStorage.setItem('learner_id', learnerId);
+        }
+        return learnerId;
+    }
+
     updateApiKeyDisplay() {
         if (this.customApiKey) {
             this.settingsBtn.classList.add('active');
@@ -365,8 +475,10 @@ class TeacherModeApp {
     }
     
     setQALoading(isLoading) {
-        this.askQuestionBtn.disabled = isLoading;
-        this.questionInput.disabled = isLoading;
+        // On the tutoring channel a new question cancels the one in progress 在辅导通道上，新问题会取消进行中的问题
+        const canInterrupt = isLoading && this.useTutorSocket();
+        this.askQuestionBtn.disabled = isLoading && !canInterrupt;
+        this.questionInput.disabled = isLoading && !canInterrupt;
         
         if (isLoading) {
             this.qaStatus.textContent = 'Thinking...';
@@ -404,7 +516,13 @@ class TeacherModeApp {
     // ==================== Image Handling 图片处理 ====================
     
     async handleImageSelect(event) {
-        const file = event.target.files[0];
+        const files = Array.from(event.target.files || []);
+        if (files.length > 1 || (files.length === 1 && files[0].type === 'application/pdf')) {
+            this.handleDocumentFiles(files);
+            return;
+        }
+        
+        const file = files[0];
         if (!file) return;
         
         // 检查文件类型
@@ -430,6 +548,7 @@ class TeacherModeApp {
             const base64 = await this.fileToBase64(compressedFile);
             
             // 保存图片数据
+            this.uploadedDocument = null;
             this.uploadedImage = {
                 data: base64,
                 mimeType: file.type,
@@ -520,13 +639,48 @@ class TeacherModeApp {
         });
     }
     
+    handleDocumentFiles(files) {
+        // PDFs and multi-page slide sets go to /api/documents as files PDF和多页幻灯片以文件形式发送到 /api/documents
+        const accepted = files.filter(f => f.type === 'application/pdf' || f.type.startsWith('image/'));
+        if (accepted.length !== files.length) {
+            this.showNotification('Please select PDF or image files only', 'warning');
+            return;
+        }
+        
+        const totalSize = accepted.reduce((sum, f) => sum + f.size, 0);
+        if (totalSize > 64 * 1024 * 1024) {
+            this.showNotification('Document too large (max 64MB)', 'warning');
+            return;
+        }
+        
+        this.uploadedImage = null;
+        this.uploadedDocument = accepted;
+        this.showDocumentPreview(accepted);
+        
+        if (!this.topicInput.value.trim()) {
+            this.topicInput.placeholder = 'Topic (optional, AI will read every page)';
+        }
+        this.showNotification('Document ready!', 'success');
+    }
+    
     showImagePreview(base64) {
         this.previewImg.src = `data:image/jpeg;base64,${base64}`;
+        this.previewImg.style.display = '';
+        this.previewDocumentInfo.style.display = 'none';
+        this.imagePreviewSection.style.display = 'block';
+    }
+    
+    showDocumentPreview(files) {
+        const names = files.map(f => f.name).join(', ');
+        this.previewDocumentInfo.textContent = files.length > 1 ? `📄 ${files.length} files: ${names}` : `📄 ${names}`;
+        this.previewDocumentInfo.style.display = 'block';
+        this.previewImg.style.display = 'none';
         this.imagePreviewSection.style.display = 'block';
     }
     
     removeImage() {
         this.uploadedImage = null;
+        this.uploadedDocument = null;
         this.imagePreviewSection.style.display = 'none';
         this.imageInput.value = '';
         this.topicInput.placeholder = 'Enter a topic to learn... e.g., \'Photosynthesis\', \'Blockchain\'...';
@@ -538,8 +692,9 @@ class TeacherModeApp {
     async handleStartTeaching() {
         const topic = this.topicInput.value.trim();
         const hasImage = this.uploadedImage !== null;
+        const hasDocument = this.uploadedDocument !== null;
         
-        if (!topic && !hasImage) {
+        if (!topic && !hasImage && !hasDocument) {
             this.showNotification('Please enter a topic or upload an image', 'warning');
             return;
         }
@@ -547,6 +702,12 @@ class TeacherModeApp {
         this.setTeachingLoading(true);
         
         try {
+            // Documents are read page by page on the server 文档在服务器端逐页阅读
+            if (hasDocument) {
+                await this.startDocumentLesson(topic);
+                return;
+            }
+            
             const requestData = {
                 apiKey: this.customApiKey
             };
@@ -559,11 +720,31 @@ class TeacherModeApp {
                 requestData.topic = topic;
             }
             
+            // Detailed text lessons are generated section by section 详细的文本课程按节生成
+            if (!hasImage && this.detailedLessonToggle && this.detailedLessonToggle.checked) {
+                await this.startSectionedLesson(requestData);
+                return;
+            }
+            
+            // Asking for the same topic right after a saved lesson was shown generates a new one
+            // 刚显示已保存的课程后再次请求同一主题时生成新课程
+            if (!hasImage && topic && topic === this.historyLessonTopic) {
+                requestData.regenerate = true;
+            }
+            
             const response = await this.requestTeaching(requestData);
+            this.historyLessonTopic = response.fromHistory ? topic : '';
+            if (response.fromHistory) {
+                this.showNotification('Showing your earlier lesson on this topic. Start it again for a new one.', 'info');
+            }
             
             this.currentTopic = topic || 'Image Analysis';
             this.currentLesson = response.content;
+            this.currentLessonId = response.lessonId || '';
             this.conversationHistory = [];  // Reset conversation history 重置对话历史
+            if (this.useTutorSocket()) {
+                this.tutorSocket.setContext(this.currentTopic, this.currentLesson, this.currentLessonId);
+            }
             
             this.displayLesson(response.content, this.currentTopic, hasImage);
             this.enableQuestionInput();
@@ -583,6 +764,8 @@ class TeacherModeApp {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
+                'X-Session-Id': this.sessionId,
+                'X-Learner-Id': this.learnerId,
             },
             body: JSON.stringify(data)
         });
@@ -595,6 +778,120 @@ class TeacherModeApp {
         return await response.json();
     }
 
+    async startSectionedLesson(data) {
+        this.currentTopic = data.topic;
+        this.currentLesson = '';
+        this.currentLessonId = '';
+        this.conversationHistory = [];  // Reset conversation history 重置对话历史
+        
+        const sections = [];
+        await this.requestSectionedTeaching({ ...data, detail: 'detailed' }, (event) => {
+            if (event.type === 'section') {
+                // Render each section as soon as it arrives 每节到达后立即渲染
+                sections.push(event.content);
+                this.displayLesson(sections.join('\n\n'), this.currentTopic);
+                this.teachingStatus.textContent = `Section ${sections.length} ready...`;
+            } else if (event.type === 'done') {
+                this.currentLesson = event.content;
+                this.currentLessonId = event.lessonId || '';
+                this.displayLesson(event.content, this.currentTopic);
+                if (this.useTutorSocket()) {
+                    this.tutorSocket.setContext(this.currentTopic, this.currentLesson, this.currentLessonId);
+                }
+            } else if (event.type === 'error') {
+                throw new Error(event.message || event.error);
+            }
+        });
+        
+        this.enableQuestionInput();
+    }
+
+    async startDocumentLesson(topic) {
+        this.currentTopic = topic || 'Document';
+        this.currentLesson = '';
+        this.currentLessonId = '';
+        this.conversationHistory = [];  // Reset conversation history 重置对话历史
+        
+        const formData = new FormData();
+        for (const file of this.uploadedDocument) {
+            formData.append('files', file, file.name);
+        }
+        formData.append('topic', topic);
+        formData.append('apiKey', this.customApiKey);
+        
+        const response = await fetch('/api/documents', {
+            method: 'POST',
+            headers: {
+                'X-Session-Id': this.sessionId,
+                'X-Learner-Id': this.learnerId,
+            },
+            body: formData
+        });
+        
+        if (!response.ok) {
+            const error = await response.json();
+            throw new Error(error.error || 'Network response was not ok');
+        }
+        
+        await this.readEventStream(response, (event) => {
+            if (event.type === 'document') {
+                this.teachingStatus.textContent = `Reading ${event.pageCount} pages...`;
+            } else if (event.type === 'page') {
+                const note = event.truncated ? ' (long page, text shortened)' : '';
+                this.teachingStatus.textContent = `Read page ${event.page} of ${event.pageCount}${note}...`;
+            } else if (event.type === 'done') {
+                this.currentTopic = event.topic;
+                this.currentLesson = event.content;
+                this.currentLessonId = event.lessonId || '';
+                this.displayLesson(event.content, this.currentTopic);
+                if (this.useTutorSocket()) {
+                    this.tutorSocket.setContext(this.currentTopic, this.currentLesson, this.currentLessonId);
+                }
+            } else if (event.type === 'error') {
+                throw new Error(event.message || event.error);
+            }
+        });
+        
+        this.enableQuestionInput();
+    }
+
+    async requestSectionedTeaching(data, onEvent) {
+        const response = await fetch('/api/teach-sectioned', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'X-Session-Id': this.sessionId,
+                'X-Learner-Id': this.learnerId,
+            },
+            body: JSON.stringify(data)
+        });
+
+        if (!response.ok) {
+            const error = await response.json();
+            throw new Error(error.error || 'Network response was not ok');
+        }
+
+        await this.readEventStream(response, onEvent);
+    }
+
+    async readEventStream(response, onEvent) {
+        // Read newline-delimited JSON events 读取按行分隔的JSON事件
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            const lines = buffer.split('\n');
+            buffer = lines.pop();
+            for (const line of lines) {
+                if (line.trim()) onEvent(JSON.parse(line));
+            }
+        }
+        if (buffer.trim()) onEvent(JSON.parse(buffer));
+    }
+
     displayLesson(content, topic, hasImage = false) {
         this.hideTeachingWelcome();
         
@@ -633,15 +930,22 @@ class TeacherModeApp {
             return;
         }
         
+        const questionId = ++this.latestQuestionId;
         this.setQALoading(true);
         
         try {
             // Display student's question 显示学生的问题
             this.displayStudentQuestion(question);
+            this.questionInput.value = '';
             
             // Get AI's answer 获取AI的回答
             const answerData = await this.requestAnswer(question);
             
+            // Superseded by a newer question 已被更新的问题取代
+            if (answerData === null) {
+                return;
+            }
+            
             // Display answer 显示回答
             this.displayTeacherAnswer(answerData);
             
@@ -651,27 +955,34 @@ class TeacherModeApp {
                 answer: answerData.answer
             });
             
-            // Clear input 清空输入
-            this.questionInput.value = '';
-            
         } catch (error) {
             console.error('Error asking question:', error);
             this.showNotification('Failed to get answer, please try again', 'error');
         } finally {
-            this.setQALoading(false);
+            if (questionId === this.latestQuestionId) {
+                this.setQALoading(false);
+            }
         }
     }
 
     async requestAnswer(question) {
+        if (this.useTutorSocket()) {
+            // Session keeps topic, lesson and history server-side 会话在服务端保存主题、课程和历史
+            return await this.tutorSocket.request('ask', { question });
+        }
+        
         const response = await fetch('/api/answer', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
+                'X-Session-Id': this.sessionId,
+                'X-Learner-Id': this.learnerId,
             },
             body: JSON.stringify({ 
                 topic: this.currentTopic,
                 question: question,
-                teachingContext: this.currentLesson,
+                lessonId: this.currentLessonId,
+                teachingContext: this.currentLesson,  // Fallback if the server index was evicted 服务端索引被淘汰时的兜底
                 conversationHistory: this.conversationHistory,
                 apiKey: this.customApiKey
             })
@@ -0,0 +1,107 @@
+"""
+Hedger against FakeBackend: threshold, budget and cancellation
+基于 FakeBackend 的 Hedger 测试：阈值、预算与取消
+
+Run 运行: python -m pytest -q tests/test_hedging.py
+"""
+
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.hedging import Attempt, FakeBackend, HedgeCancelled, Hedger
+
+
+def p95(samples):
+    samples = sorted(samples)
+    return samples[min(int(0.95 * len(samples)), len(samples) - 1)]
+
+
+def timed_calls(hedger, backend, count):
+    latencies = []
+    for _ in range(count):
+        start = time.monotonic()
+        hedger.call('respond', backend)
+        latencies.append(time.monotonic() - start)
+    return latencies
+
+
+class HedgerTest(unittest.TestCase):
+
+    def test_threshold_uses_default_until_enough_samples(self):
+        hedger = Hedger(endpoints={'respond'}, min_samples=5, default_delay=1.5, min_delay=0.01)
+        self.assertEqual(hedger.threshold('respond'), 1.5)
+        for seconds in (0.1, 0.2, 0.3, 0.4, 0.5):
+            hedger.latencies.record('respond', seconds)
+        self.assertAlmostEqual(hedger.threshold('respond'), 0.5)
+
+    def test_unhedged_endpoint_sends_one_attempt(self):
+        backend = FakeBackend(lambda: 0.05)
+        hedger = Hedger(endpoints={'respond'}, default_delay=0.01)
+        hedger.call('analyze', backend)
+        self.assertEqual(backend.calls, 1)
+        self.assertEqual(hedger.snapshot()['hedged'], 0)
+
+    def test_loser_is_cancelled(self):
+        slow = threading.Event()
+        cancelled = []
+
+        def fn(attempt):
+            attempt.mark_started()
+            if not attempt.hedge:
+                # Primary stuck before its first token 主请求卡在首个token之前
+                attempt.on_cancel(slow.set)
+                slow.wait(5)
+                cancelled.append(attempt.cancelled.is_set())
+                raise HedgeCancelled()
+            attempt.mark_first_token()
+            return 'hedge'
+
+        hedger = Hedger(endpoints={'respond'}, default_delay=0.05)
+        started = time.monotonic()
+        self.assertEqual(hedger.call('respond', fn), 'hedge')
+        self.assertLess(time.monotonic() - started, 1.0)
+        self.assertTrue(slow.wait(1))
+        time.sleep(0.05)
+        self.assertEqual(cancelled, [True])
+        self.assertEqual(hedger.snapshot()['hedgeWins'], 1)
+
+    def test_on_cancel_after_cancel_runs_at_once(self):
+        attempt = Attempt()
+        attempt.cancel()
+        ran = []
+        attempt.on_cancel(lambda: ran.append(True))
+        self.assertEqual(ran, [True])
+        self.assertRaises(HedgeCancelled, attempt.check_cancelled)
+
+    def test_hedges_stay_within_budget_and_cut_p95(self):
+        count = 200
+        ratio = 0.1
+        burst = 2.0
+
+        baseline = Hedger(endpoints=set())
+        plain = timed_calls(baseline, FakeBackend(FakeBackend.lognormal(0.01, 1.0, seed=7)), count)
+
+        hedger = Hedger(endpoints={'respond'}, percentile=0.9, min_samples=20, default_delay=0.05,
+                        min_delay=0.001, budget_ratio=ratio, budget_burst=burst)
+        backend = FakeBackend(FakeBackend.lognormal(0.01, 1.0, seed=7))
+        hedged = timed_calls(hedger, backend, count)
+        time.sleep(0.1)
+
+        stats = hedger.snapshot()
+        self.assertGreater(stats['hedged'], 0)
+        self.assertLessEqual(stats['hedged'], ratio * count + burst)
+        self.assertEqual(backend.calls, count + stats['hedged'])
+        # Every hedged call leaves exactly one loser, cancelled unless both finished together
+        # 每次对冲调用恰有一个落败者；除非两者同时完成，否则会被取消
+        self.assertGreater(backend.cancelled, 0)
+        self.assertLessEqual(backend.cancelled, stats['hedged'])
+        self.assertLess(p95(hedged), p95(plain))
+
+
+if __name__ == '__main__':
+    unittest.main()
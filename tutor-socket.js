@@ -0,0 +1,137 @@
+// Persistent tutoring channel client 持久辅导通道客户端
+// One WebSocket per page; each request is a "turn" answered by a result event.
+// Sending a new request cancels the running turn on the server.
+// 每个页面一个WebSocket；每个请求是一个"轮次"，由结果事件应答。发送新请求会在服务端取消正在运行的轮次。
+class TutorSocket {
+    constructor({ sessionId, learnerId, apiKey, mode, onPush, onClose }) {
+        this.sessionId = sessionId;
+        this.learnerId = learnerId || '';
+        this.apiKey = apiKey || '';
+        this.mode = mode;
+        this.onPush = onPush || (() => {});
+        this.onClose = onClose || (() => {});
+        this.ws = null;
+        this.ready = false;
+        this.pushToken = '';      // Server-issued; send as X-Push-Token to get job pushes here 服务端签发；作为 X-Push-Token 发送以在此接收任务推送
+        this.awaitingStart = [];  // Requests sent but not yet assigned a turn id 已发送但尚未分配轮次ID的请求
+        this.turns = {};          // turnId -> pending request 轮次ID -> 待处理请求
+    }
+
+    connect() {
+        return new Promise((resolve, reject) => {
+            const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
+            const url = `${protocol}//${window.location.host}/ws/tutor?sessionId=${encodeURIComponent(this.sessionId)}`;
+            try {
+                this.ws = new WebSocket(url);
+            } catch (error) {
+                reject(error);
+                return;
+            }
+
+            this.ws.onopen = () => {
+                this.ws.send(JSON.stringify({
+                    type: 'hello',
+                    sessionId: this.sessionId,
+                    learnerId: this.learnerId,
+                    apiKey: this.apiKey,
+                    mode: this.mode
+                }));
+            };
+
+            this.ws.onmessage = (message) => {
+                const event = JSON.parse(message.data);
+                if (event.type === 'ready') {
+                    this.pushToken = event.pushToken || '';
+                    this.ready = true;
+                    resolve(this);
+                    return;
+                }
+                this.handleEvent(event);
+            };
+
+            this.ws.onerror = () => {
+                if (!this.ready) reject(new Error('Tutoring channel unavailable'));
+            };
+
+            this.ws.onclose = (event) => {
+                const wasReady = this.ready;
+                this.ready = false;
+                // Fail everything still in flight 让所有进行中的请求失败
+                const pending = [...this.awaitingStart, ...Object.values(this.turns)];
+                this.awaitingStart = [];
+                this.turns = {};
+                pending.forEach(request => request.reject(new Error('Tutoring channel closed')));
+                // 1012 = server restarting; the caller may reconnect 1012表示服务重启；调用方可重连
+                if (wasReady) this.onClose(event.code);
+            };
+        });
+    }
+
+    isOpen() {
+        return this.ready && this.ws && this.ws.readyState === WebSocket.OPEN;
+    }
+
+    handleEvent(event) {
+        if (event.type === 'push') {
+            this.onPush(event);
+            return;
+        }
+        if (event.type === 'start') {
+            const request = this.awaitingStart.shift();
+            if (request) this.turns[event.turnId] = request;
+            return;
+        }
+
+        let request = this.turns[event.turnId];
+        if (!request && (event.type === 'cancelled' || (event.type === 'error' && !event.turnId))) {
+            // Superseded or refused before it started 开始前即被取代或拒绝
+            request = this.awaitingStart.shift();
+        }
+        if (!request) return;
+
+        if (event.type === 'token') {
+            request.onToken(event.text);
+        } else if (event.type === 'result') {
+            delete this.turns[event.turnId];
+            request.resolve(event);
+        } else if (event.type === 'cancelled') {
+            delete this.turns[event.turnId];
+            request.resolve(null);  // null means superseded 返回null表示已被取代
+        } else if (event.type === 'error') {
+            delete this.turns[event.turnId];
+            request.reject(new Error(event.message || event.error));
+        }
+    }
+
+    send(message) {
+        this.ws.send(JSON.stringify(message));
+    }
+
+    // Start a turn; resolves with the result event, or null if it was cancelled
+    // 开始一轮；以结果事件resolve，若被取消则为null
+    request(type, payload = {}, onToken = () => {}) {
+        return new Promise((resolve, reject) => {
+            this.awaitingStart.push({ resolve, reject, onToken });
+            this.send({ type, ...payload });
+        });
+    }
+
+    updateApiKey(apiKey) {
+        this.apiKey = apiKey || '';
+        if (this.isOpen()) {
+            this.send({ type: 'hello', sessionId: this.sessionId, learnerId: this.learnerId, apiKey: this.apiKey, mode: this.mode });
+        }
+    }
+
+    setContext(topic, lesson, lessonId) {
+        if (this.isOpen()) {
+            this.send({ type: 'context', topic, lesson, lessonId });
+        }
+    }
+
+    cancel() {
+        if (this.isOpen()) {
+            this.send({ type: 'cancel' });
+        }
+    }
+}
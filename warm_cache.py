@@ -0,0 +1,118 @@
+"""
+Lesson Cache Warmer - pre-generate lessons for popular topics
+课程缓存预热工具 - 为热门主题预先生成课程
+
+Generates /api/teach lessons in a rate-limited parallel batch and writes
+them to the cache file app.py loads at startup (RESPONSE_CACHE_FILE), so a
+deploy starts with a hot cache.
+以限速的并行批处理生成 /api/teach 课程，并写入 app.py 启动时加载的缓存文件（RESPONSE_CACHE_FILE），
+使部署启动时缓存即为热状态。
+
+Usage 用法:
+    python warm_cache.py --topics syllabus.txt
+    python warm_cache.py --from-log data/requests.jsonl --top 50 --concurrency 4 --rate 2
+    python warm_cache.py --import other_cache.jsonl.gz
+"""
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import app
+from services import RateLimiter, top_topics
+from services.response_cache import normalize_input
+from services.scheduler import LANE_BATCH
+
+
+def read_topics(path):
+    """
+    One topic per line; blank lines and '#' comments are ignored
+    每行一个主题；忽略空行和 '#' 注释
+    """
+    with open(path, encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip() and not line.strip().startswith('#')]
+
+
+def warm(topics, concurrency, rate, api_key=''):
+    """
+    Generate lessons for topics not already cached
+    为尚未缓存的主题生成课程
+
+    Returns:
+        tuple: (generated, skipped, failed) counts 生成、跳过、失败的数量
+    """
+    version = app.CACHE_VERSIONS['teach']
+    pending = [t for t in topics if app.response_cache.get('teach', version, t) is None]
+    skipped = len(topics) - len(pending)
+    limiter = RateLimiter(rate)
+
+    def generate(topic):
+        limiter.wait()
+        started = time.monotonic()
+        app.teach_with_ai(topic, api_key, lane=LANE_BATCH)
+        return time.monotonic() - started
+
+    generated = failed = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(generate, topic): topic for topic in pending}
+        for future in as_completed(futures):
+            topic = futures[future]
+            try:
+                seconds = future.result()
+                generated += 1
+                print(f'[{generated + failed}/{len(pending)}] OK   {topic} ({seconds:.1f}s)')
+            except Exception as e:
+                failed += 1
+                print(f'[{generated + failed}/{len(pending)}] FAIL {topic}: {e}')
+    return generated, skipped, failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Pre-generate lessons into the response cache 预生成课程到响应缓存')
+    parser.add_argument('--topics', help='File with one topic per line 每行一个主题的文件')
+    parser.add_argument('--from-log', help='Mine topics from a REQUEST_LOG_PATH file 从请求日志挖掘主题')
+    parser.add_argument('--top', type=int, default=50, help='Topics to take from the log 从日志中选取的主题数')
+    parser.add_argument('--import', dest='import_paths', action='append', default=[],
+                        help='Merge an exported cache file (repeatable) 合并已导出的缓存文件（可重复）')
+    parser.add_argument('--output', default=app.RESPONSE_CACHE_FILE,
+                        help='Cache file to write 输出的缓存文件 (default: RESPONSE_CACHE_FILE)')
+    parser.add_argument('--concurrency', type=int, default=4, help='Parallel generations 并行生成数')
+    parser.add_argument('--rate', type=float, default=1.0, help='Max generations started per second 每秒最多启动的生成数')
+    parser.add_argument('--api-key', default='', help='API key, defaults to GOOGLE_API_KEY 默认使用 GOOGLE_API_KEY')
+    args = parser.parse_args(argv)
+
+    for path in args.import_paths:
+        print(f'Imported {app.response_cache.load(path, app.CACHE_VERSIONS)} entries from {path}')
+
+    topics = []
+    if args.topics:
+        topics.extend(read_topics(args.topics))
+    if args.from_log:
+        mined = top_topics(args.from_log, 'teach', args.top)
+        print(f'Mined {len(mined)} topics from {args.from_log}')
+        topics.extend(topic for topic, _ in mined)
+    # De-duplicate by cache key, keep the first spelling 按缓存键去重，保留首次出现的写法
+    unique = {}
+    for topic in topics:
+        unique.setdefault(normalize_input(topic), topic)
+    topics = list(unique.values())
+
+    if not topics and not args.import_paths:
+        parser.error('nothing to do: pass --topics, --from-log or --import')
+
+    if topics:
+        generated, skipped, failed = warm(topics, args.concurrency, args.rate, args.api_key)
+        print(f'Generated {generated}, already cached {skipped}, failed {failed}')
+
+    output_dir = os.path.dirname(args.output)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    written = app.response_cache.export(args.output, endpoint='teach')
+    print(f'Wrote {written} lessons to {args.output}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())